@@ -10,14 +10,18 @@ import os
 from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
-from . import routing
 from channels.layers import get_channel_layer
 
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'daxApp.settings')
 
+# sets up django before the consumers import any models
+django_application = get_asgi_application()
+
+from . import routing  # noqa: E402
+
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
+    "http": django_application,
     "websocket": AuthMiddlewareStack(
         URLRouter(
             routing.websocket_urlpatterns
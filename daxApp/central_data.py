@@ -1,28 +1,80 @@
-from users.models import CompanyConnection, CustomUser
-from time_tracker.models import TTUserInfo, TTCompanyInfo
-from daxApp.encryption import encrypt_id
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from middleware.tenant import get_tenant
+from time_tracker.models import TTUserInfo
+from time_tracker.status_cache import get_cached_user_info, get_versioned_statuses
+from daxApp.encryption import encrypt_ids
+
+# The employee lists of the home and employees pages are built from the company's cached statuses, which the status
+# cache loads with one query. The built lists of DASHBOARD_CACHE_MAX_COMPANIES companies are kept with the version of
+# the statuses they came from, a status or employee change gives the statuses a new version.
+
+_fragments = OrderedDict()  # (company id, name): (status version, list)
+_lock = threading.Lock()
 
 
 def get_main_page_data(user, get_tt_employees=False, get_employee_list=False):
     arguments = dict()
-    arguments['company_connection'] = CompanyConnection.objects.filter(user=user)[0]
-    arguments['tt_company_info'] = TTCompanyInfo.objects.filter(company=user.company)[0]
-    arguments['tt_user_info'] = TTUserInfo.objects.filter(user=user)[0]
+    tenant = get_tenant(user)
+    arguments['company_connection'] = tenant.company_connection
+    arguments['tt_company_info'] = tenant.tt_company_info
+    arguments['tt_user_info'] = get_cached_user_info(user)
     arguments['user'] = user
     arguments['company'] = user.company
     arguments['tt_employees'] = []
     arguments['employees'] = []
 
     # if the user is the company owner and there are other employees then we should show the employees list
-    if arguments['company_connection'].role == 'c':
+    if tenant.role == 'c':
         if get_tt_employees:
-            tt_employees = TTUserInfo.objects.filter(user__company=user.company).exclude(user=user).order_by('user__full_name')
-            for i in tt_employees:
-                arguments['tt_employees'].append({'name': i.user.full_name, 'status': i.get_status_text_display(), 'time': i.status_time})
+            arguments['tt_employees'] = [employee for employee in get_fragment(user.company_id, 'tt_employees')
+                                         if employee['user_id'] != user.id]
 
         if get_employee_list:
-            employees = CustomUser.objects.filter(company=user.company).exclude(pk=user.pk).order_by('first_name')
-            for i in employees:
-                arguments['employees'].append({'pk': encrypt_id(i.pk), 'name': i.full_name, 'email': i.email, 'active': i.active})
+            arguments['employees'] = [employee for employee in get_fragment(user.company_id, 'employees')
+                                      if employee['user_id'] != user.id]
+
+    return arguments
+
+
+def get_fragment(company_id, name):
+    """The list of the company's employees the page shows, the lists must not be changed"""
+    version, statuses = get_versioned_statuses(company_id)
+    with _lock:
+        cached = _fragments.get((company_id, name))
+        if version is not None and cached and cached[0] == version:
+            _fragments.move_to_end((company_id, name))
+            return cached[1]
+    fragment = FRAGMENT_BUILDERS[name](statuses.values())
+    if version is not None and settings.DASHBOARD_CACHE_MAX_COMPANIES:
+        with _lock:
+            _fragments[(company_id, name)] = (version, fragment)
+            _fragments.move_to_end((company_id, name))
+            # a company has a list per name
+            while len(_fragments) > 2 * settings.DASHBOARD_CACHE_MAX_COMPANIES:
+                _fragments.popitem(last=False)
+    return fragment
+
+
+def build_tt_employees(statuses):
+    status_names = dict(TTUserInfo._meta.get_field('status_text').choices)
+    return [{'user_id': i['user_id'], 'name': i['name'], 'status': status_names.get(i['status_text']),
+             'time': i['status_time']} for i in sorted(statuses, key=lambda x: x['name'] or '')]
+
+
+def build_employees(statuses):
+    # the way the database orders them by first name, the ones without one first
+    statuses = sorted(statuses, key=lambda x: (x['first_name'] is not None, x['first_name'] or '', x['user_id']))
+    return [{'user_id': i['user_id'], 'pk': pk, 'name': i['name'], 'email': i['email'], 'active': i['active']}
+            for i, pk in zip(statuses, encrypt_ids([i['user_id'] for i in statuses]))]
+
+
+FRAGMENT_BUILDERS = {'tt_employees': build_tt_employees, 'employees': build_employees}
+
 
-    return arguments
\ No newline at end of file
+def clear_dashboard_cache():
+    with _lock:
+        _fragments.clear()
@@ -0,0 +1,34 @@
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.views import redirect_to_login
+
+
+def async_login_required(view):
+    """login_required for async views, the one django 4.1 ships can't wrap them. The user and their company are loaded
+        on a thread before the view runs so the view can read them without touching the database."""
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if is_request_user_loaded(request):
+            authenticated = request.user.is_authenticated
+        else:
+            authenticated = await sync_to_async(load_request_user)(request)
+        if not authenticated:
+            return redirect_to_login(request.get_full_path())
+        return await view(request, *args, **kwargs)
+    return wrapper
+
+
+def is_request_user_loaded(request):
+    """TenantMiddleware loads the user and sets their company on its thread, then there is nothing left to load"""
+    tenant = getattr(request, 'tenant', False)
+    if tenant is False:
+        return False
+    return tenant is None or tenant.user.company_id is None or tenant.user.__class__.company.is_cached(tenant.user)
+
+
+def load_request_user(request):
+    if not request.user.is_authenticated:
+        return False
+    request.user.company    # caches the company on the user
+    return True
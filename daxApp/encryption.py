@@ -1,29 +1,249 @@
+import abc
 import base64
-import os
-from cryptography.fernet import Fernet
+import binascii
+import hashlib
+import hmac
+import threading
+from collections import OrderedDict
+from cryptography.fernet import Fernet, InvalidToken
 from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-from daxApp.settings import ENCRYPT_CODE
+from django.conf import settings
+from django.utils.module_loading import import_string
 
 # Generate a salt
 salt = b'fndmentalSaltIsUsed'
 
+# The last ID_DECODE_CACHE_SIZE tokens that were decrypted are kept with their ids, the calendar sends the same ones
+# over and over. Only tokens that decrypted are kept, a bad token is checked every time.
 
-kdf = PBKDF2HMAC(
-    algorithm=hashes.SHA256(),
-    length=32,
-    salt=salt,
-    iterations=4    # 10000 is recommend for non sensitive data, but considering that I am not sharing the key outside of the application at the moment I am not concerned about someone breaking it.
-)
-key = base64.urlsafe_b64encode(kdf.derive(ENCRYPT_CODE))
-FERNET = Fernet(key)
+_master_key = None
+_codecs = {}
+_codec_path = None
+_decoded = OrderedDict()    # token: id
+_stats = {'hits': 0, 'misses': 0}
+_lock = threading.Lock()
+
+
+def get_master_key():
+    """The key every codec is made from, it is derived the first time an id is encrypted or decrypted"""
+    global _master_key
+    if _master_key is None:
+        with _lock:
+            if _master_key is None:
+                kdf = PBKDF2HMAC(
+                    algorithm=hashes.SHA256(),
+                    length=32,
+                    salt=salt,
+                    iterations=4    # 10000 is recommend for non sensitive data, but considering that I am not sharing the key outside of the application at the moment I am not concerned about someone breaking it.
+                )
+                _master_key = kdf.derive(settings.ENCRYPT_CODE)
+    return _master_key
+
+
+class IdCodec(abc.ABC):
+    """Turns database ids into opaque tokens for the pages and back, decode raises InvalidToken for a bad token"""
+
+    def __init__(self, master_key):
+        self.master_key = master_key
+
+    @abc.abstractmethod
+    def encode(self, in_id):
+        pass
+
+    @abc.abstractmethod
+    def decode(self, token):
+        pass
+
+    def encode_many(self, ids):
+        return [self.encode(in_id) for in_id in ids]
+
+    def decode_many(self, tokens):
+        return [self.decode(token) for token in tokens]
+
+
+class FernetIdCodec(IdCodec):
+    """The original tokens, about 100 characters and different every time an id is encrypted"""
+
+    def __init__(self, master_key):
+        super().__init__(master_key)
+        self.fernet = Fernet(base64.urlsafe_b64encode(master_key))
+
+    def encode(self, in_id):
+        return self.fernet.encrypt(bytes(str(in_id), 'utf-8')).decode()
+
+    def decode(self, token):
+        return int(self.fernet.decrypt(bytes(token, 'utf-8')).decode())
+
+
+class BlockIdCodec(IdCodec):
+    """22 character tokens that are the same every time for an id, so pages with them can be cached. The id and 8 zero
+        bytes are encrypted as one AES block, a changed or made up token decrypts to something without the zeros.
+        Tokens of any other length are decoded as Fernet tokens so the links handed out before keep working."""
+    TOKEN_LENGTH = 22
+    CHECK = bytes(8)
+
+    def __init__(self, master_key):
+        super().__init__(master_key)
+        self.cipher = Cipher(algorithms.AES(hmac.new(master_key, b'id codec', hashlib.sha256).digest()), modes.ECB())
+        self.legacy = FernetIdCodec(master_key)
+        self.contexts = threading.local()   # the cipher contexts can't be shared between threads
+
+    def get_contexts(self):
+        if not hasattr(self.contexts, 'encryptor'):
+            # ecb only ever sees single blocks, every id is a block of its own
+            self.contexts.encryptor = self.cipher.encryptor()
+            self.contexts.decryptor = self.cipher.decryptor()
+        return self.contexts
+
+    def encode(self, in_id):
+        try:
+            block = int(in_id).to_bytes(8, 'big') + self.CHECK
+        except OverflowError:
+            raise ValueError('Ids have to be between 0 and 2**64')
+        return base64.urlsafe_b64encode(self.get_contexts().encryptor.update(block))[:self.TOKEN_LENGTH].decode()
+
+    def decode(self, token):
+        if not isinstance(token, str) or len(token) != self.TOKEN_LENGTH:
+            return self.legacy.decode(token)
+        decrypted = self.get_contexts().decryptor.update(self.get_block(token))
+        if decrypted[8:] != self.CHECK:
+            raise InvalidToken
+        return int.from_bytes(decrypted[:8], 'big')
+
+    def get_block(self, token):
+        try:
+            block = base64.urlsafe_b64decode(token + '==')
+        except (binascii.Error, ValueError):
+            raise InvalidToken
+        if len(block) != 16:
+            raise InvalidToken
+        return block
+
+    def encode_many(self, ids):
+        try:
+            blocks = b''.join(int(in_id).to_bytes(8, 'big') + self.CHECK for in_id in ids)
+        except OverflowError:
+            raise ValueError('Ids have to be between 0 and 2**64')
+        encrypted = self.get_contexts().encryptor.update(blocks)
+        # 16 bytes are 22 base64 characters and two of padding
+        return [base64.urlsafe_b64encode(encrypted[index:index + 16])[:self.TOKEN_LENGTH].decode()
+                for index in range(0, len(encrypted), 16)]
+
+    def decode_many(self, tokens):
+        ids = []
+        blocks = []
+        for token in tokens:
+            if isinstance(token, str) and len(token) == self.TOKEN_LENGTH:
+                blocks.append(self.get_block(token))
+                ids.append(None)
+            else:
+                ids.append(self.legacy.decode(token))
+        decrypted = self.get_contexts().decryptor.update(b''.join(blocks))
+        block_ids = []
+        for index in range(0, len(decrypted), 16):
+            if decrypted[index + 8:index + 16] != self.CHECK:
+                raise InvalidToken
+            block_ids.append(int.from_bytes(decrypted[index:index + 8], 'big'))
+        block_ids.reverse()
+        return [block_ids.pop() if in_id is None else in_id for in_id in ids]
+
+
+def get_id_codec():
+    """The codec ID_CODEC names, one per process. Switching to another codec empties the decode cache."""
+    global _codec_path
+    path = settings.ID_CODEC
+    codec = _codecs.get(path)
+    if codec is None or path != _codec_path:
+        master_key = get_master_key()
+        with _lock:
+            codec = _codecs.get(path)
+            if codec is None:
+                codec = _codecs[path] = import_string(path)(master_key)
+            if path != _codec_path:
+                _decoded.clear()
+                _codec_path = path
+    return codec
 
 
 # Encrypt the ID
 def encrypt_id(in_id):
-    return FERNET.encrypt(bytes(str(in_id), 'utf-8')).decode()
+    return get_id_codec().encode(in_id)
 
 
 # Decrypt the ID
 def decrypt_id(in_id):
-    return int(FERNET.decrypt(bytes(in_id, 'utf-8')).decode())
+    codec = get_id_codec()
+    with _lock:
+        if in_id in _decoded:
+            _decoded.move_to_end(in_id)
+            _stats['hits'] += 1
+            return _decoded[in_id]
+        _stats['misses'] += 1
+    out_id = codec.decode(in_id)
+    cache_decoded({in_id: out_id})
+    return out_id
+
+
+def encrypt_ids(ids):
+    """encrypt_id for a list of ids, in one pass through the cipher"""
+    return get_id_codec().encode_many(ids)
+
+
+def decrypt_ids(tokens, skip_invalid=False):
+    """decrypt_id for a list of tokens, the ones that aren't cached are decrypted in one pass through the cipher.
+        A bad token raises InvalidToken, or becomes None with skip_invalid."""
+    codec = get_id_codec()
+    tokens = list(tokens)
+    found = {}
+    with _lock:
+        for token in tokens:
+            if token in _decoded and token not in found:
+                _decoded.move_to_end(token)
+                found[token] = _decoded[token]
+        _stats['hits'] += len(found)
+    missing = list(dict.fromkeys(token for token in tokens if token not in found))
+    with _lock:
+        _stats['misses'] += len(missing)
+    if missing:
+        try:
+            decoded = dict(zip(missing, codec.decode_many(missing)))
+        except (InvalidToken, TypeError, ValueError):
+            if not skip_invalid:
+                raise
+            decoded = {}
+            for token in missing:
+                try:
+                    decoded[token] = codec.decode(token)
+                except (InvalidToken, TypeError, ValueError):
+                    pass
+        cache_decoded(decoded)
+        found.update(decoded)
+    return [found.get(token) for token in tokens]
+
+
+def cache_decoded(decoded):
+    if not settings.ID_DECODE_CACHE_SIZE:
+        return
+    with _lock:
+        for token, out_id in decoded.items():
+            if isinstance(token, str):
+                _decoded[token] = out_id
+                _decoded.move_to_end(token)
+        while len(_decoded) > settings.ID_DECODE_CACHE_SIZE:
+            _decoded.popitem(last=False)
+
+
+def get_id_decode_stats():
+    """The hits and misses of the decode cache since the process started or the stats were cleared"""
+    with _lock:
+        lookups = _stats['hits'] + _stats['misses']
+        return {'hits': _stats['hits'], 'misses': _stats['misses'], 'size': len(_decoded),
+                'hit_rate': round(_stats['hits'] / lookups, 4) if lookups else None}
+
+
+def clear_id_decode_cache():
+    with _lock:
+        _decoded.clear()
+        _stats['hits'] = _stats['misses'] = 0
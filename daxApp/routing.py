@@ -1,6 +1,8 @@
 from django.urls import path
 from users import consumers
+from time_tracker.consumers import StatusBoardConsumer
 
 websocket_urlpatterns = [
     path('ws/', consumers.NotificationConsumer.as_asgi()),
+    path('ws/status_board/', StatusBoardConsumer.as_asgi()),
 ]
\ No newline at end of file
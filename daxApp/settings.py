@@ -44,15 +44,15 @@ INSTALLED_APPS = [
 ]   # by default, it always fails silently. Makes things easier to debug like this
 
 MIDDLEWARE = [
-    'whitenoise.middleware.WhiteNoiseMiddleware',
-    'django.middleware.security.SecurityMiddleware',
+    'middleware.static_files.AsyncWhiteNoiseMiddleware',
+    'middleware.builtin.AsyncSecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
-    'django.middleware.common.CommonMiddleware',
-    'django.middleware.csrf.CsrfViewMiddleware',
-    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'middleware.builtin.AsyncCommonMiddleware',
+    'middleware.builtin.AsyncCsrfViewMiddleware',
+    'middleware.builtin.AsyncAuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
-    'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'middleware.timezone.TimezoneMiddleware',
+    'middleware.builtin.AsyncXFrameOptionsMiddleware',
+    'middleware.tenant.TenantMiddleware',
 ]
 
 ROOT_URLCONF = 'daxApp.urls'
@@ -258,3 +258,81 @@ BACKUP_COUNT = 5
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 ENCRYPT_CODE = b"The Craziest pass3wrd you321 have enver seen"
+
+# Which engine calculates the report totals, 'python' or 'numpy'. Both give identical results.
+REPORT_CALCULATION_BACKEND = 'python'
+
+# Number of worker processes that generate reports in the background, 0 generates them inside the request.
+REPORT_WORKER_PROCESSES = 2
+
+# Seconds a queued or running report job can go without progress before it is failed as lost, the jobs only live in
+# the worker pool of the process that took them.
+REPORT_JOB_TIMEOUT = 60 * 30
+
+# Number of processes a single report is built with and how many employees each process builds at a time.
+REPORT_BUILD_PROCESSES = 1
+REPORT_BUILD_CHUNK_SIZE = 50
+
+# Rendered reports are reused until one of their employees' data changes. 0 entries disables the cache.
+REPORT_CACHE_MAX_ENTRIES = 500
+REPORT_CACHE_MAX_SIZE = 1024 * 1024 * 500  # 500 MB
+
+# Employees rendered into each section of a report pdf, it limits the html and the layout held at once but not the
+# merged pdf, which is built in memory. And how big the finished pdf gets before it moves to disk.
+REPORT_PDF_CHUNK_SIZE = 25
+REPORT_PDF_SPOOL_SIZE = 1024 * 1024 * 5  # 5 MB
+
+# Number of time actions written per INSERT by the bulk import.
+ACTION_IMPORT_BATCH_SIZE = 2000
+
+# How long a retried punch with the same idempotency key gets the first response back instead of punching again.
+PUNCH_IDEMPOTENCY_KEY_HOURS = 24
+
+# Most punches a kiosk or phone can sync in one request after being offline.
+PUNCH_SYNC_MAX_EVENTS = 1000
+
+# Write-behind punches: the simple clock appends punches to a log in PUNCH_LOG_DIR and answers right away, a background
+# thread saves them every PUNCH_FLUSH_INTERVAL seconds. An interval of 0 leaves it to the flush_punches command.
+PUNCH_WRITE_BEHIND = False
+PUNCH_LOG_DIR = os.path.join(BASE_DIR, 'punch_log')
+PUNCH_FLUSH_INTERVAL = 1
+PUNCH_FLUSH_BATCH_SIZE = 500
+
+# The statuses of the employees of this many companies are kept in memory for STATUS_CACHE_TTL seconds, 0 turns the
+# cache off. Processes let each other know about status, tenant and geofence changes through files in
+# STATUS_CACHE_BUS_DIR.
+STATUS_CACHE_MAX_COMPANIES = 1000
+STATUS_CACHE_TTL = 60
+STATUS_CACHE_BUS_DIR = os.path.join(BASE_DIR, 'status_cache')
+
+# Finished time actions older than this many days are moved into a table per year by the archive_actions command, so
+# the InOutAction table only holds recent history. Ranges that reach further back read the archive tables too.
+ACTION_ARCHIVE_DAYS = 730
+ACTION_ARCHIVE_BATCH_SIZE = 2000
+
+# Punch locations are checked against the company's geofences through a grid of GEOFENCE_GRID_SIZE degree cells. The
+# grids of this many companies are kept in memory for GEOFENCE_CACHE_TTL seconds, 0 companies loads them every punch.
+GEOFENCE_GRID_SIZE = 0.01
+GEOFENCE_CACHE_MAX_COMPANIES = 1000
+GEOFENCE_CACHE_TTL = 300
+GEOFENCE_REVALIDATE_BATCH_SIZE = 5000
+
+# The codec that turns ids into the tokens on the pages. BlockIdCodec tokens are short and the same every time for an
+# id, it still reads the FernetIdCodec tokens handed out before.
+ID_CODEC = 'daxApp.encryption.BlockIdCodec'
+
+# How many decrypted id tokens are kept in memory with their ids, 0 decrypts every token every time.
+ID_DECODE_CACHE_SIZE = 10000
+
+# The company, role and time tracker settings of this many users are kept in memory for TENANT_CACHE_TTL seconds, so a
+# request doesn't look them up again. 0 users loads them every request.
+TENANT_CACHE_MAX_USERS = 10000
+TENANT_CACHE_TTL = 60
+
+# The employee lists of the home and employees pages of this many companies are kept in memory until the statuses of
+# the company change, 0 builds them every time.
+DASHBOARD_CACHE_MAX_COMPANIES = 1000
+
+# Status changes are sent to the owners watching the company's status board once every STATUS_BOARD_TICK seconds, all
+# the changes of a tick in one message. 0 turns the board updates off.
+STATUS_BOARD_TICK = 1
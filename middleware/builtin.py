@@ -0,0 +1,48 @@
+from django.conf import settings
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.middleware.clickjacking import XFrameOptionsMiddleware
+from django.middleware.common import CommonMiddleware
+from django.middleware.csrf import CsrfViewMiddleware
+from django.middleware.security import SecurityMiddleware
+
+
+class InlineHooksMixin:
+    """Django 4.1 runs the process_request and process_response of every MiddlewareMixin on a thread under asgi, that is
+        two thread switches per middleware and request. The hooks of these middlewares only look at the request and
+        the response, so they are run on the event loop instead. Hooks that read the session or the database must stay
+        on a thread, they would raise SynchronousOnlyOperation here."""
+
+    async def __acall__(self, request):
+        response = None
+        if hasattr(self, 'process_request'):
+            response = self.process_request(request)
+        response = response or await self.get_response(request)
+        if hasattr(self, 'process_response'):
+            response = self.process_response(request, response)
+        return response
+
+
+class AsyncSecurityMiddleware(InlineHooksMixin, SecurityMiddleware):
+    pass
+
+
+class AsyncCommonMiddleware(InlineHooksMixin, CommonMiddleware):
+    pass
+
+
+class AsyncCsrfViewMiddleware(InlineHooksMixin, CsrfViewMiddleware):
+
+    async def __acall__(self, request):
+        if settings.CSRF_USE_SESSIONS:
+            # the token is read from the session
+            return await super(InlineHooksMixin, self).__acall__(request)
+        return await super().__acall__(request)
+
+
+class AsyncAuthenticationMiddleware(InlineHooksMixin, AuthenticationMiddleware):
+    """request.user is lazy, it is loaded on the thread of whoever reads it first"""
+    pass
+
+
+class AsyncXFrameOptionsMiddleware(InlineHooksMixin, XFrameOptionsMiddleware):
+    pass
@@ -0,0 +1,30 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from whitenoise.middleware import WhiteNoiseMiddleware
+
+
+class AsyncWhiteNoiseMiddleware(WhiteNoiseMiddleware):
+    """WhiteNoise 6.2 is sync only, at the top of the middleware it makes django run every request on a thread, the
+        async views included. The static files are served the same way, the other requests are passed on without a
+        thread."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response=None, *args, **kwargs):
+        super().__init__(get_response, *args, **kwargs)
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        if self.autorefresh:
+            # looks for the file on disk
+            response = await sync_to_async(self.process_request, thread_sensitive=False)(request)
+        else:
+            response = self.process_request(request)
+        if response is None:
+            response = await self.get_response(request)
+        return response
@@ -0,0 +1,170 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Subquery
+
+from middleware.timezone import activate_timezone, get_timezone
+
+# The company of a user, their role in it and the company's time tracker settings are loaded with one query and kept
+# for TENANT_CACHE_TTL seconds, for at most TENANT_CACHE_MAX_USERS users. Saving a company, its settings or a company
+# connection drops the entries it touches in this process and, once committed, writes a stamp for the company or the
+# user to the status cache's bus so the other processes drop theirs. Every request gets its own copies so a view can
+# change them without touching the cache.
+
+_tenants = OrderedDict()    # user id: {'loaded': time, 'company_id': id, 'stamps': ..., 'company': ..., ...}
+_lock = threading.Lock()
+
+
+class TenantContext:
+    """Who the user is within their company, built once per request by TenantMiddleware"""
+
+    def __init__(self, user, company, company_connection, tt_company_info):
+        self.user = user
+        self.company = company
+        self.company_connection = company_connection
+        self.tt_company_info = tt_company_info
+        self.timezone = get_timezone(user)
+
+    @property
+    def role(self):
+        return self.company_connection.role if self.company_connection else None
+
+
+class TenantMiddleware:
+    """Sets request.tenant and activates the timezone of the logged in user. Async capable so the async views aren't
+        pushed onto a thread, the tenant is built on one since that reads the session and the database."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            # lets django see __call__ as a coroutine function
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        activate_timezone(get_request_timezone(request))
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        activate_timezone(await sync_to_async(get_request_timezone)(request))
+        return await self.get_response(request)
+
+
+def get_request_timezone(request):
+    if request.user.is_authenticated:
+        request.tenant = get_tenant(request.user)
+        return request.tenant.timezone
+    request.tenant = None
+    return None
+
+
+def get_tenant(user):
+    """The tenant of the user, it is kept on the user so it is only built once for them. The user's company is set to
+        the tenant's."""
+    tenant = getattr(user, '_tenant', None)
+    if tenant is None:
+        entry = get_tenant_entry(user)
+        company = copy.copy(entry['company'])
+        company_connection = copy.copy(entry['company_connection'])
+        tt_company_info = copy.copy(entry['tt_company_info'])
+        if company is not None:
+            user.company = company
+            tt_company_info.company = company
+        tenant = user._tenant = TenantContext(user, company, company_connection, tt_company_info)
+    return tenant
+
+
+def get_tenant_entry(user):
+    cached = settings.TENANT_CACHE_MAX_USERS and not connection.in_atomic_block
+    stamps = read_tenant_stamps(user.company_id, user.id) if cached else None
+    if cached:
+        with _lock:
+            entry = _tenants.get(user.id)
+            if entry and entry['company_id'] == user.company_id and entry['stamps'] == stamps and \
+                    time.monotonic() - entry['loaded'] < settings.TENANT_CACHE_TTL:
+                _tenants.move_to_end(user.id)
+                return entry
+    entry = load_tenant(user)
+    entry['stamps'] = stamps
+    # nothing read inside a transaction is cached, it might be rolled back
+    if cached:
+        with _lock:
+            _tenants[user.id] = entry
+            _tenants.move_to_end(user.id)
+            while len(_tenants) > settings.TENANT_CACHE_MAX_USERS:
+                _tenants.popitem(last=False)
+    return entry
+
+
+def load_tenant(user):
+    """The company, company connection and time tracker settings of the user in one query"""
+    from users.models import CompanyConnection
+    from time_tracker.models import TTCompanyInfo
+
+    entry = {'loaded': time.monotonic(), 'company_id': user.company_id, 'company': None, 'company_connection': None,
+             'tt_company_info': None}
+    if user.company_id is None:
+        entry['company_connection'] = CompanyConnection.objects.filter(user=user).order_by('pk').first()
+        return entry
+    connections = CompanyConnection.objects.filter(user_id=user.id).order_by('pk')
+    tt_company_info = TTCompanyInfo.objects.select_related('company').filter(company_id=user.company_id).annotate(
+        connection_id=Subquery(connections.values('id')[:1]),
+        connection_company_id=Subquery(connections.values('company_id')[:1]),
+        connection_role=Subquery(connections.values('role')[:1]),
+    ).order_by('pk').first()
+    if tt_company_info is None:
+        return entry
+    entry['company'] = tt_company_info.company
+    entry['tt_company_info'] = tt_company_info
+    if tt_company_info.connection_id is not None:
+        entry['company_connection'] = CompanyConnection(
+            id=tt_company_info.connection_id, company_id=tt_company_info.connection_company_id, user_id=user.id,
+            role=tt_company_info.connection_role)
+    return entry
+
+
+def clear_tenant_cache(company_id=None, user_id=None):
+    """Drops the tenants of the company or the user, everything without either"""
+    with _lock:
+        if company_id is None and user_id is None:
+            _tenants.clear()
+            return
+        for cached_user_id in [cached_user_id for cached_user_id, entry in _tenants.items()
+                               if cached_user_id == user_id or (company_id is not None and
+                                                                entry['company_id'] == company_id)]:
+            del _tenants[cached_user_id]
+
+
+def get_tenant_stamp_names(company_id, user_id):
+    return ['tenant_company_' + str(company_id), 'tenant_user_' + str(user_id)]
+
+
+def read_tenant_stamps(company_id, user_id):
+    """The bus stamps of the user's company and the user, a cached tenant is dropped when either changed"""
+    from time_tracker.status_cache import read_bus_stamp
+    return [read_bus_stamp(name) for name in get_tenant_stamp_names(company_id, user_id)]
+
+
+def tenant_changed(company_id=None, user_id=None):
+    """Drops the tenants now and again once the change is committed, a request in between would have loaded the old
+        values. The other processes are told once it is committed."""
+    clear_tenant_cache(company_id, user_id)
+    transaction.on_commit(lambda: publish_tenant_change(company_id, user_id))
+
+
+def publish_tenant_change(company_id=None, user_id=None):
+    from time_tracker.status_cache import write_bus_stamp
+    clear_tenant_cache(company_id, user_id)
+    company_stamp, user_stamp = get_tenant_stamp_names(company_id, user_id)
+    if company_id is not None:
+        write_bus_stamp(company_stamp)
+    if user_id is not None:
+        write_bus_stamp(user_stamp)
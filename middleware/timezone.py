@@ -1,21 +1,11 @@
-
 from django.utils import timezone
 
 
-class TimezoneMiddleware:
-    def __init__(self, get_response):
-        self.get_response = get_response
-
-    def __call__(self, request):
-        if request.user.is_authenticated:
-            used_timezone = get_timezone(request.user)
-            if used_timezone:
-                timezone.activate(used_timezone)
-            else:
-                timezone.deactivate()
-        else:
-            timezone.deactivate()
-        return self.get_response(request)
+def activate_timezone(used_timezone):
+    if used_timezone:
+        timezone.activate(used_timezone)
+    else:
+        timezone.deactivate()
 
 
 def get_timezone(user):
@@ -28,4 +18,4 @@ def get_timezone(user):
             used_timezone = company.timezone
     if not used_timezone:
         used_timezone = timezone.timezone.utc
-    return used_timezone
\ No newline at end of file
+    return used_timezone
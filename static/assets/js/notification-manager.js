@@ -56,7 +56,7 @@ class NotificationManager {
     const { title, message, time } = notification;
     const item = `
       <div class="list-group-item">
-        <a class="notification notification-flush ${notification.read ? '' : 'notification-unread'}" href="#!">
+        <a class="notification notification-flush ${notification.read ? '' : 'notification-unread'}" href="${notification.link || '#!'}">
           <div class="notification-body">
             <p class="mb-1"><strong>${title}</strong> ${message}</p>
             <span class="notification-time">${time}</span>
@@ -70,6 +70,8 @@ class NotificationManager {
   handleSocketMessage(data) {
     if (data.type === 'notification') {
       this.addNotification(data);
+    } else if (data.type === 'report_progress') {
+      document.dispatchEvent(new CustomEvent('report_progress', { detail: data }));
     }
   }
 
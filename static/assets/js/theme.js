@@ -4818,7 +4818,7 @@ var appCalendarInit = function appCalendarInit() {
         omitZeroMinute: true,
         meridiem: true
       },
-      events: {
+      eventSources: [{
             url: '/get_time_actions',
             method: 'POST',
             extraParams: {
@@ -4828,8 +4828,21 @@ var appCalendarInit = function appCalendarInit() {
             failure: function() {
               alert('There was an error while fetching actions, please refresh in a minute and try again.');
             }
-          },
+          }, {
+            // the hours worked each day, calculated on the server
+            id: 'daily_totals',
+            url: '/get_daily_totals',
+            method: 'POST',
+            extraParams: {
+              csrfmiddlewaretoken: document.querySelector(Selectors.CSRF_INPUT).getAttribute('value'),
+              employee_id: selected_emp,
+            }
+          }],
       eventClick: function eventClick(info) {
+        if (info.event.source && info.event.source.id === 'daily_totals') {
+          // the daily totals can't be edited
+          return;
+        }
         if (info.event.url) {
           window.open(info.event.url, '_blank');
           info.jsEvent.preventDefault();
@@ -4879,6 +4892,7 @@ var appCalendarInit = function appCalendarInit() {
             if(response.errors){
                 console.log(response.errors)
             }
+            calendar.getEventSourceById('daily_totals').refetch();
         }
       })
       },
@@ -4899,6 +4913,7 @@ var appCalendarInit = function appCalendarInit() {
             if(response.errors){
                 console.log(response.errors)
             }
+            calendar.getEventSourceById('daily_totals').refetch();
         }
       })
       },
@@ -4986,6 +5001,7 @@ var appCalendarInit = function appCalendarInit() {
                   }
                 temp_data.start = flatpickr.parseDate(temp_data.start, "G:iK  M d, Y").toISOString()
                 calendar.addEvent(temp_data, calendar.getEventSources()[0]);
+                calendar.getEventSourceById('daily_totals').refetch();
             } else {
                 console.log(response.errors)
             }
@@ -5013,6 +5029,7 @@ var appCalendarInit = function appCalendarInit() {
                 success:function(response){
                     var temp_event = calendar.getEventById(selected_event_id)
                     temp_event.remove()
+                    calendar.getEventSourceById('daily_totals').refetch();
                 }
             });
             window.bootstrap.Modal.getInstance(addEventModal).hide();
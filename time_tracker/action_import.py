@@ -0,0 +1,114 @@
+from datetime import datetime
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from middleware.timezone import get_timezone
+from users.models import CustomUser
+from .daily_totals import get_span_dates, update_daily_totals
+from .models import InOutAction, bump_report_versions, refresh_current_time_actions
+
+ACTION_TYPES = dict(InOutAction._meta.get_field('type').choices)
+
+
+def import_actions(rows, batch_size=None, dry_run=False):
+    """Validates the rows and bulk creates their time actions, batch by batch.
+
+        Each row is a dict with a user_id or email, type, start, end and comment. Times without an offset are in the
+        user's timezone. InOutAction.save is skipped so the report versions, daily totals and current time actions of
+        the users are updated once after every row is written. Returns the number of created actions, the errors as
+        (row number, message) and the number of users that got actions."""
+    batch_size = batch_size or settings.ACTION_IMPORT_BATCH_SIZE
+    users = {}
+    dates_by_user = {}
+    result = {'created': 0, 'errors': [], 'users': 0}
+    batch = []
+    for row_number, row in enumerate(rows, 1):
+        try:
+            action = build_import_action(row, users)
+        except ValidationError as e:
+            result['errors'].append((row_number, ' '.join(e.messages)))
+            continue
+        user_timezone, dates = dates_by_user.setdefault(action.user_id, (get_timezone(action.user), set()))
+        dates.update(get_span_dates(action.start, action.end, user_timezone))
+        batch.append(action)
+        if len(batch) >= batch_size:
+            result['created'] += write_import_batch(batch, dry_run)
+            batch = []
+    result['created'] += write_import_batch(batch, dry_run)
+    result['users'] = len(dates_by_user)
+
+    if not dry_run and dates_by_user:
+        finish_import(dates_by_user)
+    return result
+
+
+def write_import_batch(batch, dry_run):
+    if not batch or dry_run:
+        return len(batch)
+    with transaction.atomic():
+        InOutAction.objects.bulk_create(batch)
+    return len(batch)
+
+
+def finish_import(dates_by_user):
+    """Does the work InOutAction.save would have done for every imported action, once per user"""
+    with transaction.atomic():
+        bump_report_versions(dates_by_user.keys())
+        for user_id, (user_timezone, dates) in dates_by_user.items():
+            update_daily_totals(user_id, dates, user_timezone)
+        refresh_current_time_actions(dates_by_user.keys())
+
+
+def build_import_action(row, users):
+    """An unsaved InOutAction for the row with its lookup datetime and total time filled in"""
+    user = get_import_user(row, users)
+    user_timezone = get_timezone(user)
+    type = (row.get('type') or 't').strip().lower()
+    if type not in ACTION_TYPES:
+        raise ValidationError('Unknown action type ' + type)
+    start = parse_import_datetime(row.get('start'), user_timezone)
+    if start is None:
+        raise ValidationError('The start is required')
+    end = parse_import_datetime(row.get('end'), user_timezone)
+    if end and end < start:
+        raise ValidationError('The end is before the start')
+    if start > timezone.now() or (end and end > timezone.now()):
+        raise ValidationError('Actions can\'t be in the future')
+
+    action = InOutAction(user=user, type=type, start=start, end=end, comment=row.get('comment') or '')
+    action.set_calculated_fields()
+    return action
+
+
+def get_import_user(row, users):
+    """Finds the user of the row by user_id or email, users caches the lookups including the misses"""
+    key = str(row.get('user_id') or '').strip() or (row.get('email') or '').strip().lower()
+    if not key:
+        raise ValidationError('A user_id or email is required')
+    if key not in users:
+        lookup = Q(id=int(key)) if key.isdigit() else Q(email__iexact=key)
+        users[key] = CustomUser.objects.select_related('company').filter(lookup).first()
+    if users[key] is None:
+        raise ValidationError('Unknown user ' + key)
+    return users[key]
+
+
+def parse_import_datetime(value, user_timezone):
+    if not value:
+        return None
+    if not isinstance(value, datetime):
+        try:
+            parsed = parse_datetime(str(value).strip())
+        except ValueError:
+            parsed = None
+        if parsed is None:
+            raise ValidationError('Invalid date time ' + str(value))
+        value = parsed
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value, user_timezone)
+    return value
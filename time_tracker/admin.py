@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import InOutAction
+from .models import InOutAction, TTGeofence, TTRejectedPunch
 from admin_auto_filters.filters import AutocompleteFilter
 
 
@@ -10,9 +10,28 @@ class UserFilter(AutocompleteFilter):
 
 class InOutActionsAdmin(admin.ModelAdmin):
     list_display = ('id', 'user', 'type', 'start', 'end', 'comment')
-    list_filter = ('id', UserFilter, 'type', 'start', 'end', 'comment')
+    list_filter = ('id', UserFilter, 'type', 'start', 'end', 'comment', 'start_outside_fence', 'end_outside_fence')
     search_fields = ('id',)
     ordering = ('id',)
 
 
-admin.site.register(InOutAction, InOutActionsAdmin)
\ No newline at end of file
+admin.site.register(InOutAction, InOutActionsAdmin)
+
+class TTGeofenceAdmin(admin.ModelAdmin):
+    list_display = ('id', 'company', 'name', 'shape', 'radius', 'active')
+    list_filter = ('shape', 'active')
+    search_fields = ('name',)
+    ordering = ('company', 'name')
+
+
+admin.site.register(TTGeofence, TTGeofenceAdmin)
+
+
+class TTRejectedPunchAdmin(admin.ModelAdmin):
+    list_display = ('id', 'user', 'key', 'errors', 'created_date')
+    list_filter = (UserFilter, 'created_date')
+    search_fields = ('key',)
+    ordering = ('-created_date',)
+
+
+admin.site.register(TTRejectedPunch, TTRejectedPunchAdmin)
@@ -0,0 +1,227 @@
+import threading
+from datetime import timedelta, timezone as dt_timezone
+
+from asgiref.sync import sync_to_async
+from django.apps import apps
+from django.conf import settings
+from django.db import connection, models, transaction
+from django.db.models import Value
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+
+from users.models import CustomUser
+from .models import InOutAction, TTActionArchive, TTUserInfo
+
+# Finished time actions older than ACTION_ARCHIVE_DAYS are moved out of InOutAction into a table per year, keyed on the
+# utc year of their lookup datetime. The tables keep the ids and the ARCHIVE_FIELDS of InOutAction but aren't known to
+# the migrations, they are created the first time a year is archived and listed in TTActionArchive. A table made before
+# a field was added to ARCHIVE_FIELDS is read without it until archive_actions adds the column. Nothing newer than the
+# latest cutoff an archive run used is archived, so a range that starts after it never has to look at the archive.
+
+ARCHIVE_TABLE_PREFIX = 'time_tracker_inoutaction_'
+# the InOutAction fields the archive tables have, a field added to InOutAction is only archived once it is listed here
+ARCHIVE_FIELDS = ['id', 'user', 'start', 'end', 'total_time', 'type', 'start_lon', 'start_lat', 'end_lon', 'end_lat',
+                  'comment', 'action_lookup_datetime', 'start_outside_fence', 'end_outside_fence', 'created_date',
+                  'updated_date']
+
+_archive_models = {}
+_archived_before = {'loaded': False, 'value': None}     # the latest cutoff of the archive runs, read once per process
+_lock = threading.Lock()
+
+
+def get_archive_model(year):
+    """The model of the archive table of the year with the ARCHIVE_FIELDS the table has, the table might not exist
+        yet. The fields it is missing read as None."""
+    with _lock:
+        if year not in _archive_models:
+            columns = get_archive_columns(year)
+            attrs = {
+                '__module__': __name__,
+                'archived': True,   # read only, the calendar and the reports only show them
+                'Meta': type('Meta', (), {
+                    'app_label': 'time_tracker',
+                    'db_table': ARCHIVE_TABLE_PREFIX + str(year),
+                    'managed': False,
+                    'indexes': [models.Index(fields=['user', 'action_lookup_datetime'],
+                                             name='tt_arch_' + str(year) + '_user_lookup_idx')],
+                }),
+            }
+            for field in get_archive_fields():
+                if columns is None or field.column in columns:
+                    attrs[field.name] = copy_archive_field(field)
+                else:
+                    attrs[field.name] = None
+            _archive_models[year] = type('InOutActionArchive' + str(year), (models.Model,), attrs)
+        return _archive_models[year]
+
+
+def forget_archive_model(year):
+    """Drops the model of the year so the next get_archive_model reads the table's columns again"""
+    with _lock:
+        model = _archive_models.pop(year, None)
+        if model is not None:
+            apps.all_models[model._meta.app_label].pop(model._meta.model_name, None)
+            apps.clear_cache()
+
+
+def get_archive_fields():
+    return [InOutAction._meta.get_field(name) for name in ARCHIVE_FIELDS]
+
+
+def get_archive_columns(year):
+    """The columns of the archive table of the year, None when it doesn't exist yet"""
+    table = ARCHIVE_TABLE_PREFIX + str(year)
+    with connection.cursor() as cursor:
+        if table not in connection.introspection.table_names(cursor):
+            return None
+        return {column.name for column in connection.introspection.get_table_description(cursor, table)}
+
+
+def copy_archive_field(field):
+    name, path, args, kwargs = field.deconstruct()
+    # the dates are copied as they are
+    kwargs.pop('auto_now', None)
+    kwargs.pop('auto_now_add', None)
+    if field.is_relation:
+        # deleting a user doesn't look in the archive, archive_actions cleans up after them
+        kwargs.update(on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+    return field.__class__(*args, **kwargs)
+
+
+def create_archive_table(year, table_names):
+    """Creates the archive table of the year if it is missing, or adds the ARCHIVE_FIELDS it is missing. The sqlite
+        schema editor can't run inside a transaction."""
+    table = ARCHIVE_TABLE_PREFIX + str(year)
+    if table not in table_names:
+        with connection.schema_editor() as editor:
+            editor.create_model(get_archive_model(year))
+        table_names.append(table)
+    else:
+        columns = get_archive_columns(year)
+        missing = [field for field in get_archive_fields() if field.column not in columns]
+        if missing:
+            with connection.schema_editor() as editor:
+                model = get_archive_model(year)
+                for field in missing:
+                    column_field = copy_archive_field(field)
+                    column_field.set_attributes_from_name(field.name)
+                    column_field.model = model
+                    editor.add_field(model, column_field)
+            forget_archive_model(year)
+    TTActionArchive.objects.get_or_create(year=year)
+    return get_archive_model(year)
+
+
+def get_archived_before():
+    """The latest cutoff any archive run used, nothing newer than it is in the archive"""
+    if not _archived_before['loaded']:
+        set_archived_before(TTActionArchive.objects.aggregate(value=models.Max('archived_before'))['value'])
+    return _archived_before['value']
+
+
+def set_archived_before(value):
+    with _lock:
+        _archived_before['loaded'] = True
+        if value is not None and (_archived_before['value'] is None or value > _archived_before['value']):
+            _archived_before['value'] = value
+
+
+def get_archive_horizon():
+    """Where the archive ends. The latest stored cutoff, or ACTION_ARCHIVE_DAYS ago when that is later since an archive
+        run in another process can't go past it."""
+    horizon = timezone.now() - timedelta(days=settings.ACTION_ARCHIVE_DAYS)
+    archived_before = get_archived_before()
+    return max(horizon, archived_before) if archived_before is not None else horizon
+
+
+def reaches_archive(range_start):
+    """If a range starting at range_start could need archived actions, None starts at the beginning. Only the first
+        call in a process reads the database, see areaches_archive."""
+    if range_start is None:
+        return True
+    if timezone.is_naive(range_start):
+        range_start = timezone.make_aware(range_start)
+    return range_start < get_archive_horizon()
+
+
+async def areaches_archive(range_start):
+    if not _archived_before['loaded']:
+        await sync_to_async(get_archived_before)()
+    return reaches_archive(range_start)
+
+
+def get_archive_years(range_start=None, range_end=None):
+    """The archived years a range of lookup datetimes overlaps, no query when the range is newer than the horizon"""
+    if not reaches_archive(range_start):
+        return []
+    archives = TTActionArchive.objects.order_by('year')
+    if range_start is not None:
+        archives = archives.filter(year__gte=get_utc_year(range_start))
+    if range_end is not None:
+        archives = archives.filter(year__lte=get_utc_year(range_end))
+    return list(archives.values_list('year', flat=True))
+
+
+def get_utc_year(value):
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value)
+    return value.astimezone(dt_timezone.utc).year
+
+
+def get_archived_actions(range_start=None, range_end=None, **filters):
+    """The archived actions with a lookup datetime between range_start and range_end that match the filters, in the
+        order of their years. They have the ARCHIVE_FIELDS and archived set."""
+    lookup = {}
+    if range_start is not None:
+        lookup['action_lookup_datetime__gte'] = range_start
+    if range_end is not None:
+        lookup['action_lookup_datetime__lte'] = range_end
+    actions = []
+    for year in get_archive_years(range_start, range_end):
+        actions += get_archive_model(year).objects.filter(**filters, **lookup)
+    return actions
+
+
+def archive_actions(days=None, batch_size=None):
+    """Moves the finished actions older than the horizon into the archive tables, batch by batch. The current time and
+        break actions of the users stay so their status keeps working, and the daily totals aren't touched. The
+        archived actions of deleted users are removed. Returns the number of archived actions per year.
+        days can't be less than ACTION_ARCHIVE_DAYS, another process only knows the ranges newer than that don't look
+        in the archive."""
+    days = days if days is not None else settings.ACTION_ARCHIVE_DAYS
+    batch_size = batch_size or settings.ACTION_ARCHIVE_BATCH_SIZE
+    cutoff = timezone.now() - timedelta(days=days)
+    candidates = InOutAction.objects.filter(end__isnull=False, action_lookup_datetime__lt=cutoff).exclude(
+        id__in=TTUserInfo.objects.filter(time_action__isnull=False).values('time_action')).exclude(
+        id__in=TTUserInfo.objects.filter(break_action__isnull=False).values('break_action')).order_by('id')
+    table_names = connection.introspection.table_names()
+    archived = {}
+    while True:
+        batch = list(candidates[:batch_size])
+        if not batch:
+            break
+        by_year = {}
+        for action in batch:
+            by_year.setdefault(get_utc_year(action.action_lookup_datetime), []).append(action)
+        archive_models = {year: create_archive_table(year, table_names) for year in by_year}
+        with transaction.atomic():
+            for year, actions in by_year.items():
+                model = archive_models[year]
+                model.objects.bulk_create([model(**{field.attname: getattr(action, field.attname)
+                                                    for field in get_archive_fields()})
+                                           for action in actions])
+                # a run with more days doesn't move the cutoff back, the newer actions are still there
+                TTActionArchive.objects.filter(year=year).update(
+                    actions=models.F('actions') + len(actions), updated_date=timezone.now(),
+                    archived_before=Greatest(Coalesce('archived_before', Value(cutoff)), Value(cutoff)))
+                archived[year] = archived.get(year, 0) + len(actions)
+            transaction.on_commit(lambda: set_archived_before(cutoff))
+            # a queryset delete skips InOutAction.delete, the daily totals and statuses stay as they are
+            InOutAction.objects.filter(id__in=[action.id for action in batch]).delete()
+
+    for year in TTActionArchive.objects.values_list('year', flat=True):
+        if ARCHIVE_TABLE_PREFIX + str(year) in table_names:
+            deleted, _ = get_archive_model(year).objects.exclude(user_id__in=CustomUser.objects.values('id')).delete()
+            if deleted:
+                TTActionArchive.objects.filter(year=year).update(actions=models.F('actions') - deleted)
+    return archived
@@ -0,0 +1,56 @@
+import json
+
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
+
+from daxApp.encryption import encrypt_ids
+from middleware.tenant import get_tenant
+from users.utils import remember_server_loop
+from .models import TTUserInfo
+from .status_board import get_group_name, get_status_snapshot
+
+
+class StatusBoardConsumer(AsyncWebsocketConsumer):
+    """The live status board of a company owner. Sends the status of every employee once, then only the ones that
+        changed as [id, status text, status time]. The employee ids are encrypted the same way for the whole
+        connection."""
+
+    async def connect(self):
+        self.group_name = None
+        remember_server_loop()
+        company_id = await database_sync_to_async(get_board_company)(self.scope['user'])
+        if company_id is None:
+            await self.close()
+            return
+        self.user_id = self.scope['user'].id
+        self.group_name = get_group_name(company_id)
+        # joined before the snapshot is read so no change is missed, a change can come after it twice
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept()
+        snapshot = await database_sync_to_async(get_status_snapshot)(company_id)
+        snapshot = [status for status in snapshot if status[0] != self.user_id]
+        self.ids = dict(zip([status[0] for status in snapshot], encrypt_ids([status[0] for status in snapshot])))
+        await self.send(text_data=json.dumps({
+            'type': 'snapshot',
+            'status_names': dict(TTUserInfo._meta.get_field('status_text').choices),
+            'employees': [[self.ids[status[0]]] + status[1:] for status in snapshot],
+        }))
+
+    async def disconnect(self, close_code):
+        if self.group_name:
+            await self.channel_layer.group_discard(self.group_name, self.channel_name)
+
+    async def status_delta(self, event):
+        # employees added after the snapshot aren't on the board
+        statuses = [status for status in event['statuses'] if status[0] in self.ids]
+        if statuses:
+            await self.send(text_data=json.dumps({
+                'type': 'delta', 'employees': [[self.ids[status[0]]] + status[1:] for status in statuses]}))
+
+
+def get_board_company(user):
+    """The company whose board the user can watch, only company owners have one"""
+    if not user.is_authenticated:
+        return None
+    tenant = get_tenant(user)
+    return tenant.company.id if tenant.company and tenant.role == 'c' else None
@@ -0,0 +1,176 @@
+import logging
+from datetime import datetime, time, timedelta
+
+from django.db import transaction
+from django.db.models import Q
+
+from middleware.timezone import get_timezone
+from users.models import CustomUser
+from .archive import get_archived_actions, reaches_archive
+from .models import InOutAction, TTDailyTotal
+
+logger = logging.getLogger("django.request")
+
+SECONDS_IN_HOUR = 3600
+
+
+def get_local_midnight(day, user_timezone):
+    """Midnight at the beginning of the day, pytz timezones have to localize instead of replacing the tzinfo"""
+    midnight = datetime.combine(day, time.min)
+    if hasattr(user_timezone, 'localize'):
+        return user_timezone.localize(midnight)
+    return midnight.replace(tzinfo=user_timezone)
+
+
+def split_action_by_day(start, end, user_timezone):
+    """Yields the date and the seconds of every day the action covers, split at midnight in the user's timezone"""
+    start = start.astimezone(user_timezone)
+    end = end.astimezone(user_timezone)
+    day = start.date()
+    while True:
+        next_midnight = get_local_midnight(day + timedelta(days=1), user_timezone)
+        if end <= next_midnight:
+            yield day, end.timestamp() - start.timestamp()
+            return
+        yield day, next_midnight.timestamp() - start.timestamp()
+        start = next_midnight
+        day = day + timedelta(days=1)
+
+
+def get_span_dates(start, end, user_timezone):
+    """The dates a finished action is counted on, nothing for actions without an end"""
+    if not (start and end) or end < start:
+        return []
+    return [day for day, seconds in split_action_by_day(start, end, user_timezone)]
+
+
+def calc_daily_totals(actions, user_timezone, dates=None):
+    """Sums the finished actions into {(date, type): seconds}, only the given dates are kept when dates is set"""
+    totals = {}
+    for action in actions:
+        if not (action.start and action.end) or action.end < action.start:
+            continue
+        for day, seconds in split_action_by_day(action.start, action.end, user_timezone):
+            if dates is None or day in dates:
+                totals[(day, action.type)] = totals.get((day, action.type), 0) + seconds
+    return totals
+
+
+def get_day_range(dates, user_timezone):
+    """The midnight before the first date and the midnight after the last date"""
+    begin = get_local_midnight(min(dates), user_timezone)
+    end = get_local_midnight(max(dates) + timedelta(days=1), user_timezone)
+    return begin, end
+
+
+def create_daily_total_rows(user_id, totals, user_timezone):
+    return [TTDailyTotal(user_id=user_id, date=day, type=type, total_time=seconds, timezone=str(user_timezone))
+            for (day, type), seconds in totals.items()]
+
+
+def get_day_actions(user_id, dates, user_timezone):
+    """The user's actions that overlap the dates, the archived ones included"""
+    begin, end = get_day_range(dates, user_timezone)
+    actions = list(InOutAction.objects.filter(user_id=user_id, start__lt=end, end__gt=begin).only('start', 'end', 'type'))
+    if reaches_archive(begin):
+        # an archived action that ends on one of the days, the finished actions are looked up by their end
+        actions += get_archived_actions(begin, None, user_id=user_id, start__lt=end)
+    return actions
+
+
+def update_daily_totals(user_id, dates, user_timezone):
+    """Recalculates the TTDailyTotal rows of the dates from the actions that overlap them"""
+    if not dates:
+        return
+    totals = calc_daily_totals(get_day_actions(user_id, dates, user_timezone), user_timezone, dates)
+    kept = Q()
+    for day, type in totals:
+        kept |= Q(date=day, type=type)
+    TTDailyTotal.objects.filter(user_id=user_id, date__in=dates).exclude(kept).delete()
+    # a punch of the user on the same day can write its rows at the same time, whoever writes last wins instead of
+    # failing on the unique constraint
+    TTDailyTotal.objects.bulk_create(create_daily_total_rows(user_id, totals, user_timezone), update_conflicts=True,
+                                     unique_fields=['user_id', 'date', 'type'],
+                                     update_fields=['total_time', 'timezone', 'updated_date'])
+
+
+def get_all_finished_actions(user):
+    """Every finished action of the user, the archived ones included"""
+    yield from get_archived_actions(user=user, end__isnull=False)
+    yield from InOutAction.objects.filter(user=user, end__isnull=False).only('start', 'end', 'type').iterator(chunk_size=2000)
+
+
+def rebuild_daily_totals(user, user_timezone):
+    """Throws away the user's TTDailyTotal rows and calculates them again from every action"""
+    totals = calc_daily_totals(get_all_finished_actions(user), user_timezone)
+    TTDailyTotal.objects.filter(user=user).delete()
+    TTDailyTotal.objects.bulk_create(create_daily_total_rows(user.id, totals, user_timezone), batch_size=1000)
+    return len(totals)
+
+
+def verify_daily_totals(user, user_timezone):
+    """Compares the user's TTDailyTotal rows to the actions, returns a list of (date, type, stored, expected)"""
+    expected = calc_daily_totals(get_all_finished_actions(user), user_timezone)
+    stored = {(row.date, row.type): row.total_time for row in TTDailyTotal.objects.filter(user=user)}
+    mismatches = []
+    for key in sorted(set(expected) | set(stored)):
+        if round(expected.get(key, 0), 3) != round(stored.get(key, 0), 3):
+            mismatches.append((key[0], key[1], stored.get(key), expected.get(key)))
+    return mismatches
+
+
+def get_daily_totals(user, begin_date, end_date):
+    """The stored totals of the finished actions between the dates as {date: {type: seconds}}. While rows calculated
+        in another timezone than the user's wait for timezone_changed or the rebuild_daily_totals command, the days are
+        summed from the actions instead."""
+    rows = list(TTDailyTotal.objects.filter(user=user, date__gte=begin_date, date__lte=end_date))
+    user_timezone = get_timezone(user)
+    daily_totals = {}
+    if any(row.timezone != str(user_timezone) for row in rows):
+        dates = {begin_date + timedelta(days=offset) for offset in range((end_date - begin_date).days + 1)}
+        totals = calc_daily_totals(get_day_actions(user.id, dates, user_timezone), user_timezone, dates)
+        for (day, type), seconds in totals.items():
+            daily_totals.setdefault(day, {})[type] = seconds
+        return daily_totals
+    for row in rows:
+        daily_totals.setdefault(row.date, {})[row.type] = row.total_time
+    return daily_totals
+
+
+def timezone_changed(user_id=None, company_id=None):
+    """Rebuilds the daily totals of the user or the company's employees once the change is committed, the days are
+        split at midnight in their timezone"""
+    transaction.on_commit(lambda: rebuild_stale_daily_totals(user_id, company_id))
+
+
+def rebuild_stale_daily_totals(user_id=None, company_id=None):
+    """Rebuilds the totals of the users whose rows were calculated in another timezone than theirs now, returns the
+        number of users rebuilt"""
+    users = CustomUser.objects.select_related('company')
+    users = users.filter(id=user_id) if user_id is not None else users.filter(company_id=company_id)
+    users = {user.id: user for user in users}
+    stored = TTDailyTotal.objects.filter(user_id__in=users).values_list('user_id', 'timezone').distinct()
+    stale = {stored_user_id for stored_user_id, stored_timezone in stored
+             if stored_timezone != str(get_timezone(users[stored_user_id]))}
+    for stale_user_id in stale:
+        user = users[stale_user_id]
+        rebuild_daily_totals(user, get_timezone(user))
+    return len(stale)
+
+
+def get_daily_total_events(user, in_start, in_end):
+    """Calendar events with the hours worked on each day between the iso dates"""
+    in_start = datetime.fromisoformat(in_start).date()
+    in_end = datetime.fromisoformat(in_end).date()
+    event_list = []
+    for day, totals in sorted(get_daily_totals(user, in_start, in_end).items()):
+        worked = (totals.get('t', 0) - totals.get('b', 0)) / SECONDS_IN_HOUR
+        event_list.append({
+            'id': 'total_' + day.isoformat(),
+            'title': 'Total ' + str(round(worked, 2)) + ' hrs',
+            'start': day.isoformat(),
+            'allDay': True,
+            'editable': False,
+            'className': 'bg-soft-info',
+        })
+    return event_list
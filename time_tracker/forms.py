@@ -28,7 +28,7 @@ class ReportsForm(Form):
     end_date = forms.DateField(widget=NewDateInput())
     report_type = forms.ChoiceField(choices=(
         ('time_tracker/reports/detailed_hours.html', 'Detailed Hours Report'),
-        ('reports/summary.html', 'Summary Report')), initial='reports/detailed_hours.html')
+        ('time_tracker/reports/summary.html', 'Summary Report')), initial='time_tracker/reports/detailed_hours.html')
     selected_employees_list = forms.MultipleChoiceField(choices=((-1, 'All Employees'),),
                                                         required=False, widget=forms.CheckboxSelectMultiple(),
                                                         initial=[-1])
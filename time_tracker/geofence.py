@@ -0,0 +1,202 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from itertools import chain
+
+import numpy as np
+from django.conf import settings
+from django.db.models import Q
+
+from .models import InOutAction, TTGeofence
+from .status_cache import read_bus_stamp, write_bus_stamp
+
+# The geofences of a company are put into a grid of GEOFENCE_GRID_SIZE degree cells when they are loaded, a punch only
+# checks the few geofences whose bounding box touches its cell. The grids of GEOFENCE_CACHE_MAX_COMPANIES companies are
+# kept for GEOFENCE_CACHE_TTL seconds. A change to a geofence drops the grid of its company in this process and, once
+# committed, writes a stamp for the company to the status cache's bus so the other processes drop theirs.
+
+EARTH_RADIUS = 6371008.8  # meters
+METERS_PER_DEGREE = 111320.0  # of latitude, and of longitude at the equator
+GRID_MAX_CELLS = 4096  # bigger geofences aren't put in the grid, every punch checks them
+
+_indexes = OrderedDict()  # company id: {'loaded': time, 'stamp': ..., 'fences': [...], 'cells': {...}, 'large': [...]}
+_lock = threading.Lock()
+
+
+def load_geofences(company_id):
+    """The active geofences of the company as (shape, latitude, longitude, radius, points, bounding box) tuples"""
+    fences = []
+    for fence in TTGeofence.objects.filter(company_id=company_id, active=True):
+        if fence.shape == 'c' and fence.latitude is not None and fence.longitude is not None and fence.radius:
+            latitude, longitude = float(fence.latitude), float(fence.longitude)
+            lat_offset = fence.radius / METERS_PER_DEGREE
+            lon_offset = fence.radius / (METERS_PER_DEGREE * max(math.cos(math.radians(latitude)), 0.01))
+            fences.append(('c', latitude, longitude, fence.radius, None, (
+                latitude - lat_offset, longitude - lon_offset, latitude + lat_offset, longitude + lon_offset)))
+        elif fence.shape == 'p' and len(fence.points) >= 3:
+            points = [(float(lat), float(lon)) for lat, lon in fence.points]
+            lats, lons = [point[0] for point in points], [point[1] for point in points]
+            fences.append(('p', None, None, None, points, (min(lats), min(lons), max(lats), max(lons))))
+    return fences
+
+
+def build_geofence_index(fences, cell_size):
+    cells = {}
+    large = []
+    for fence in fences:
+        min_lat, min_lon, max_lat, max_lon = fence[5]
+        rows = range(math.floor(min_lat / cell_size), math.floor(max_lat / cell_size) + 1)
+        columns = range(math.floor(min_lon / cell_size), math.floor(max_lon / cell_size) + 1)
+        if len(rows) * len(columns) > GRID_MAX_CELLS:
+            large.append(fence)
+            continue
+        for row in rows:
+            for column in columns:
+                cells.setdefault((row, column), []).append(fence)
+    return {'loaded': time.monotonic(), 'fences': fences, 'cells': cells, 'large': large, 'size': cell_size}
+
+
+def get_geofence_index(company_id):
+    # read before the geofences are loaded, a change in between is picked up by the next punch
+    stamp = read_bus_stamp(get_geofence_stamp_name(company_id)) if settings.GEOFENCE_CACHE_MAX_COMPANIES else None
+    with _lock:
+        index = _indexes.get(company_id)
+        if index and index['stamp'] == stamp and time.monotonic() - index['loaded'] < settings.GEOFENCE_CACHE_TTL:
+            _indexes.move_to_end(company_id)
+            return index
+    index = build_geofence_index(load_geofences(company_id), settings.GEOFENCE_GRID_SIZE)
+    index['stamp'] = stamp
+    if settings.GEOFENCE_CACHE_MAX_COMPANIES:
+        with _lock:
+            _indexes[company_id] = index
+            _indexes.move_to_end(company_id)
+            while len(_indexes) > settings.GEOFENCE_CACHE_MAX_COMPANIES:
+                _indexes.popitem(last=False)
+    return index
+
+
+def clear_geofence_index(company_id=None):
+    with _lock:
+        if company_id is None:
+            _indexes.clear()
+        else:
+            _indexes.pop(company_id, None)
+
+
+def get_geofence_stamp_name(company_id):
+    return 'geofence_company_' + str(company_id)
+
+
+def publish_geofence_change(company_id):
+    """Drops the company's index in this process and tells the other processes through the bus"""
+    clear_geofence_index(company_id)
+    write_bus_stamp(get_geofence_stamp_name(company_id))
+
+
+def is_outside_fences(company_id, lat, lon):
+    """True when the location is outside every geofence of the company, None without a location or geofences"""
+    if lat is None or lon is None or company_id is None:
+        return None
+    index = get_geofence_index(company_id)
+    if not index['fences']:
+        return None
+    lat, lon = float(lat), float(lon)
+    cell = (math.floor(lat / index['size']), math.floor(lon / index['size']))
+    for fence in chain(index['cells'].get(cell, ()), index['large']):
+        if fence_contains(fence, lat, lon):
+            return False
+    return True
+
+
+def fence_contains(fence, lat, lon):
+    shape, center_lat, center_lon, radius, points, (min_lat, min_lon, max_lat, max_lon) = fence
+    if not (min_lat <= lat <= max_lat and min_lon <= lon <= max_lon):
+        return False
+    if shape == 'c':
+        return get_distance(lat, lon, center_lat, center_lon) <= radius
+    inside = False
+    for index in range(len(points)):
+        lat1, lon1 = points[index - 1]
+        lat2, lon2 = points[index]
+        if (lat1 > lat) != (lat2 > lat) and lon < (lon2 - lon1) * (lat - lat1) / (lat2 - lat1) + lon1:
+            inside = not inside
+    return inside
+
+
+def get_distance(lat1, lon1, lat2, lon2):
+    """Meters between two points along the earth's surface"""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+def get_outside_mask(fences, lats, lons):
+    """is_outside_fences for arrays of coordinates, every point is measured against every circle at once and the
+        polygons are crossed edge by edge. NaN coordinates are outside."""
+    inside = np.zeros(len(lats), dtype=bool)
+    circles = [fence for fence in fences if fence[0] == 'c']
+    if circles:
+        lat1, lon1 = np.radians(lats)[:, None], np.radians(lons)[:, None]
+        lat2 = np.radians([fence[1] for fence in circles])[None, :]
+        lon2 = np.radians([fence[2] for fence in circles])[None, :]
+        a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+        distances = 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+        inside |= (distances <= np.array([fence[3] for fence in circles])[None, :]).any(axis=1)
+    for fence in fences:
+        if fence[0] != 'p':
+            continue
+        in_polygon = np.zeros(len(lats), dtype=bool)
+        points = fence[4]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for index in range(len(points)):
+                lat1, lon1 = points[index - 1]
+                lat2, lon2 = points[index]
+                crosses = (lat1 > lats) != (lat2 > lats)
+                in_polygon ^= crosses & (lons < (lon2 - lon1) * (lats - lat1) / (lat2 - lat1) + lon1)
+        inside |= in_polygon
+    return ~inside
+
+
+def get_fence_flags(fences, lats, lons):
+    """The start or end fence flags of a batch of actions, None where there is no location or no geofence"""
+    lats = np.array([np.nan if lat is None else float(lat) for lat in lats])
+    lons = np.array([np.nan if lon is None else float(lon) for lon in lons])
+    if not fences:
+        return [None] * len(lats)
+    outside = get_outside_mask(fences, lats, lons)
+    located = ~(np.isnan(lats) | np.isnan(lons))
+    return [bool(flag) if has_location else None for flag, has_location in zip(outside, located)]
+
+
+def revalidate_geofences(company_ids=None, batch_size=None):
+    """Checks the locations of the saved punches against the current geofences and fixes the flags that changed,
+        batch by batch. Returns the number of actions checked and changed."""
+    batch_size = batch_size or settings.GEOFENCE_REVALIDATE_BATCH_SIZE
+    located = InOutAction.objects.filter(Q(start_lat__isnull=False) | Q(end_lat__isnull=False))
+    if company_ids is None:
+        company_ids = located.order_by().values_list('user__company_id', flat=True).distinct()
+    result = {'checked': 0, 'changed': 0}
+    for company_id in company_ids:
+        fences = load_geofences(company_id)
+        last_id = 0
+        while True:
+            rows = list(located.filter(user__company_id=company_id, id__gt=last_id).order_by('id').values_list(
+                'id', 'start_lat', 'start_lon', 'end_lat', 'end_lon', 'start_outside_fence',
+                'end_outside_fence')[:batch_size])
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            ids, start_lats, start_lons, end_lats, end_lons, start_flags, end_flags = zip(*rows)
+            changed = []
+            for action_id, start_flag, end_flag, old_start, old_end in zip(
+                    ids, get_fence_flags(fences, start_lats, start_lons), get_fence_flags(fences, end_lats, end_lons),
+                    start_flags, end_flags):
+                if (start_flag, end_flag) != (old_start, old_end):
+                    changed.append(InOutAction(id=action_id, start_outside_fence=start_flag,
+                                               end_outside_fence=end_flag))
+            # bulk_update skips InOutAction.save, the totals and statuses don't depend on the flags
+            InOutAction.objects.bulk_update(changed, ['start_outside_fence', 'end_outside_fence'])
+            result['checked'] += len(rows)
+            result['changed'] += len(changed)
+    return result
@@ -0,0 +1,21 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from time_tracker.archive import archive_actions
+
+
+class Command(BaseCommand):
+    help = 'Moves the finished time actions older than ACTION_ARCHIVE_DAYS into the archive table of their year'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None, help='Only archive actions older than this, at least ACTION_ARCHIVE_DAYS')
+        parser.add_argument('--batch-size', type=int, default=None, help='Overrides ACTION_ARCHIVE_BATCH_SIZE')
+
+    def handle(self, *args, **options):
+        if options['days'] is not None and options['days'] < settings.ACTION_ARCHIVE_DAYS:
+            # ranges newer than ACTION_ARCHIVE_DAYS don't look in the archive
+            raise CommandError('--days can\'t be less than ACTION_ARCHIVE_DAYS')
+        archived = archive_actions(options['days'], options['batch_size'])
+        for year, count in sorted(archived.items()):
+            self.stdout.write('%s: archived %s actions' % (year, count))
+        self.stdout.write('Archived %s actions' % sum(archived.values()))
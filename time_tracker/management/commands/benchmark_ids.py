@@ -0,0 +1,18 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from time_tracker.benchmark import ID_CODECS, run_id_codec_benchmark
+
+
+class Command(BaseCommand):
+    help = 'Times how long every id codec takes to encrypt and decrypt an id, the results are printed as json'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=10000, help='Random ids to encrypt and decrypt')
+        parser.add_argument('--codecs', default=','.join(ID_CODECS), help='Comma separated codec classes to time')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        results = run_id_codec_benchmark(options['count'], options['codecs'].split(','), options['seed'])
+        self.stdout.write(json.dumps({'count': options['count'], 'codecs': results}, indent=2))
@@ -0,0 +1,46 @@
+import json
+import shutil
+import tempfile
+
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from time_tracker.benchmark import (create_punch_burst_users, delete_load_test_clients, run_clock_in_benchmark,
+                                   run_punch_burst_benchmark)
+
+
+class Command(BaseCommand):
+    help = 'Punches every employee of a generated company in and out through the write-behind punch log at once and ' \
+           'prints the punch latency at the start and the end of the burst as json, with the clock-ins per second ' \
+           'of InOutAction.save before and after the single UPDATE'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=500)
+        parser.add_argument('--rounds', type=int, default=4, help='Times every user punches, in and out in turn')
+        parser.add_argument('--clients', type=int, default=50, help='Punches sent at the same time')
+        parser.add_argument('--stages', default='burst,clock_in',
+                            help='Comma separated: burst for the write-behind log, clock_in for InOutAction.save')
+        parser.add_argument('--output', default=None, help='Write the json to this file instead of printing it')
+
+    def handle(self, *args, **options):
+        # the clients use their own connections, the users can't be rolled back
+        log_dir = tempfile.mkdtemp()
+        company, users = create_punch_burst_users(options['users'])
+        stages = options['stages'].split(',')
+        results = {}
+        try:
+            if 'burst' in stages:
+                with override_settings(PUNCH_WRITE_BEHIND=True, PUNCH_LOG_DIR=log_dir, PUNCH_FLUSH_INTERVAL=0):
+                    results['burst'] = run_punch_burst_benchmark(users, options['rounds'], options['clients'])
+            if 'clock_in' in stages:
+                results['clock_in'] = run_clock_in_benchmark(users, options['rounds'])
+        finally:
+            delete_load_test_clients(company, [])
+            shutil.rmtree(log_dir)
+
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as out_file:
+                out_file.write(output)
+        else:
+            self.stdout.write(output)
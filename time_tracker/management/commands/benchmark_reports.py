@@ -0,0 +1,58 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test.utils import override_settings
+
+from time_tracker.benchmark import BENCHMARK_STAGES, create_synthetic_company, get_benchmark_form, run_report_benchmark
+
+
+class Command(BaseCommand):
+    help = 'Generates a synthetic company and times every stage of building its report, the results are printed as json'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--employees', type=int, default=50)
+        parser.add_argument('--days', type=int, default=28, help='Length of the report in days')
+        parser.add_argument('--shifts', type=int, default=1, help='Shifts per employee per working day')
+        parser.add_argument('--overnight', type=float, default=0.1, help='Part of the shifts that end the next day')
+        parser.add_argument('--open', type=float, default=0.02, help='Part of the shifts without a clock out')
+        parser.add_argument('--timezones', default='America/Denver,America/New_York,America/Los_Angeles',
+                            help='Comma separated timezones the employees cycle through')
+        parser.add_argument('--hours-format', default='decimal', choices=['decimal', 'hours_and_minutes'])
+        parser.add_argument('--backend', default=None, choices=['python', 'numpy'],
+                            help='Overrides REPORT_CALCULATION_BACKEND')
+        parser.add_argument('--stages', default=','.join(BENCHMARK_STAGES),
+                            help='Comma separated stages to run, render and pdf are optional')
+        parser.add_argument('--no-memory', action='store_true', help='Skip tracing memory, it slows every stage down')
+        parser.add_argument('--repeat', type=int, default=1)
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', default=None, help='Write the json to this file instead of printing it')
+        parser.add_argument('--keep', action='store_true', help='Keep the synthetic company instead of rolling back')
+
+    def handle(self, *args, **options):
+        settings_overrides = {}
+        if options['backend']:
+            settings_overrides['REPORT_CALCULATION_BACKEND'] = options['backend']
+
+        with override_settings(**settings_overrides), transaction.atomic():
+            company, begin_date = create_synthetic_company(
+                employees=options['employees'], days=options['days'], shifts_per_day=options['shifts'],
+                overnight_ratio=options['overnight'], open_ratio=options['open'],
+                timezones=options['timezones'].split(','), seed=options['seed'])
+            form = get_benchmark_form(begin_date, options['days'], options['hours_format'])
+            runs = [run_report_benchmark(company, form, options['stages'].split(','), not options['no_memory'])
+                    for i in range(options['repeat'])]
+            if not options['keep']:
+                transaction.set_rollback(True)
+
+        results = {
+            'settings': {key: options[key] for key in ['employees', 'days', 'shifts', 'overnight', 'open', 'timezones',
+                                                       'hours_format', 'backend', 'seed']},
+            'runs': runs,
+        }
+        output = json.dumps(results, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as out_file:
+                out_file.write(output)
+        else:
+            self.stdout.write(output)
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from time_tracker.punch_buffer import flush_punch_log
+
+
+class Command(BaseCommand):
+    help = 'Saves the punches waiting in the write-behind punch log to the database'
+
+    def handle(self, *args, **options):
+        flushed = flush_punch_log()
+        self.stdout.write('Flushed %s punches' % flushed)
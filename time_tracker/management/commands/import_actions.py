@@ -0,0 +1,36 @@
+import csv
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from time_tracker.action_import import import_actions
+
+
+class Command(BaseCommand):
+    help = 'Imports time actions from a csv file with user_id or email, type, start, end and comment columns'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='The csv file, - reads from stdin')
+        parser.add_argument('--batch-size', type=int, default=None, help='Actions written per INSERT')
+        parser.add_argument('--dry-run', action='store_true', help='Only validate the rows')
+
+    def handle(self, *args, **options):
+        if options['path'] == '-':
+            result = self.import_file(sys.stdin, options)
+        else:
+            try:
+                with open(options['path'], newline='') as csv_file:
+                    result = self.import_file(csv_file, options)
+            except OSError as e:
+                raise CommandError(str(e))
+
+        for row_number, error in result['errors']:
+            # the header is the first line of the file
+            self.stderr.write('Line %s: %s' % (row_number + 1, error))
+        verb = 'Validated' if options['dry_run'] else 'Imported'
+        self.stdout.write('%s %s actions for %s users' % (verb, result['created'], result['users']))
+        if result['errors']:
+            raise CommandError('%s rows were skipped' % len(result['errors']))
+
+    def import_file(self, csv_file, options):
+        return import_actions(csv.DictReader(csv_file), batch_size=options['batch_size'], dry_run=options['dry_run'])
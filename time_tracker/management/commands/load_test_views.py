@@ -0,0 +1,33 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from time_tracker.benchmark import create_load_test_clients, delete_load_test_clients, run_view_load_test
+
+
+class Command(BaseCommand):
+    help = 'Sends the clock and calendar requests of many clients at once through the asgi and wsgi handlers and ' \
+           'prints the throughput, latency and thread count of each as json'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=50, help='Clients sending requests at the same time')
+        parser.add_argument('--rounds', type=int, default=10,
+                            help='Times every client loads the clock and calendar and punches')
+        parser.add_argument('--servers', default='asgi,wsgi', help='Comma separated handlers to load, asgi or wsgi')
+        parser.add_argument('--output', default=None, help='Write the json to this file instead of printing it')
+
+    def handle(self, *args, **options):
+        # the handlers use their own connections, the clients can't be rolled back
+        company, sessions = create_load_test_clients(options['clients'])
+        try:
+            runs = [run_view_load_test(sessions, options['rounds'], server)
+                    for server in options['servers'].split(',')]
+        finally:
+            delete_load_test_clients(company, sessions)
+
+        output = json.dumps({'clients': options['clients'], 'rounds': options['rounds'], 'runs': runs}, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as out_file:
+                out_file.write(output)
+        else:
+            self.stdout.write(output)
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from middleware.timezone import get_timezone
+from users.models import CustomUser
+from time_tracker.daily_totals import rebuild_daily_totals, verify_daily_totals
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the TTDailyTotal rollup from the time actions, or checks it with --verify'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verify', action='store_true', help='Only compare the stored totals to the time actions')
+        parser.add_argument('--user', type=int, action='append', dest='user_ids', help='Limit to these user ids')
+
+    def handle(self, *args, **options):
+        users = CustomUser.objects.select_related('company').order_by('id')
+        if options['user_ids']:
+            users = users.filter(id__in=options['user_ids'])
+
+        mismatched_users = 0
+        for user in users.iterator():
+            user_timezone = get_timezone(user)
+            if options['verify']:
+                mismatches = verify_daily_totals(user, user_timezone)
+                if mismatches:
+                    mismatched_users += 1
+                    for day, type, stored, expected in mismatches:
+                        self.stdout.write('User %s %s %s: stored %s expected %s' % (user.id, day, type, stored, expected))
+            else:
+                days = rebuild_daily_totals(user, user_timezone)
+                self.stdout.write('User %s: %s daily totals' % (user.id, days))
+
+        if mismatched_users:
+            raise CommandError('%s users have daily totals that don\'t match their time actions' % mismatched_users)
+        if options['verify']:
+            self.stdout.write(self.style.SUCCESS('The daily totals match the time actions'))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from time_tracker.geofence import revalidate_geofences
+
+
+class Command(BaseCommand):
+    help = 'Checks the locations of the saved punches against the current geofences and updates their flags'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--company', type=int, action='append', dest='company_ids', help='Limit to these company ids')
+        parser.add_argument('--batch-size', type=int, default=None, help='Overrides GEOFENCE_REVALIDATE_BATCH_SIZE')
+
+    def handle(self, *args, **options):
+        result = revalidate_geofences(options['company_ids'], options['batch_size'])
+        self.stdout.write('Checked %s actions, changed %s' % (result['checked'], result['changed']))
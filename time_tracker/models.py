@@ -1,7 +1,12 @@
 from datetime import date, timedelta, datetime
+from zoneinfo import ZoneInfo
 
+from django.core.exceptions import ValidationError
 from django.core.validators import MaxValueValidator, MinValueValidator
-from django.db import models
+from django.db import connections, models, router, transaction
+from django.db.models import Case, F, OuterRef, Q, Subquery, Value, When
+from django.db.models.lookups import GreaterThan, IsNull, LessThan
+from django.db.models.sql import UpdateQuery
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
@@ -33,37 +38,112 @@ class InOutAction(models.Model):
     comment = models.TextField(blank=True, null=True, default='')
     action_lookup_datetime = models.DateTimeField(blank=True,
                                                   null=True)  # if no end is set then it is the start datetime, otherwise it is the end datetime. For calculating the users current action.
+    # set when the punch has a location and the user's company has geofences, True when it is outside all of them
+    start_outside_fence = models.BooleanField(default=None, null=True, blank=True)
+    end_outside_fence = models.BooleanField(default=None, null=True, blank=True)
     created_date = models.DateField(_("Created Date"), auto_now_add=True, blank=True)
     updated_date = models.DateField(_("Last Updated Date"), auto_now=True, blank=True)
 
+    class Meta:
+        indexes = [
+            # the current action of a type, the summary report's next start and the status updates
+            models.Index(fields=['user', 'type', 'action_lookup_datetime'], name='tt_action_user_type_lookup_idx'),
+            # the calendar events and the report ranges
+            models.Index(fields=['user', 'action_lookup_datetime'], name='tt_action_user_lookup_idx'),
+        ]
+
     def __str__(self):
         return self.user.__str__() + ", " + self.type.__str__() + ", " + self.start.__str__() + ', ' + self.end.__str__()
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """Remembers the loaded start, end and lookup datetime so the daily totals of the days the action is moved away
+            from are updated and moving the action back in time is noticed"""
+        instance = super().from_db(db, field_names, values)
+        instance._original_span = (instance.__dict__.get('start'), instance.__dict__.get('end'))
+        instance._original_lookup = instance.__dict__.get('action_lookup_datetime')
+        return instance
+
     def save(self, *args, **kwargs):
-        """Overridden to allow for calling update current time action after a time action is edited or created"""
-        # set action_lookup_datetime when necessary
-        if 'skip' in kwargs:
-            skip = kwargs.pop('skip')
+        """Overridden to fill in action_lookup_datetime and total_time before the row is written and to update the
+            current time action attached to the user in the same transaction"""
+        if kwargs.pop('skip', False):
+            super(InOutAction, self).save(*args, **kwargs)
+            return
+        self.set_calculated_fields()
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = set(kwargs['update_fields']) | {'action_lookup_datetime', 'total_time',
+                                                                      'start_outside_fence', 'end_outside_fence'}
+        if self._state.adding:
+            moved_back = False
         else:
-            skip = False
-        super(InOutAction, self).save(*args, **kwargs)
-        if not skip:
-            if self.end:
-                self.action_lookup_datetime = self.end
+            original_lookup = getattr(self, '_original_lookup', None)
+            moved_back = original_lookup is None or self.action_lookup_datetime < original_lookup
+        spans = (getattr(self, '_original_span', (None, None)), (self.start, self.end))
+        with transaction.atomic():
+            super(InOutAction, self).save(*args, **kwargs)
+            bump_report_versions([self.user_id])
+            user_info = None if moved_back else self.set_current_time_action()
+            if user_info is None:
+                # an older action might be the current one now, look it up the slow way
+                self.update_current_time_action()
             else:
-                self.action_lookup_datetime = self.start
-            if self.end and self.start:
-                self.total_time = self.end.timestamp() - self.start.timestamp()
-            else:
-                self.total_time = 0
-            self.save(skip=True)
-            self.update_current_time_action()
+                # the UPDATE returned the new status, the status cache is written through
+                notify_status_changed(self.user_id, self.user.company_id if InOutAction.user.is_cached(self) else None,
+                                      user_info)
+            if any(start and end for start, end in spans):
+                # worked out once the action is committed so the punch's transaction stays short
+                transaction.on_commit(lambda: self.update_daily_totals(*spans))
+        self._original_span = (self.start, self.end)
+        self._original_lookup = self.action_lookup_datetime
+
+    def set_calculated_fields(self):
+        if self.end:
+            self.action_lookup_datetime = self.end
+        else:
+            self.action_lookup_datetime = self.start
+        if self.end and self.start:
+            self.total_time = self.end.timestamp() - self.start.timestamp()
+        else:
+            self.total_time = 0
+        self.set_fence_flags()
+
+    def set_fence_flags(self):
+        """Checks the locations of the punches against the geofences of the user's company"""
+        if self.start_lat is None and self.end_lat is None:
+            self.start_outside_fence = self.end_outside_fence = None
+            return
+        from .geofence import is_outside_fences
+        if InOutAction.user.is_cached(self):
+            company_id = self.user.company_id
+        else:
+            # only the company is needed, not the whole user
+            company_id = InOutAction.user.field.related_model.objects.filter(id=self.user_id).values_list(
+                'company_id', flat=True).first()
+        self.start_outside_fence = is_outside_fences(company_id, self.start_lat, self.start_lon)
+        self.end_outside_fence = is_outside_fences(company_id, self.end_lat, self.end_lon)
 
     def delete(self, *args, **kwargs):
         """Overridden to allow for calling update current time action after deletion"""
+        span = (self.start, self.end)
         super(InOutAction, self).delete(*args, **kwargs)
+        bump_report_versions([self.user_id])
+        self.update_daily_totals(span)
         self.update_current_time_action()
 
+    def update_daily_totals(self, *spans):
+        """Recalculates the TTDailyTotal rows of every day the spans touched"""
+        from .daily_totals import get_span_dates, update_daily_totals
+        from middleware.timezone import get_timezone
+        if any(start and end for start, end in spans):
+            # open actions aren't counted so there is nothing to do until the action has an end
+            user_timezone = get_timezone(self.user)
+            dates = set()
+            for start, end in spans:
+                dates.update(get_span_dates(start, end, user_timezone))
+            with transaction.atomic():
+                update_daily_totals(self.user_id, dates, user_timezone)
+
     def update_current_time_action(self):
         """Updates the current time action attached to the specific user"""
         if self.user:
@@ -77,7 +157,73 @@ class InOutAction(models.Model):
             elif self.type == 'b':
                 user_info.break_action = current_action
             user_info.update_status()
-            user_info.save()
+            user_info.save(update_fields=['time_action', 'break_action', 'status_text', 'status_time', 'updated_date'])
+
+    def set_current_time_action(self):
+        """Makes this action the user's current one with a single UPDATE unless a later action of the same type is
+            already current. Returns the user info with the USER_INFO_STATUS_FIELDS the UPDATE wrote, None when it
+            wasn't updated."""
+        if self.type not in ('t', 'b') or self.action_lookup_datetime > timezone.now():
+            return None
+        using = router.db_for_write(TTUserInfo)
+        connection = connections[using]
+        if not connection.features.update_can_self_select:
+            # the user info is looked up by a query of its own first, the statement can't be kept
+            user_infos, values = self.get_status_update()
+            if not user_infos.update(**values):
+                return None
+            return TTUserInfo.objects.filter(user_id=self.user_id).only(*USER_INFO_STATUS_FIELDS).first()
+        sql, slots, fields = get_status_update_statement(using, self.type, self.end is not None)
+        values = {'action_id': self.pk, 'user_id': self.user_id, 'start': self.start, 'end': self.end,
+                  'today': date.today()}
+        params = []
+        for param, name in slots:
+            if name is not None:
+                field = STATUS_UPDATE_STAND_INS[name][1]
+                param = field.get_db_prep_value(values[name], connection) if field else values[name]
+            params.append(param)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            if not fields:
+                if not cursor.rowcount:
+                    return None
+                return TTUserInfo.objects.filter(user_id=self.user_id).only(*USER_INFO_STATUS_FIELDS).first()
+            row = cursor.fetchone()
+        return get_returned_instance(TTUserInfo, using, fields, row) if row else None
+
+    def get_status_update(self):
+        """The user info set_current_time_action updates and the values it sets. The status is worked out the way
+            TTUserInfo.update_status does it, the other current action is read by the database."""
+        field = 'time_action' if self.type == 't' else 'break_action'
+        other = 'break_action_id' if self.type == 't' else 'time_action_id'
+        other_start = Subquery(InOutAction.objects.filter(id=OuterRef(other)).values('start')[:1])
+        other_end = Subquery(InOutAction.objects.filter(id=OuterRef(other)).values('end')[:1])
+        if self.type == 't':
+            if self.end:
+                status, default = [], ('o', Value(self.end))
+            else:
+                status = [(GreaterThan(other_end, self.start), 'c', other_end),
+                          (GreaterThan(other_start, self.start), 'b', other_start)]
+                default = ('i', Value(self.start))
+        else:
+            status = [(Q(time_action__isnull=True), 'n', Value(None)),
+                      (IsNull(other_end, False), 'o', other_end)]
+            if self.end:
+                status.append((LessThan(other_start, self.end), 'c', Value(self.end)))
+            status.append((LessThan(other_start, self.start), 'b', Value(self.start)))
+            default = ('i', other_start)
+        user_infos = TTUserInfo.objects.filter(user_id=self.user_id).filter(
+            Q(**{field + '__action_lookup_datetime__isnull': True}) |
+            Q(**{field + '__action_lookup_datetime__lte': self.action_lookup_datetime}))
+        values = {
+            field: self.pk,
+            'status_text': Case(*[When(condition, then=Value(text)) for condition, text, time in status],
+                                default=Value(default[0]), output_field=models.CharField()),
+            'status_time': Case(*[When(condition, then=time) for condition, text, time in status],
+                                default=default[1], output_field=models.DateTimeField()),
+            'updated_date': date.today(),
+        }
+        return user_infos, values
 
 
 class TTCompanyInfo(models.Model):
@@ -110,6 +256,13 @@ class TTCompanyInfo(models.Model):
     def __str__(self):
         return self.company.name
 
+    def save(self, *args, **kwargs):
+        """Overridden so the cached reports and tenants of the company's employees pick up the new settings"""
+        from middleware.tenant import tenant_changed
+        super().save(*args, **kwargs)
+        bump_report_versions(TTUserInfo.objects.filter(user__company_id=self.company_id).values_list('user_id', flat=True))
+        tenant_changed(company_id=self.company_id)
+
 
 class TTUserInfo(models.Model):
     user = models.ForeignKey('users.CustomUser', on_delete=models.CASCADE, null=False, blank=False)
@@ -154,6 +307,10 @@ class TTUserInfo(models.Model):
                     if getattr(self, i) is None:
                         setattr(self, i, getattr(tt_company, 'default_' + i))
         super().save(*args, **kwargs)
+        notify_status_changed(self.user_id, self.user.company_id if TTUserInfo.user.is_cached(self) else None, self)
+        if not created and kwargs.get('update_fields') is None:
+            # the overtime and break settings might have changed
+            bump_report_versions([self.user_id])
 
     def update_status(self):
         if self.time_action and self.break_action:
@@ -197,4 +354,264 @@ class TTReports(models.Model):
             name = self.custom_name + '_' + date_time
         else:
             name = self.report_name + '_' + date_time
-        return '/'.join(['reports', str(self.user.id), self.folder, name + '.pdf'])
\ No newline at end of file
+        return '/'.join(['reports', str(self.user.id), self.folder, name + '.pdf'])
+
+class TTReportJob(models.Model):
+    """A report that is generated in the background by the report workers, progress is sent to the user's websocket."""
+    user = models.ForeignKey('users.CustomUser', on_delete=models.CASCADE, null=False, blank=False)
+    form_data = models.JSONField(default=dict, blank=True)  # the submitted ReportsForm data, every value is a list
+    status = models.CharField(max_length=1, default='q', choices=(
+        ('q', 'Queued'), ('r', 'Running'), ('c', 'Complete'), ('f', 'Failed')))
+    progress = models.IntegerField(default=0, validators=[MaxValueValidator(100), MinValueValidator(0)])
+    report = models.ForeignKey(TTReports, on_delete=models.SET_NULL, default=None, null=True, blank=True)
+    report_path = models.TextField(default='', blank=True, null=True)
+    error = models.TextField(default='', blank=True, null=True)
+    created_date = models.DateTimeField(_("Created Date"), auto_now_add=True, blank=True, null=True)
+    updated_date = models.DateTimeField(_("Updated Date"), auto_now=True, blank=True, null=True)
+
+    def __str__(self):
+        return self.user.__str__() + ", " + self.get_status_display() + ", " + str(self.progress) + '%'
+
+
+class TTDailyTotal(models.Model):
+    """Seconds of finished actions per user, day and type. The day is in the user's timezone.
+        Kept up to date by InOutAction.save and delete, rebuild with the rebuild_daily_totals command.
+        Only the manage_times calendar reads it, the reports sum every action rounded on its own and raw seconds per
+        day can't give the same totals."""
+    user = models.ForeignKey('users.CustomUser', on_delete=models.CASCADE, null=False, blank=False)
+    date = models.DateField(null=False, blank=False)
+    type = models.CharField(max_length=1, default="t", choices=(('t', 'Time'), ('b', 'Break'), ('l', 'Lunch')))
+    total_time = models.FloatField(default=0)  # seconds
+    timezone = models.CharField(max_length=63, default='', blank=True)  # the timezone the day was calculated in
+    updated_date = models.DateTimeField(_("Updated Date"), auto_now=True, blank=True, null=True)
+
+    class Meta:
+        unique_together = ('user', 'date', 'type')
+
+    def __str__(self):
+        return self.user.__str__() + ", " + self.type + ", " + str(self.date) + ', ' + str(self.total_time)
+
+
+class TTReportDataVersion(models.Model):
+    """Counts the changes to the data an employee's reports are built from. Cached reports are keyed on it."""
+    user = models.OneToOneField('users.CustomUser', on_delete=models.CASCADE, null=False, blank=False)
+    version = models.PositiveIntegerField(default=0)
+
+
+# The fields of TTUserInfo the status cache keeps, the status UPDATE of a punch returns them
+USER_INFO_STATUS_FIELDS = ['user_id', 'status_text', 'status_time', 'time_action_id', 'break_action_id',
+                           'enable_breaks']
+
+
+# The status UPDATE of a punch is the same for every action of a type with or without an end, only the values differ.
+# Building it with the ORM takes about ten times as long as running it, so it is built once per shape from an action
+# with these stand-in values and the values of each action are put in their places.
+STATUS_UPDATE_STAND_INS = {
+    # name: (stand-in, field that prepares the value for the database, None when it is used as it is)
+    'action_id': (-1000001, None),
+    'user_id': (-1000002, None),
+    'start': (datetime(1901, 1, 1, 1, tzinfo=ZoneInfo('UTC')), InOutAction._meta.get_field('start')),
+    'end': (datetime(1901, 1, 1, 2, tzinfo=ZoneInfo('UTC')), InOutAction._meta.get_field('end')),
+    'today': (date(1901, 1, 3), TTUserInfo._meta.get_field('updated_date')),
+}
+_status_updates = {}    # (database, type, has end, returning): (sql, [(param, stand-in name or None)], returned fields)
+
+
+def get_status_update_statement(using, type, has_end):
+    """The sql of the status UPDATE, its params with the names of the stand-ins to replace and the fields it returns,
+        no fields when the database can't return them"""
+    returning = can_update_returning(using)
+    key = (using, type, has_end, returning)
+    statement = _status_updates.get(key)
+    if statement is None:
+        connection = connections[using]
+        stand_ins = {name: value for name, (value, field) in STATUS_UPDATE_STAND_INS.items()}
+        stand_in = InOutAction(id=stand_ins['action_id'], user_id=stand_ins['user_id'], type=type,
+                               start=stand_ins['start'], end=stand_ins['end'] if has_end else None)
+        stand_in.action_lookup_datetime = stand_in.end or stand_in.start
+        user_infos, values = stand_in.get_status_update()
+        values['updated_date'] = stand_ins['today']
+        query = user_infos.query.chain(UpdateQuery)
+        query.add_update_values(values)
+        compiler = query.get_compiler(using)
+        sql, params = compiler.as_sql()
+        names = {field.get_db_prep_value(value, connection) if field else value: name
+                 for name, (value, field) in STATUS_UPDATE_STAND_INS.items()}
+        fields = []
+        if returning:
+            # from_db takes the values in the order of the model's fields
+            fields = [field for field in TTUserInfo._meta.concrete_fields if field.attname in USER_INFO_STATUS_FIELDS]
+            sql += ' RETURNING ' + ', '.join(compiler.quote_name_unless_alias(field.column) for field in fields)
+        statement = _status_updates[key] = (sql, [(param, names.get(param)) for param in params], fields)
+    return statement
+
+
+def can_update_returning(using):
+    """If the database can return the rows an UPDATE changed, sqlite has RETURNING since 3.35. MariaDB only has it for
+        INSERT."""
+    connection = connections[using]
+    return connection.vendor in ('postgresql', 'sqlite') and connection.features.can_return_columns_from_insert
+
+
+def get_returned_instance(model, using, fields, row):
+    """The instance of a row returned by a statement, with the fields loaded"""
+    connection = connections[using]
+    values = []
+    for field, value in zip(fields, row):
+        column = field.get_col(model._meta.db_table)
+        for converter in connection.ops.get_db_converters(column) + field.get_db_converters(connection):
+            value = converter(value, column, connection)
+        values.append(value)
+    return model.from_db(using, [field.attname for field in fields], values)
+
+
+def bump_report_versions(user_ids):
+    """Invalidates the cached reports of the users. Users without a TTReportDataVersion are on version 0."""
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+    updated = TTReportDataVersion.objects.filter(user_id__in=user_ids).update(version=F('version') + 1)
+    if updated < len(user_ids):
+        existing = set(TTReportDataVersion.objects.filter(user_id__in=user_ids).values_list('user_id', flat=True))
+        TTReportDataVersion.objects.bulk_create([TTReportDataVersion(user_id=user_id, version=1)
+                                                 for user_id in user_ids if user_id not in existing],
+                                                ignore_conflicts=True)
+
+
+def notify_status_changed(user_id, company_id=None, user_info=None):
+    """Keeps the in memory status cache and the status boards up to date, see status_cache.status_changed"""
+    from .status_cache import status_changed
+    from .status_board import status_changed as board_status_changed
+    status_changed(user_id, company_id, user_info)
+    board_status_changed(user_id, company_id)
+
+
+def refresh_current_time_actions(user_ids):
+    """Points the users' TTUserInfo at their latest time and break actions and updates their status.
+        Used after actions were written without InOutAction.save, like the bulk import does."""
+    user_ids = list(user_ids)
+    if not user_ids:
+        return 0
+    now = timezone.now()
+
+    def latest(type):
+        return Subquery(InOutAction.objects.filter(user=OuterRef('user'), type=type, action_lookup_datetime__lte=now)
+                        .order_by('-action_lookup_datetime').values('id')[:1])
+    user_infos = list(TTUserInfo.objects.filter(user_id__in=user_ids).annotate(latest_time=latest('t'),
+                                                                               latest_break=latest('b')))
+    actions = InOutAction.objects.in_bulk([action_id for user_info in user_infos
+                                           for action_id in (user_info.latest_time, user_info.latest_break) if action_id])
+    for user_info in user_infos:
+        user_info.time_action = actions.get(user_info.latest_time)
+        user_info.break_action = actions.get(user_info.latest_break)
+        user_info.update_status()
+        user_info.updated_date = date.today()
+    TTUserInfo.objects.bulk_update(user_infos, ['time_action', 'break_action', 'status_text', 'status_time',
+                                                'updated_date'], batch_size=500)
+    for user_info in user_infos:
+        notify_status_changed(user_info.user_id, user_info=user_info)
+    return len(user_infos)
+
+
+class TTReportCache(models.Model):
+    """A rendered report that is handed out again when the same report is requested with unchanged data."""
+    key = models.CharField(max_length=64, unique=True)  # sha256 of the report options, employees and their versions
+    company = models.ForeignKey('users.Company', on_delete=models.CASCADE, null=False, blank=False)
+    report = models.ForeignKey(TTReports, on_delete=models.CASCADE, null=False, blank=False)
+    report_path = models.TextField(default='', blank=False, null=False)
+    size = models.PositiveIntegerField(default=0)  # size of the pdf in bytes
+    hits = models.PositiveIntegerField(default=0)
+    last_used = models.DateTimeField(default=timezone.now)
+    created_date = models.DateTimeField(_("Created Date"), auto_now_add=True, blank=True, null=True)
+
+    def __str__(self):
+        return self.company.__str__() + ", " + self.report.report_name
+
+
+class TTRejectedPunch(models.Model):
+    """A punch from the write-behind punch log that couldn't be saved, kept so an admin can look at it and enter it by
+        hand. The user is told about it when it is rejected."""
+    user = models.ForeignKey('users.CustomUser', on_delete=models.SET_NULL, default=None, null=True, blank=True)
+    key = models.CharField(max_length=64, unique=True)  # the id of the punch in the log, it is flushed again after a crash
+    event = models.JSONField(default=dict, blank=True)  # the line of the punch log
+    errors = models.JSONField(default=list, blank=True)
+    created_date = models.DateTimeField(_("Created Date"), auto_now_add=True, blank=True, null=True)
+
+    def __str__(self):
+        return str(self.user) + ", " + self.key
+
+
+class TTPunchKey(models.Model):
+    """The response of a punch sent with an idempotency key, a retry with the same key gets it back instead of
+        punching again."""
+    user = models.ForeignKey('users.CustomUser', on_delete=models.CASCADE, null=False, blank=False)
+    key = models.CharField(max_length=64)
+    action = models.ForeignKey(InOutAction, on_delete=models.SET_NULL, default=None, null=True, blank=True)
+    response = models.JSONField(default=dict, blank=True)
+    created_date = models.DateTimeField(_("Created Date"), auto_now_add=True, blank=True, null=True)
+
+    class Meta:
+        unique_together = ('user', 'key')
+
+    def __str__(self):
+        return self.user.__str__() + ", " + self.key
+
+
+class TTActionArchive(models.Model):
+    """An archive table of the finished time actions of a year, the archive_actions command moves the actions that are
+        older than ACTION_ARCHIVE_DAYS out of InOutAction into it. The daily totals of the archived days are kept."""
+    year = models.PositiveIntegerField(unique=True)  # the utc year of the actions' lookup datetime
+    actions = models.PositiveIntegerField(default=0)
+    archived_before = models.DateTimeField(blank=True, null=True)  # the cutoff of the last run that archived into it
+    created_date = models.DateTimeField(_("Created Date"), auto_now_add=True, blank=True, null=True)
+    updated_date = models.DateTimeField(_("Updated Date"), auto_now=True, blank=True, null=True)
+
+    def __str__(self):
+        return str(self.year) + ", " + str(self.actions)
+
+
+class TTGeofence(models.Model):
+    """An area punches of the company's employees are expected to come from, a circle or a polygon. Punches outside of
+        every active geofence of the company are flagged on the action."""
+    company = models.ForeignKey('users.Company', on_delete=models.CASCADE, null=False, blank=False)
+    name = models.CharField(max_length=100, default='', blank=True)
+    shape = models.CharField(max_length=1, default='c', choices=(('c', 'Circle'), ('p', 'Polygon')))
+    latitude = models.DecimalField(max_digits=22, decimal_places=16, blank=True, null=True)  # the center of a circle
+    longitude = models.DecimalField(max_digits=22, decimal_places=16, blank=True, null=True)
+    radius = models.FloatField(default=100, blank=True, null=True)  # meters
+    points = models.JSONField(default=list, blank=True)  # the corners of a polygon as [[lat, lon], ...]
+    active = models.BooleanField(default=True)
+    created_date = models.DateTimeField(_("Created Date"), auto_now_add=True, blank=True, null=True)
+    updated_date = models.DateTimeField(_("Updated Date"), auto_now=True, blank=True, null=True)
+
+    def __str__(self):
+        return self.company.__str__() + ", " + self.name
+
+    def clean(self):
+        if self.shape == 'c' and (self.latitude is None or self.longitude is None or not self.radius
+                                  or self.radius < 0):
+            raise ValidationError('A circle needs a center and a radius')
+        if self.shape == 'p':
+            try:
+                valid = len(self.points) >= 3 and all(abs(float(lat)) <= 90 and abs(float(lon)) <= 180
+                                                      for lat, lon in self.points)
+            except (TypeError, ValueError):
+                valid = False
+            if not valid:
+                raise ValidationError('A polygon needs at least 3 points of [lat, lon]')
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        geofences_changed(self.company_id)
+
+    def delete(self, *args, **kwargs):
+        super().delete(*args, **kwargs)
+        geofences_changed(self.company_id)
+
+
+def geofences_changed(company_id):
+    """Drops the company's geofence index now and again once the change is committed, a punch in between would have
+        loaded the old geofences. The other processes are told once it is committed."""
+    from .geofence import clear_geofence_index, publish_geofence_change
+    clear_geofence_index(company_id)
+    transaction.on_commit(lambda: publish_geofence_change(company_id))
@@ -0,0 +1,278 @@
+from datetime import timedelta
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from daxApp.encryption import encrypt_id, decrypt_ids
+from middleware.timezone import get_timezone
+from users.models import CustomUser
+from .action_import import finish_import, parse_import_datetime
+from .daily_totals import get_span_dates
+from .models import InOutAction, TTUserInfo, TTPunchKey
+from .utils import combine_comments
+
+# the type of action each punch works on, if it ends that action and the statuses the punch is allowed from.
+# the statuses match the buttons the simple clock widget shows.
+PUNCH_ACTIONS = {
+    'in': ('t', False, ('o', 'n')),
+    'out': ('t', True, ('i', 'c')),
+    'b_in': ('b', False, ('i', 'c')),
+    'b_out': ('b', True, ('b',)),
+}
+
+
+def punch(user, action, comment='', idempotency_key='', lat=None, lon=None):
+    """Records a punch of the json punch api, returns the response data and the status code.
+        A punch repeated with the same idempotency key gets the first response back without punching again."""
+    if action not in PUNCH_ACTIONS:
+        return {'errors': ['Unknown punch ' + str(action)]}, 400
+    if len(idempotency_key) > 64:
+        return {'errors': ['The idempotency key can be at most 64 characters']}, 400
+    try:
+        lat, lon = parse_coordinate(lat, 90), parse_coordinate(lon, 180)
+    except ValidationError as e:
+        return {'errors': e.messages}, 400
+
+    expired = timezone.now() - timedelta(hours=settings.PUNCH_IDEMPOTENCY_KEY_HOURS)
+    if idempotency_key:
+        punch_key = TTPunchKey.objects.filter(user=user, key=idempotency_key, created_date__gte=expired).first()
+        if punch_key:
+            return punch_key.response, 201
+    try:
+        with transaction.atomic():
+            data, status, punch_action = record_punch(user, action, comment, lat, lon)
+            if idempotency_key and punch_action:
+                TTPunchKey.objects.filter(user=user, created_date__lt=expired).delete()
+                TTPunchKey.objects.create(user=user, key=idempotency_key, action=punch_action, response=data)
+    except IntegrityError:
+        if not idempotency_key:
+            raise
+        # a request with the same key finished first, its punch is the one that counts
+        return TTPunchKey.objects.get(user=user, key=idempotency_key).response, 201
+    return data, status
+
+
+def record_punch(user, action, comment, lat=None, lon=None):
+    """Creates or ends the action of the punch. The status in the response is worked out from the user info already
+        in memory, InOutAction.save has written the same status to the database."""
+    type, ends_action, allowed_statuses = PUNCH_ACTIONS[action]
+    user_info = TTUserInfo.objects.select_related('time_action', 'break_action').filter(user=user).first()
+    if user_info is None:
+        return {'errors': ['Time tracking is not set up for this user']}, 404, None
+    if user_info.status_text not in allowed_statuses:
+        return {'errors': ['Can\'t ' + action.replace('_', ' ') + ' while ' + user_info.get_status_text_display()],
+                'status': user_info.status_text}, 409, None
+
+    if ends_action:
+        punch_action = user_info.time_action if type == 't' else user_info.break_action
+        punch_action.user = user    # already loaded with its company, the daily totals need its timezone
+        punch_action.comment = combine_comments(punch_action.comment, comment)
+        punch_action.end = timezone.now()
+        punch_action.end_lat, punch_action.end_lon = lat, lon
+        punch_action.save()
+    else:
+        punch_action = InOutAction.objects.create(user=user, type=type, comment=comment, start_lat=lat, start_lon=lon)
+
+    if type == 't':
+        user_info.time_action = punch_action
+    else:
+        user_info.break_action = punch_action
+    user_info.update_status()
+    return get_punch_response(user_info, punch_action), 201, punch_action
+
+
+def get_punch_response(user_info, punch_action):
+    return {
+        'action_id': encrypt_id(punch_action.id),
+        'status': user_info.status_text,
+        'status_text': user_info.get_status_text_display(),
+        'status_time': user_info.status_time.isoformat() if user_info.status_time else None,
+        'outside_fence': punch_action.end_outside_fence if punch_action.end else punch_action.start_outside_fence,
+    }
+
+
+def sync_punches(user, events):
+    """Applies the punches an offline kiosk or phone queued up, all of them in one transaction.
+
+        Each event has a client id, an action, the time it happened and optionally a comment, lat, lon and the
+        encrypted employee_id it was punched for. The events of each employee are applied in the order they happened,
+        an out ends the open action the in started. Ids that were synced before get their first result back. The
+        report versions, daily totals and statuses of the employees are updated once for the whole batch."""
+    if not isinstance(events, list):
+        return {'errors': ['The punches have to be a list']}, 400
+    if len(events) > settings.PUNCH_SYNC_MAX_EVENTS:
+        return {'errors': ['At most ' + str(settings.PUNCH_SYNC_MAX_EVENTS) + ' punches can be synced at once']}, 400
+
+    results = [None] * len(events)
+    employees = get_sync_employees(user, events)
+    punches_by_user = {}
+    for index, event in enumerate(events):
+        try:
+            sync_punch = parse_sync_punch(event, user, employees)
+        except ValidationError as e:
+            results[index] = {'id': event.get('id') if isinstance(event, dict) else None, 'status': 'rejected',
+                              'errors': e.messages}
+            continue
+        punches_by_user.setdefault(sync_punch['user'].id, []).append((index, sync_punch))
+
+    with transaction.atomic():
+        apply_sync_punches(punches_by_user, results)
+    # the employee ids are handed back the way the client sent them, the user's own punches have none
+    employee_ids = {user_id: punches[0][1]['employee_id'] for user_id, punches in punches_by_user.items()}
+    statuses = TTUserInfo.objects.filter(user_id__in=employee_ids.keys()).order_by('user_id').values(
+        'user_id', 'status_text', 'status_time')
+    return {
+        'results': results,
+        'statuses': [{
+            'employee_id': employee_ids[status['user_id']],
+            'status': status['status_text'],
+            'status_time': status['status_time'].isoformat() if status['status_time'] else None,
+        } for status in statuses],
+    }, 201
+
+
+def get_sync_employees(user, events):
+    """The employees the events were punched for by their encrypted id, only the user's company is looked up"""
+    tokens = list({event['employee_id'] for event in events
+                   if isinstance(event, dict) and isinstance(event.get('employee_id'), str) and event['employee_id']})
+    employee_ids = {token: employee_id for token, employee_id in zip(tokens, decrypt_ids(tokens, skip_invalid=True))
+                    if employee_id is not None}
+    by_id = CustomUser.objects.select_related('company').filter(
+        id__in=employee_ids.values(), company=user.company).in_bulk() if employee_ids else {}
+    return {key: by_id[employee_id] for key, employee_id in employee_ids.items() if employee_id in by_id}
+
+
+def parse_sync_punch(event, user, employees):
+    if not isinstance(event, dict):
+        raise ValidationError('A punch has to be an object')
+    client_id = str(event.get('id') or '')
+    if not client_id or len(client_id) > 64:
+        raise ValidationError('A punch needs an id of at most 64 characters')
+    if event.get('action') not in PUNCH_ACTIONS:
+        raise ValidationError('Unknown punch ' + str(event.get('action')))
+    employee = user
+    employee_id = event.get('employee_id') or None
+    if employee_id:
+        employee = employees.get(employee_id)
+        if employee is None:
+            raise ValidationError('Unknown employee')
+    time = parse_import_datetime(event.get('time'), get_timezone(employee))
+    if time is None:
+        raise ValidationError('The time of the punch is required')
+    if time > timezone.now() + timedelta(minutes=5):
+        raise ValidationError('The punch is in the future')
+    return {
+        'id': client_id, 'action': event['action'], 'user': employee, 'employee_id': employee_id, 'time': time,
+        'comment': str(event.get('comment') or ''),
+        'lat': parse_coordinate(event.get('lat'), 90), 'lon': parse_coordinate(event.get('lon'), 180),
+    }
+
+
+def parse_coordinate(value, limit):
+    if value in (None, ''):
+        return None
+    try:
+        value = Decimal(str(value))
+    except InvalidOperation:
+        raise ValidationError('Invalid coordinate ' + str(value))
+    if not value.is_finite() or abs(value) > limit:
+        raise ValidationError('Invalid coordinate ' + str(value))
+    return round(value, 16)
+
+
+def apply_sync_punches(punches_by_user, results):
+    """Pairs the punches with the open actions and writes them, results is filled in by the index of each event"""
+    expired = timezone.now() - timedelta(hours=settings.PUNCH_IDEMPOTENCY_KEY_HOURS)
+    user_ids = punches_by_user.keys()
+    synced = {(punch_key.user_id, punch_key.key): punch_key.response for punch_key in TTPunchKey.objects.filter(
+        user_id__in=user_ids, key__in={sync_punch['id'] for punches in punches_by_user.values()
+                                       for index, sync_punch in punches},
+        created_date__gte=expired)}
+    user_infos = {user_info.user_id: user_info for user_info in TTUserInfo.objects.select_related(
+        'time_action', 'break_action').filter(user_id__in=user_ids)}
+
+    new_actions, ended_actions, applied, dates_by_user = [], [], {}, {}
+    for user_id, punches in punches_by_user.items():
+        open_time, open_break = get_open_actions(user_infos.get(user_id))
+        for index, sync_punch in sorted(punches, key=lambda punch: punch[1]['time']):
+            key = (user_id, sync_punch['id'])
+            if key in synced or key in applied:
+                continue
+            try:
+                action, open_time, open_break = apply_sync_punch(sync_punch, open_time, open_break)
+            except ValidationError as e:
+                results[index] = {'id': sync_punch['id'], 'status': 'rejected', 'errors': e.messages}
+                continue
+            if not PUNCH_ACTIONS[sync_punch['action']][1]:
+                new_actions.append(action)
+            elif action.pk:
+                ended_actions.append(action)
+            applied[key] = (index, action)
+            user_timezone, dates = dates_by_user.setdefault(user_id, (get_timezone(sync_punch['user']), set()))
+            dates.update(get_span_dates(action.start, action.end, user_timezone))
+
+    InOutAction.objects.bulk_create(new_actions)
+    InOutAction.objects.bulk_update(ended_actions, ['end', 'end_lat', 'end_lon', 'comment', 'action_lookup_datetime',
+                                                    'total_time', 'start_outside_fence', 'end_outside_fence'])
+    punch_keys = []
+    for (user_id, client_id), (index, action) in applied.items():
+        results[index] = {'id': client_id, 'status': 'created', 'action_id': encrypt_id(action.pk)}
+        punch_keys.append(TTPunchKey(user_id=user_id, key=client_id, action=action, response=results[index]))
+    TTPunchKey.objects.filter(user_id__in=user_ids, created_date__lt=expired).delete()
+    TTPunchKey.objects.bulk_create(punch_keys)
+    if dates_by_user:
+        finish_import(dates_by_user)
+
+    for user_id, punches in punches_by_user.items():
+        for index, sync_punch in punches:
+            key = (user_id, sync_punch['id'])
+            if results[index] is None:
+                # synced before, or a second event with the same id in this batch
+                first = synced[key] if key in synced else results[applied[key][0]]
+                results[index] = dict(first, status='duplicate')
+
+
+def get_open_actions(user_info):
+    """The open time action and the break that was started during it, the same pair update_status looks at"""
+    if user_info is None or not user_info.time_action or user_info.time_action.end:
+        return None, None
+    open_time = user_info.time_action
+    open_break = user_info.break_action
+    if open_break and not open_break.end and open_break.start > open_time.start:
+        return open_time, open_break
+    return open_time, None
+
+
+def apply_sync_punch(sync_punch, open_time, open_break):
+    """Starts or ends an action for the punch, returns it with the open time and break actions after the punch"""
+    type, ends_action = PUNCH_ACTIONS[sync_punch['action']][:2]
+    if not ends_action:
+        if type == 't' and open_time:
+            raise ValidationError('Already clocked in')
+        if type == 'b' and (not open_time or open_break):
+            raise ValidationError('Not clocked in' if not open_time else 'Already on break')
+        action = InOutAction(user=sync_punch['user'], type=type, start=sync_punch['time'],
+                             comment=sync_punch['comment'], start_lat=sync_punch['lat'], start_lon=sync_punch['lon'])
+        action.set_calculated_fields()
+        if type == 't':
+            return action, action, None
+        return action, open_time, action
+
+    action = open_time if type == 't' else open_break
+    if action is None:
+        raise ValidationError('Not clocked in' if type == 't' else 'Not on break')
+    if type == 't' and open_break:
+        raise ValidationError('Still on break')
+    if sync_punch['time'] < action.start:
+        raise ValidationError('The punch is before the start of the action it ends')
+    action.end = sync_punch['time']
+    action.end_lat = sync_punch['lat']
+    action.end_lon = sync_punch['lon']
+    action.comment = combine_comments(action.comment, sync_punch['comment'])
+    action.set_calculated_fields()
+    if type == 't':
+        return action, None, None
+    return action, open_time, None
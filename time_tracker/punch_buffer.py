@@ -0,0 +1,383 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from middleware.timezone import get_timezone
+from users.models import CustomUser
+from users.utils import send_user_message
+from .models import TTUserInfo, TTRejectedPunch
+from .punch import PUNCH_ACTIONS, apply_sync_punch, apply_sync_punches, get_open_actions
+
+logger = logging.getLogger("django.request")
+
+# Every process keeps the punches that are still in the log per user. A request only reads what was appended since the
+# process last looked and drops what the flusher saved since, so a punch costs the same however many punches are
+# waiting. The offset file counts the times the log was started over, the punches of an older log are all dropped.
+
+_flusher = None
+_flusher_lock = threading.Lock()
+_overlay = {'path': None, 'generation': None, 'offset': 0, 'position': 0, 'punches': {}}  # user id: [(end, event)]
+_overlay_lock = threading.Lock()
+
+
+def get_log_path():
+    return os.path.join(settings.PUNCH_LOG_DIR, 'punches.log')
+
+
+def get_offset_path():
+    # how far into the log the punches are already in the database
+    return os.path.join(settings.PUNCH_LOG_DIR, 'punches.offset')
+
+
+def open_log(flags):
+    os.makedirs(settings.PUNCH_LOG_DIR, exist_ok=True)
+    # windows would translate the newlines and the offsets wouldn't match the file
+    return os.open(get_log_path(), flags | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o600)
+
+
+@contextmanager
+def lock_punch_file(name, shared=False):
+    """Holds a lock on the file in PUNCH_LOG_DIR while the block runs. The log is locked through punches.log.lock, the
+        flusher through punches.lock."""
+    os.makedirs(settings.PUNCH_LOG_DIR, exist_ok=True)
+    fd = os.open(os.path.join(settings.PUNCH_LOG_DIR, name), os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        lock_file(fd, shared)
+        try:
+            yield
+        finally:
+            unlock_file(fd)
+    finally:
+        os.close(fd)
+
+
+def lock_file(fd, shared=False):
+    """fcntl is only on unix, windows locks the first byte with msvcrt, which has no shared locks"""
+    try:
+        import fcntl
+    except ImportError:     # windows
+        import msvcrt
+        os.lseek(fd, 0, os.SEEK_SET)
+        while True:
+            try:
+                msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                # LK_LOCK gives up after 10 seconds
+                pass
+    fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+
+
+def unlock_file(fd):
+    try:
+        import fcntl
+    except ImportError:     # windows
+        import msvcrt
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+        return
+    fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+def buffer_punch(user, action, comment=''):
+    """Appends the punch to the punch log and returns once it is on disk, the flusher writes it to the database.
+        Returns the logged punch."""
+    event = {'id': uuid.uuid4().hex, 'user_id': user.id, 'action': action, 'time': timezone.now().isoformat(),
+             'comment': comment}
+    line = (json.dumps(event) + '\n').encode()
+    with lock_punch_file('punches.log.lock'):
+        fd = open_log(os.O_WRONLY | os.O_APPEND)
+        try:
+            os.write(fd, line)
+            os.fsync(fd)
+            end = os.lseek(fd, 0, os.SEEK_CUR)
+        finally:
+            os.close(fd)
+    remember_punch(end - len(line), end, event)
+    start_punch_flusher()
+    return event
+
+
+def remember_punch(start, end, event):
+    """Adds the punch to the overlay when the overlay has everything before it, otherwise the next read finds it"""
+    with _overlay_lock:
+        if _overlay['path'] == get_log_path() and _overlay['position'] == start:
+            _overlay['punches'].setdefault(event['user_id'], []).append((end, event))
+            _overlay['position'] = end
+
+
+def read_pending_punches():
+    """The offset the pending punches start at, the punches the database doesn't have yet and the offset they end at"""
+    offset, generation, punches, end_offset = read_log()
+    return offset, [event for end, event in punches], end_offset
+
+
+def read_log(position=0, generation=None):
+    """Reads the punches from position on, or from the offset when the log was started over since generation or the
+        punches before position are flushed. Returns the offset, the generation, the punches with the position each
+        one ends at and the position the last one ends at."""
+    with lock_punch_file('punches.log.lock', shared=True):
+        offset, log_generation = read_log_position()
+        if log_generation != generation or position < offset:
+            position = offset
+        fd = open_log(os.O_RDONLY)
+        try:
+            os.lseek(fd, position, os.SEEK_SET)
+            data = b''
+            while True:
+                chunk = os.read(fd, 1024 * 1024)
+                if not chunk:
+                    break
+                data += chunk
+        finally:
+            os.close(fd)
+    # a line without its newline is still being written
+    data = data[:data.rfind(b'\n') + 1]
+    punches = []
+    end = position
+    for line in data.splitlines(keepends=True):
+        end += len(line)
+        try:
+            punches.append((end, json.loads(line)))
+        except ValueError:
+            logger.error('Skipped an unreadable line in the punch log: ' + repr(line))
+    return offset, log_generation, punches, position + len(data)
+
+
+def read_log_position():
+    """The offset and the number of times the log was started over"""
+    try:
+        with open(get_offset_path()) as offset_file:
+            values = offset_file.read().split()
+        return int(values[0]) if values else 0, int(values[1]) if len(values) > 1 else 0
+    except (OSError, ValueError):
+        return 0, 0
+
+
+def write_offset(offset, generation):
+    temp_path = get_offset_path() + '.tmp'
+    with open(temp_path, 'w') as offset_file:
+        offset_file.write(str(offset) + ' ' + str(generation))
+        offset_file.flush()
+        os.fsync(offset_file.fileno())
+    os.replace(temp_path, get_offset_path())
+
+
+def get_pending_punches(user_id):
+    if not settings.PUNCH_WRITE_BEHIND:
+        return []
+    with _overlay_lock:
+        read_overlay()
+        return [event for end, event in _overlay['punches'].get(user_id, [])]
+
+
+def read_overlay():
+    """Adds the punches appended since the overlay was last read and drops the flushed ones, the overlay lock is held"""
+    if _overlay['path'] != get_log_path():
+        _overlay.update(path=get_log_path(), generation=None, offset=0, position=0, punches={})
+    offset, generation, punches, position = read_log(_overlay['position'], _overlay['generation'])
+    if generation != _overlay['generation']:
+        _overlay['punches'] = {}
+    elif offset != _overlay['offset']:
+        for user_id, user_punches in list(_overlay['punches'].items()):
+            user_punches = [(end, event) for end, event in user_punches if end > offset]
+            if user_punches:
+                _overlay['punches'][user_id] = user_punches
+            else:
+                del _overlay['punches'][user_id]
+    for end, event in punches:
+        _overlay['punches'].setdefault(event.get('user_id'), []).append((end, event))
+    _overlay.update(generation=generation, offset=offset, position=position)
+
+
+def flush_punch_log():
+    """Writes the pending punches to the database in batches and moves the offset past them. Only one process flushes
+        at a time. The ids of the punches are kept in TTPunchKey so punches flushed twice after a crash only count
+        once. Returns the number of punches flushed."""
+    with lock_punch_file('punches.lock'):
+        offset, events, end_offset = read_pending_punches()
+        batch_size = settings.PUNCH_FLUSH_BATCH_SIZE
+        for start in range(0, len(events), batch_size):
+            write_punches(events[start:start + batch_size])
+        if events:
+            write_offset(end_offset, read_log_position()[1])
+        truncate_punch_log()
+    return len(events)
+
+
+def write_punches(events):
+    """Applies a batch of logged punches in one transaction, the way the batch sync applies them. The punches that
+        can't be saved are kept as TTRejectedPunch and their users are told."""
+    users = CustomUser.objects.select_related('company').in_bulk({event.get('user_id') for event in events})
+    punches_by_user = {}
+    logged_events = []
+    rejected = []
+    for event in events:
+        sync_punch = get_logged_punch(event, users)
+        if sync_punch is None:
+            logger.error('Skipped an invalid punch in the punch log: ' + str(event))
+            rejected.append(get_rejected_punch(event, users, ['The punch in the punch log is invalid']))
+            continue
+        punches_by_user.setdefault(sync_punch['user'].id, []).append((len(logged_events), sync_punch))
+        logged_events.append(event)
+    results = [None] * len(logged_events)
+    with transaction.atomic():
+        apply_sync_punches(punches_by_user, results)
+        for event, result in zip(logged_events, results):
+            if result['status'] == 'rejected':
+                logger.error('A buffered punch was rejected: ' + str(event) + ' ' + ', '.join(result['errors']))
+                rejected.append(get_rejected_punch(event, users, result['errors']))
+        # flushed again after a crash the punch is rejected again, it is only kept once
+        TTRejectedPunch.objects.bulk_create(rejected, ignore_conflicts=True)
+    for rejected_punch in rejected:
+        if rejected_punch.user_id is not None:
+            notify_rejected_punch(rejected_punch)
+
+
+def get_rejected_punch(event, users, errors):
+    user_id = event.get('user_id') if event.get('user_id') in users else None
+    return TTRejectedPunch(user_id=user_id, key=str(event.get('id') or uuid.uuid4().hex)[:64], event=event,
+                           errors=errors)
+
+
+def notify_rejected_punch(rejected_punch):
+    """Tells the user their punch wasn't saved, the punch is on their screen already"""
+    try:
+        send_user_message(rejected_punch.user_id, {
+            'type': 'notification',
+            'title': 'Punch not saved',
+            'message': ' '.join(rejected_punch.errors) + ' Please ask your administrator to correct your time.',
+            'actions': []
+        })
+    except Exception as e:
+        logger.error('Failed to tell user ' + str(rejected_punch.user_id) + ' about a rejected punch')
+        logger.error(e)
+
+
+def get_logged_punch(event, users):
+    """The punch of a log line in the form apply_sync_punches takes"""
+    punch_time = parse_datetime(event.get('time') or '')
+    if event.get('user_id') not in users or event.get('action') not in PUNCH_ACTIONS or punch_time is None:
+        return None
+    return {'id': event.get('id', ''), 'action': event['action'], 'user': users[event['user_id']],
+            'employee_id': None, 'time': punch_time, 'comment': event.get('comment', ''), 'lat': None, 'lon': None}
+
+
+def truncate_punch_log():
+    """Starts the log over once everything in it is flushed, the appenders are held off while it is checked. The offset
+        goes first, a crash in between flushes the punches again instead of skipping the next ones."""
+    with lock_punch_file('punches.log.lock'):
+        fd = open_log(os.O_WRONLY)
+        try:
+            offset, generation = read_log_position()
+            if os.fstat(fd).st_size == offset:
+                write_offset(0, generation + 1)
+                os.ftruncate(fd, 0)
+        finally:
+            os.close(fd)
+
+
+def start_punch_flusher():
+    """Starts the background thread that flushes the log every PUNCH_FLUSH_INTERVAL seconds, 0 leaves the flushing
+        to the flush_punches command"""
+    global _flusher
+    if not settings.PUNCH_FLUSH_INTERVAL:
+        return
+    with _flusher_lock:
+        if _flusher is None:
+            _flusher = threading.Thread(target=run_punch_flusher, daemon=True)
+            _flusher.start()
+
+
+def run_punch_flusher():
+    while True:
+        time.sleep(settings.PUNCH_FLUSH_INTERVAL)
+        try:
+            close_old_connections()
+            flush_punch_log()
+        except Exception as e:
+            logger.error('Failed to flush the punch log')
+            logger.error(e)
+
+
+def buffer_clock_action(user, action, comment=''):
+    """The write-behind version of a simple clock punch. The punch is logged when the user's status allows it,
+        returns the user info with the pending punches applied."""
+    user_info = get_buffered_user_info(user)
+    if user_info is None:
+        return None
+    if action not in PUNCH_ACTIONS or user_info.status_text not in PUNCH_ACTIONS[action][2]:
+        logger.error('Tried to ' + str(action) + ' while ' + user_info.get_status_text_display() + '. User:' +
+                     str(user.id))
+        return user_info
+    event = buffer_punch(user, action, comment)
+    open_time, open_break = get_open_actions(user_info)
+    apply_to_user_info(user_info, [apply_sync_punch(get_logged_punch(event, {user.id: user}), open_time, open_break)[0]])
+    return user_info
+
+
+def get_buffered_user_info(user):
+    """The user's TTUserInfo with the punches that are still in the log applied to it, so the user sees their punch
+        right away. Nothing is saved."""
+    user_info = TTUserInfo.objects.select_related('time_action', 'break_action').filter(user=user).first()
+    if user_info is not None:
+        apply_to_user_info(user_info, apply_pending_punches(user, user_info))
+    return user_info
+
+
+def apply_to_user_info(user_info, actions):
+    for action in actions:
+        if action.type == 't':
+            user_info.time_action = action
+        elif action.type == 'b':
+            user_info.break_action = action
+    user_info.update_status()
+
+
+def apply_pending_punches(user, user_info):
+    """The actions the user's pending punches start or end, in the order they were punched. None of them are saved."""
+    open_time, open_break = get_open_actions(user_info)
+    changed_actions = []
+    users = {user.id: user}
+    for event in get_pending_punches(user.id):
+        sync_punch = get_logged_punch(event, users)
+        if sync_punch is None:
+            continue
+        try:
+            action, open_time, open_break = apply_sync_punch(sync_punch, open_time, open_break)
+        except ValidationError:
+            # flushed while we were reading, the database already has it
+            continue
+        changed_actions.append(action)
+    return changed_actions
+
+
+def get_buffered_actions(user, actions, range_start, range_end):
+    """The actions of a calendar range with the user's pending punches applied, the actions that aren't in the
+        database yet have no id"""
+    user_info = TTUserInfo.objects.select_related('time_action', 'break_action').filter(user=user).first()
+    changed_actions = apply_pending_punches(user, user_info) if user_info else []
+    if not changed_actions:
+        return actions
+    user_timezone = get_timezone(user)
+    if timezone.is_naive(range_start):
+        range_start = timezone.make_aware(range_start, user_timezone)
+    if timezone.is_naive(range_end):
+        range_end = timezone.make_aware(range_end, user_timezone)
+    by_id = {action.id: action for action in actions}
+    for action in changed_actions:
+        if action.id in by_id:
+            by_id[action.id] = action
+        elif range_start <= action.action_lookup_datetime <= range_end:
+            actions.append(action)
+    return [by_id.get(action.id, action) if action.id else action for action in actions]
@@ -0,0 +1,69 @@
+import re
+from datetime import timedelta
+
+from django.db import connection, transaction
+from django.utils import timezone
+
+from middleware.timezone import get_timezone
+from .models import InOutAction
+from .utils import get_month_range
+
+# plan lines of a table read from start to end, and of rows sorted after they were read
+FULL_SCAN_PATTERNS = {
+    'sqlite': re.compile(r'\bSCAN (?:TABLE )?(?!CONSTANT ROW)"?(\w+)"?'),
+    'postgresql': re.compile(r'\bSeq Scan on "?(\w+)"?'),
+}
+SORT_PATTERNS = {
+    'sqlite': re.compile(r'USE TEMP B-TREE FOR (?:RIGHT PART OF )?ORDER BY'),
+    'postgresql': re.compile(r'^\s*(?:->\s*)?Sort\b', re.MULTILINE),
+}
+
+
+def get_hot_queries(user):
+    """The time action queries that run on every punch, calendar load and report, built the way their views build them"""
+    now = timezone.now()
+    month_start, next_month_start = get_month_range(now.date(), get_timezone(user))
+    return {
+        'current_time_action': InOutAction.objects.filter(user=user, type='t', action_lookup_datetime__lte=now)
+        .order_by('-action_lookup_datetime')[:1],
+        'events_by_range': InOutAction.objects.filter(user=user, action_lookup_datetime__gte=now - timedelta(days=42),
+                                                      action_lookup_datetime__lte=now),
+        'events_by_month': InOutAction.objects.filter(user=user, action_lookup_datetime__gte=month_start,
+                                                      action_lookup_datetime__lt=next_month_start),
+        'time_actions_list': InOutAction.objects.filter(
+            user__in=[user.id], action_lookup_datetime__range=[now - timedelta(days=15), now])
+        .order_by('user', 'action_lookup_datetime'),
+    }
+
+
+def get_query_plan(queryset):
+    """EXPLAIN of the queryset. The planner of postgres is told to avoid sequential scans so the small tables of a test
+        database show the plan a full table would get."""
+    if connection.vendor != 'postgresql':
+        return queryset.explain()
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+        plan = queryset.explain()
+        transaction.set_rollback(True)
+    return plan
+
+
+def get_plan_problems(queryset, allow_sort=False):
+    """The full table scans and, unless allow_sort is set, the sorts the database needs for the queryset"""
+    plan = get_query_plan(queryset)
+    problems = []
+    scan_pattern = FULL_SCAN_PATTERNS.get(connection.vendor)
+    if scan_pattern:
+        problems += ['full scan of ' + table for table in scan_pattern.findall(plan)]
+    sort_pattern = SORT_PATTERNS.get(connection.vendor)
+    if sort_pattern and not allow_sort and sort_pattern.search(plan):
+        problems.append('sort without an index')
+    return problems, plan
+
+
+def assert_uses_indexes(queryset, allow_sort=False):
+    """Meant for the tests, fails when the database can't answer the queryset from an index"""
+    problems, plan = get_plan_problems(queryset, allow_sort)
+    if problems:
+        raise AssertionError(', '.join(problems) + ' in the plan of\n' + str(queryset.query) + '\n' + plan)
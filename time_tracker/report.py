@@ -1,120 +1,190 @@
 import logging
+import multiprocessing
 import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from copy import copy
 from io import BytesIO
+from tempfile import TemporaryFile, SpooledTemporaryFile
 from datetime import timedelta, date, datetime
-from django.contrib import messages
+from django.conf import settings
 from django.utils import timezone
 from django.template.loader import get_template
 from string import capwords
 
-from django.shortcuts import render
 from users.models import CustomUser
 from middleware.timezone import get_timezone
 from xhtml2pdf import pisa
+from pypdf import PdfWriter
+from boto3.s3.transfer import TransferConfig
 from daxApp.settings import S3_CLIENT, S3_BUCKET_NAME
 
-from .forms import ReportsForm
 from .models import InOutAction, TTCompanyInfo, TTUserInfo, TTReports
-from daxApp.encryption import encrypt_id, decrypt_id
+from .archive import get_archived_actions
+from . import report_worker
+from daxApp.encryption import encrypt_ids, decrypt_id
 
 
 SECONDS_IN_HOUR = 3600
+REPORT_LINK_EXPIRATION = 60 * 5     # 5 minutes
+DETAILED_HOURS_REPORT = 'time_tracker/reports/detailed_hours.html'
+SUMMARY_REPORT = 'time_tracker/reports/summary.html'
+# large reports are sent to S3 in parts straight from the file instead of one request
+REPORT_UPLOAD_CONFIG = TransferConfig(multipart_threshold=1024 * 1024 * 8, multipart_chunksize=1024 * 1024 * 8,
+                                      max_concurrency=4)
 
-from django.http import HttpResponse
-from asgiref.sync import async_to_sync
+_report_build_executor = None
+_report_build_executor_lock = threading.Lock()
 
-def generate_report(request):
-    # Get the template
-    template = get_template('report_template.html')
 
-    # Render the template with context
-    context = {'foo': 'bar'}
-    html = template.render(context)
+def create_report(user, form, override_timezone=None):
+    """Runs the report engine for the cleaned ReportsForm data.
+        Returns the report template and its arguments, the template is None when no employees were selected."""
+    override_timezone = get_report_timezone(user, override_timezone)
 
-def generate_report(request, page, page_arguments, override_timezone=None):
-    if not override_timezone and request.user.company.use_company_timezone:
-        override_timezone = get_timezone(request.user)
+    """Grab employee list"""
+    employee_list, employee_id_list = get_employee_list(user.company, form['selected_employees_list'])
+    if not employee_list:
+        return None, {}
 
-    original_form = ReportsForm(request.POST, company=request.user.company, user=request.user)
-    if original_form.is_valid():
-        form = original_form.cleaned_data
-        """Grab employee list"""
-        employee_list, employee_id_list = get_employee_list(request.user.company, form['selected_employees_list'])
+    """Get the company time tracker info"""
+    company_info = TTCompanyInfo.objects.get(company=user.company)
 
-        if not employee_list:
-            logging.error("An invalid request to generate a report was received no employees selected")
-            messages.warning(request, 'No employees selected')
-            page_arguments['form'] = original_form
-            return render(request, page, page_arguments)
+    """Grab time actions for date range"""
+    full_beg_date, full_end_date, time_actions_list = get_time_actions_list(form, employee_id_list,
+                                                                            company_info, override_timezone)
 
-        """Get the company time tracker info"""
-        company_info = TTCompanyInfo.objects.get(company=request.user.company)
+    if form['report_type'] == SUMMARY_REPORT:
+        from .report_summary import SummaryReport
+        report_class = SummaryReport
+    else:
+        report_class = get_report_class()
+    report_engine = report_class(employee_list, time_actions_list, form, full_beg_date, full_end_date,
+                                 user.company, company_info, override_timezone)
 
-        """Grab time actions for date range"""
-        full_beg_date, full_end_date, time_actions_list = get_time_actions_list(form, employee_id_list,
-                                                                                company_info, override_timezone)
+    return form['report_type'], report_engine.make_detailed_hours_report()
 
-        report_engine = Report(employee_list, time_actions_list, form, full_beg_date, full_end_date,
-                               request.user.company, company_info, override_timezone)
 
-        page_arguments = report_engine.make_detailed_hours_report()
+def get_report_timezone(user, override_timezone=None):
+    """The timezone every employee is shown in, None when each employee uses their own timezone"""
+    if not override_timezone and user.company.use_company_timezone:
+        override_timezone = get_timezone(user)
+    return override_timezone
 
-        """if there are no errors then pass link to the report and pass the page arguments. otherwise send errors to the forms page"""
-        if not page_arguments.get('error', None):
-            page = form['report_type']
-        else:
-            page_arguments['form'] = original_form
-        template = get_template(page)
-        html = template.render(page_arguments)
-        pdf_file = BytesIO()
-        pdf = pisa.pisaDocument(BytesIO(html.encode("ISO-8859-1")), pdf_file)
-        with open('test.pdf', 'wb') as out_file:
-            out_file.write(pdf_file.getvalue())
-        if form['report_type'] == 'time_tracker/reports/detailed_hours.html':
-            report_type = 'Detailed Hours Report'
-            report_folder = 'detailed'
-        else:
-            report_type = 'Unknown'
-            report_folder = 'unknown'
-
-        rep_obj = TTReports.objects.create(user=request.user,
-                                 report_name=report_type + ' ' + page_arguments['date-range'],
-                                           folder=report_folder)
-        rep_obj.save()
-        report_path = rep_obj.report_path()
 
+def render_report_pdf(page, page_arguments):
+    """Renders the report into a pdf a few employees at a time so the whole document is never held as html or laid out
+        by xhtml2pdf at once. Every section is rendered into its own pdf on disk and the pages are appended to the final
+        pdf. The merge is not streamed, PdfWriter keeps the pages of every section in memory until the pdf is written.
+        Returns a temporary file positioned at the beginning, close it when done."""
+    employees = page_arguments.get('employees') or []
+    chunk_size = settings.REPORT_PDF_CHUNK_SIZE
+    if page == DETAILED_HOURS_REPORT:
+        chunks = [employees[i:i + chunk_size] for i in range(0, len(employees), chunk_size)] or [employees]
+    else:
+        # the other reports are a row per employee, they are small enough to render at once
+        chunks = [employees]
+    template = get_template(page)
+    writer = PdfWriter()
+    section_files = []
+    try:
+        for index, chunk in enumerate(chunks):
+            """Only the first section gets the letter head and only the last one the grand totals.
+                Sections always start on a new page, the same as when each employee gets a new page."""
+            section_arguments = dict(page_arguments, employees=chunk, hide_report_start=index > 0,
+                                     hide_report_end=index < len(chunks) - 1)
+            html = template.render(section_arguments)
+            section_file = TemporaryFile()
+            pisa.pisaDocument(BytesIO(html.encode("ISO-8859-1")), section_file)
+            del html
+            section_file.seek(0)
+            writer.append(section_file)
+            section_files.append(section_file)
+
+        pdf_file = SpooledTemporaryFile(max_size=settings.REPORT_PDF_SPOOL_SIZE)
+        writer.write(pdf_file)
         pdf_file.seek(0)    # Reset the location to the beginning of the pdf_file
-        S3_CLIENT.upload_fileobj(pdf_file, S3_BUCKET_NAME, report_path)
-        presigned_url = S3_CLIENT.generate_presigned_url(
-            ClientMethod='get_object',
-            Params={
-                'Bucket': S3_BUCKET_NAME,
-                'Key': report_path
-            },
-            ExpiresIn=60*5 #5 minutes
-        )
-        print(presigned_url)
-
-        return render(request, page, page_arguments)
+    finally:
+        for section_file in section_files:
+            section_file.close()
+    return pdf_file
+
+
+def upload_report(user, form, page_arguments, pdf_file):
+    """Stores the pdf on S3 and records it as a TTReports. Returns the TTReports and the S3 key of the pdf"""
+    if form['report_type'] == DETAILED_HOURS_REPORT:
+        report_type = 'Detailed Hours Report'
+        report_folder = 'detailed'
+    elif form['report_type'] == SUMMARY_REPORT:
+        report_type = 'Summary Report'
+        report_folder = 'summary'
     else:
-        logging.error("An invalid request to generate a report was received")
-        messages.warning(request, 'Please fix the error below')
-        page_arguments['form'] = original_form
-        return render(request, page, page_arguments)
+        report_type = 'Unknown'
+        report_folder = 'unknown'
+
+    rep_obj = TTReports.objects.create(user=user,
+                                       report_name=report_type + ' ' + page_arguments['date-range'],
+                                       folder=report_folder)
+    report_path = rep_obj.report_path()
+
+    S3_CLIENT.upload_fileobj(pdf_file, S3_BUCKET_NAME, report_path, Config=REPORT_UPLOAD_CONFIG)
+    return rep_obj, report_path
+
+
+def copy_report(user, report, report_path):
+    """A TTReports of the user for a pdf another user already has on S3. The pdf is copied on S3 so the copy is kept
+        and removed with the user's own reports. Returns the TTReports and the S3 key of the copy"""
+    rep_obj = TTReports.objects.create(user=user, report_name=report.report_name, folder=report.folder)
+    copy_path = rep_obj.report_path()
+    S3_CLIENT.copy({'Bucket': S3_BUCKET_NAME, 'Key': report_path}, S3_BUCKET_NAME, copy_path,
+                   Config=REPORT_UPLOAD_CONFIG)
+    return rep_obj, copy_path
+
+
+def get_report_link(report_path, expires_in=REPORT_LINK_EXPIRATION):
+    """Creates a temporary link to a report stored on S3"""
+    return S3_CLIENT.generate_presigned_url(
+        ClientMethod='get_object',
+        Params={
+            'Bucket': S3_BUCKET_NAME,
+            'Key': report_path
+        },
+        ExpiresIn=expires_in
+    )
+
+
+def get_report_build_executor(processes):
+    """The pool of processes that build chunks of employees, it is started the first time a report needs it"""
+    global _report_build_executor
+    with _report_build_executor_lock:
+        if _report_build_executor is None:
+            _report_build_executor = ProcessPoolExecutor(max_workers=processes,
+                                                         mp_context=multiprocessing.get_context('spawn'),
+                                                         initializer=report_worker.init_report_build_worker)
+    return _report_build_executor
+
+
+def get_report_class():
+    """Returns the report engine for the configured calculation backend"""
+    if settings.REPORT_CALCULATION_BACKEND == 'numpy':
+        from .report_vectorized import VectorizedReport
+        return VectorizedReport
+    return Report
 
 
 def get_employee_list(company, employee_ids):
-    if '-1' in employee_ids:
-        employee_list = TTUserInfo.objects.filter(user__company=company).order_by('user__last_name', 'user__first_name')
-    else:
+    """The user and company are joined in so the report engine never has to go back to the database per employee"""
+    employee_list = TTUserInfo.objects.filter(user__company=company).select_related('user', 'user__company')
+    if '-1' not in employee_ids:
         temp_id_list = []
         for i in employee_ids:
             temp_id_list.append(i)
-        employee_list = TTUserInfo.objects.filter(user__company=company, user__id__in=temp_id_list).order_by('user__last_name', 'user__first_name')
+        employee_list = employee_list.filter(user__id__in=temp_id_list)
+    employee_list = list(employee_list.order_by('user__last_name', 'user__first_name'))
 
     employee_id_list = []
     for employee in employee_list:
-        employee_id_list.append(employee.user.id)
+        employee_id_list.append(employee.user_id)
 
     return employee_list, employee_id_list
 
@@ -130,9 +200,26 @@ def get_time_actions_list(form, employee_id_list, company_info, override_timezon
         # grabbing one extra day so we can widen the scope and get all employees whose timezones say they are in the date range.
         filter_end_date = filter_end_date + timedelta(days=1)
     time_actions_list = InOutAction.objects.filter(user__in=employee_id_list, action_lookup_datetime__range=[filter_beg_date, filter_end_date]).order_by('user', 'action_lookup_datetime')
+    archived_actions = get_archived_actions(filter_beg_date, filter_end_date, user__in=employee_id_list)
+    if archived_actions:
+        # the range reaches into the archive, both are loaded and handed over as one list in the same order
+        time_actions_list = sorted(list(time_actions_list) + archived_actions,
+                                   key=lambda time_action: (time_action.user_id, time_action.action_lookup_datetime))
     return full_beg_date.date(), full_end_date.date(), time_actions_list
 
 
+def group_actions_by_user(time_actions_list):
+    """Splits the time actions into lists keyed by user id.
+        The time actions are expected to be ordered by user and action_lookup_datetime, that order is kept in each list.
+        Querysets are streamed so the whole range is loaded with a single query."""
+    actions_by_user = {}
+    if hasattr(time_actions_list, 'iterator'):
+        time_actions_list = time_actions_list.iterator(chunk_size=2000)
+    for time_action in time_actions_list:
+        actions_by_user.setdefault(time_action.user_id, []).append(time_action)
+    return actions_by_user
+
+
 def get_date_range(week_start_day, begin_date, end_date):
     """This function expands the date range to fit the max number of weeks the range spans.
         This allows for accurate overtime calculations in regards to previous hours worked and overnight shifts"""
@@ -164,7 +251,7 @@ def convert_front_end_date_to_utc(input_date, override_timezone):
 
 class Report:
     def __init__(self, employee_list, time_actions_list, form, full_beg_date, full_end_date, company, company_info,
-                 override_timezone):
+                 override_timezone, processes=None, chunk_size=None):
         self.employee_list = employee_list
         self.time_actions_list = time_actions_list
         self.form = form
@@ -174,6 +261,15 @@ class Report:
         self.company_info = company_info
         self.override_timezone = override_timezone
         self.auto_inserted = False
+        self._actions_by_user = None
+        self.processes = settings.REPORT_BUILD_PROCESSES if processes is None else processes
+        self.chunk_size = settings.REPORT_BUILD_CHUNK_SIZE if chunk_size is None else chunk_size
+
+    def get_employee_actions(self, employee):
+        """Returns the time actions of a single employee, the first call loads the actions for every employee."""
+        if self._actions_by_user is None:
+            self._actions_by_user = group_actions_by_user(self.time_actions_list)
+        return self._actions_by_user.get(employee.user_id, [])
 
     def create_report_dict(self):
         """This function builds a dictionary that organizes employee times so it can be displayed on the report.
@@ -275,7 +371,65 @@ class Report:
 
         """
 
-        return_dict = {
+        return_dict = self.create_report_header()
+        possible_weeks = self.get_possible_weeks()
+
+        chunks = self.get_employee_chunks()
+        if len(chunks) > 1:
+            # every employee is independent until the grand totals, so chunks of employees are built in parallel.
+            # map returns the results in the order of the chunks which keeps the employee order of the report.
+            chunk_reports = [self.create_chunk_report(chunk) for chunk in chunks]
+            results = get_report_build_executor(self.processes).map(report_worker.build_report_chunk, chunk_reports,
+                                                                    [possible_weeks] * len(chunk_reports))
+        else:
+            results = [self.build_employees(possible_weeks)]
+
+        for employee_results, auto_inserted in results:
+            for emp_dict, tt_settings in employee_results:
+                self.update_report_settings(return_dict, tt_settings)
+                return_dict['employees'].append(emp_dict)
+            self.auto_inserted = self.auto_inserted or auto_inserted
+
+        self.add_report_totals(return_dict)
+        self.add_report_dates(return_dict)
+        return return_dict
+
+    def build_employees(self, possible_weeks):
+        """Builds the days, weeks and totals of every employee in the report.
+            Returns a list of (employee dictionary, employee settings) and whether any actions were auto inserted."""
+        employee_results = []
+        for employee in self.employee_list:
+            employee_timezone = self.get_employee_timezone(employee)
+
+            # get employee specific settings if necessary
+            tt_settings = self.get_tt_settings(employee)
+
+            days, weeks = self.organize_days_weeks(employee, employee_timezone, possible_weeks, tt_settings)
+            employee_results.append((self.create_employee_dict(employee, employee_timezone, weeks, tt_settings),
+                                     tt_settings))
+        return employee_results, self.auto_inserted
+
+    def get_employee_chunks(self):
+        """Splits the employees into the chunks that are built in parallel, a single chunk is built in this process"""
+        employee_list = list(self.employee_list)
+        if self.processes <= 1 or len(employee_list) <= self.chunk_size:
+            return [employee_list]
+        return [employee_list[i:i + self.chunk_size] for i in range(0, len(employee_list), self.chunk_size)]
+
+    def create_chunk_report(self, employee_list):
+        """Creates a copy of this report that only holds the chunk's employees and their actions,
+            it is sent to a worker process so it can't hold on to the queryset."""
+        chunk_report = copy(self)
+        chunk_report.employee_list = employee_list
+        chunk_report.time_actions_list = []
+        chunk_report.auto_inserted = False
+        chunk_report._actions_by_user = {employee.user_id: self.get_employee_actions(employee)
+                                         for employee in employee_list}
+        return chunk_report
+
+    def create_report_header(self):
+        """Creates the top level of the report dictionary, employees and totals are added to it later."""
+        return {
             'date-range': (self.form['begin_date'].strftime('%m/%d/%y') + " - " + self.form['end_date'].strftime(
                 '%m/%d/%y')),
             'employees': [],
@@ -287,83 +441,82 @@ class Report:
             'paid_breaks': self.company_info.default_breaks_are_paid,
         }
 
+    def get_possible_weeks(self):
         possible_weeks = []
         loop_date = self.full_beg_date
         while loop_date < self.full_end_date:
             possible_weeks.append({'start': loop_date, 'end': (loop_date + timedelta(days=6))})
             loop_date = loop_date + timedelta(days=7)
-
-        for employee in self.employee_list:
-            if self.override_timezone:
-                employee_timezone = self.override_timezone
-            else:
-                employee_timezone = get_timezone(employee.user)
-
-            # get employee specific settings if necessary
-            tt_settings = self.get_tt_settings(employee)
-
-            # toggle true on daily, weekly overtimes and double time so they show up on reports if they are ever used.
-            if not self.company_info.use_company_defaults_for_all_employees:
-                for i in ['daily_overtime_s', 'double_time_s', 'weekly_overtime_s', 'paid_breaks']:
-                    if tt_settings[i]:
-                        return_dict[i] = tt_settings[i]
-
-            days, weeks = self.organize_days_weeks(employee, employee_timezone, possible_weeks, tt_settings)
-
-            """Getting final totals for the employee"""
-            emp_dict = {
-                'name': capwords(employee.user.full_name),
-                'timezone': str(employee_timezone),
-                'weeks': weeks,
-                'paid_breaks': tt_settings['paid_breaks']
-            }
-            return_dict['employees'].append(emp_dict)
-            if self.form['other_hours_format'] == 'decimal':
-                emp_dict['total'] = 0.0
-                emp_dict['break'] = 0.0
-                emp_dict['overtime'] = 0.0
-                emp_dict['previous_total'] = 0.0
-                emp_dict['previous_breaks'] = 0.0
-                emp_dict['weekly_overtime'] = 0.0
-                emp_dict['daily_overtime'] = 0.0
-                emp_dict['double_time'] = 0.0
-            else:
-                emp_dict['total'] = 0
-                emp_dict['break'] = 0
-                emp_dict['overtime'] = 0
-                emp_dict['previous_total'] = 0
-                emp_dict['previous_breaks'] = 0
-                emp_dict['weekly_overtime'] = 0
-                emp_dict['daily_overtime'] = 0
-                emp_dict['double_time'] = 0
-
-            """ Get totals from the weeks compilied"""
-            for week_info in weeks:
-                emp_dict['total'] += week_info['total']
-                emp_dict['break'] += week_info['break']
-                emp_dict['previous_total'] += week_info['previous_total']
-                emp_dict['previous_breaks'] += week_info['previous_breaks']
-                try:
-                    emp_dict['overtime'] += week_info['overtime']
-                except Exception as e:
-                    print(e)
-                if tt_settings['weekly_overtime_s']:
-                    emp_dict['weekly_overtime'] += week_info['weekly_overtime']
-                if tt_settings['daily_overtime_s']:
-                    emp_dict['daily_overtime'] += week_info['daily_overtime']
-                if tt_settings['double_time_s']:
-                    emp_dict['double_time'] += week_info['double_time']
-
-            emp_dict['regular'] = emp_dict['total'] - emp_dict['overtime']
+        return possible_weeks
+
+    def get_employee_timezone(self, employee):
+        if self.override_timezone:
+            return self.override_timezone
+        return get_timezone(employee.user)
+
+    def update_report_settings(self, return_dict, tt_settings):
+        """toggle true on daily, weekly overtimes and double time so they show up on reports if they are ever used."""
+        if not self.company_info.use_company_defaults_for_all_employees:
+            for i in ['daily_overtime_s', 'double_time_s', 'weekly_overtime_s', 'paid_breaks']:
+                if tt_settings[i]:
+                    return_dict[i] = tt_settings[i]
+
+    def create_employee_dict(self, employee, employee_timezone, weeks, tt_settings):
+        """Getting final totals for the employee"""
+        emp_dict = {
+            'name': capwords(employee.user.full_name),
+            'timezone': str(employee_timezone),
+            'weeks': weeks,
+            'paid_breaks': tt_settings['paid_breaks']
+        }
+        if self.form['other_hours_format'] == 'decimal':
+            emp_dict['total'] = 0.0
+            emp_dict['break'] = 0.0
+            emp_dict['overtime'] = 0.0
+            emp_dict['previous_total'] = 0.0
+            emp_dict['previous_breaks'] = 0.0
+            emp_dict['weekly_overtime'] = 0.0
+            emp_dict['daily_overtime'] = 0.0
+            emp_dict['double_time'] = 0.0
+        else:
+            emp_dict['total'] = 0
+            emp_dict['break'] = 0
+            emp_dict['overtime'] = 0
+            emp_dict['previous_total'] = 0
+            emp_dict['previous_breaks'] = 0
+            emp_dict['weekly_overtime'] = 0
+            emp_dict['daily_overtime'] = 0
+            emp_dict['double_time'] = 0
+
+        """ Get totals from the weeks compilied"""
+        for week_info in weeks:
+            emp_dict['total'] += week_info['total']
+            emp_dict['break'] += week_info['break']
+            emp_dict['previous_total'] += week_info['previous_total']
+            emp_dict['previous_breaks'] += week_info['previous_breaks']
+            try:
+                emp_dict['overtime'] += week_info['overtime']
+            except Exception as e:
+                print(e)
+            if tt_settings['weekly_overtime_s']:
+                emp_dict['weekly_overtime'] += week_info['weekly_overtime']
+            if tt_settings['daily_overtime_s']:
+                emp_dict['daily_overtime'] += week_info['daily_overtime']
             if tt_settings['double_time_s']:
-                emp_dict['regular'] = emp_dict['regular'] - emp_dict['double_time']
-            emp_dict['total_with_break'] = emp_dict['total'] + emp_dict['break']
+                emp_dict['double_time'] += week_info['double_time']
 
-            self.convert_to_string(
-                emp_dict, ['regular', 'total_with_break', 'total', 'previous_total',
-                           'previous_breaks', 'overtime', 'daily_overtime',
-                           'weekly_overtime', 'break'])
+        emp_dict['regular'] = emp_dict['total'] - emp_dict['overtime']
+        if tt_settings['double_time_s']:
+            emp_dict['regular'] = emp_dict['regular'] - emp_dict['double_time']
+        emp_dict['total_with_break'] = emp_dict['total'] + emp_dict['break']
+
+        self.convert_to_string(
+            emp_dict, ['regular', 'total_with_break', 'total', 'previous_total',
+                       'previous_breaks', 'overtime', 'daily_overtime',
+                       'weekly_overtime', 'break'])
+        return emp_dict
 
+    def add_report_totals(self, return_dict):
         """Getting the final values for the whole report"""
         if self.form['other_hours_format'] == 'decimal':
             return_dict['total'] = 0.0
@@ -386,14 +539,6 @@ class Report:
             return_dict['double_time'] = 0
             return_dict['total_with_break'] = 0
 
-        """Create string dates for the main dictionary"""
-        return_dict['previous_begin_date'] = self.full_beg_date.strftime('%m/%d/%y')
-        return_dict['begin_date'] = self.form['begin_date'].strftime('%m/%d/%y')
-        return_dict['end_date'] = self.form['end_date'].strftime('%m/%d/%y')
-        return_dict['todays_date'] = date.today().strftime('%m/%d/%y')
-        return_dict['previous_date_range'] = self.full_beg_date.strftime('%m/%d/%y') + ' - ' + (
-                self.form['begin_date'] - timedelta(days=1)).strftime('%m/%d/%y')
-
         """Cycle through all the employees and their times to get the report totals"""
         for final_employee in return_dict['employees']:
             return_dict['total'] += final_employee['total']
@@ -420,8 +565,15 @@ class Report:
                           'previous_breaks', 'overtime', 'daily_overtime',
                           'weekly_overtime', 'break'])
 
+    def add_report_dates(self, return_dict):
+        """Create string dates for the main dictionary"""
+        return_dict['previous_begin_date'] = self.full_beg_date.strftime('%m/%d/%y')
+        return_dict['begin_date'] = self.form['begin_date'].strftime('%m/%d/%y')
+        return_dict['end_date'] = self.form['end_date'].strftime('%m/%d/%y')
+        return_dict['todays_date'] = date.today().strftime('%m/%d/%y')
+        return_dict['previous_date_range'] = self.full_beg_date.strftime('%m/%d/%y') + ' - ' + (
+                self.form['begin_date'] - timedelta(days=1)).strftime('%m/%d/%y')
         return_dict['auto_inserted'] = self.auto_inserted
-        return return_dict
 
     def get_tt_settings(self, employee):
         """
@@ -461,7 +613,7 @@ class Report:
 
     def organize_days_weeks(self, employee, employee_timezone, possible_weeks, tt_settings):
         """Organize Time Actions into days, and weeks"""
-        employee_actions = self.time_actions_list.filter(user=employee.user)
+        employee_actions = self.get_employee_actions(employee)
         cur_time = datetime.utcnow().astimezone(employee_timezone)
         day_info = {}
         days = []
@@ -524,27 +676,47 @@ class Report:
             day_info['previous'] = False
         return day_info
 
+    def get_next_starts(self, employee_actions):
+        """Finds the start of the next action of the same type for every action in one pass from the back.
+            Actions without an end use it as their predicted end."""
+        next_starts = [None] * len(employee_actions)
+        following_start = {}
+        for index in range(len(employee_actions) - 1, -1, -1):
+            time_action = employee_actions[index]
+            next_starts[index] = following_start.get(time_action.type)
+            following_start[time_action.type] = time_action.start
+        return next_starts
+
     def organize_employee_actions(self, cur_time, employee_actions, employee_timezone):
         """Organize action and handle for special cases like missing end dates or the start date and end date are on two different days."""
         action_objs = []
-        employee_action_length = len(employee_actions)
-        for index, time_action in enumerate(employee_actions):
-            # handle if time action doesn't have an end date.
-            action_id = encrypt_id(time_action.id)
-            start = time_action.start
-            end = time_action.end
+        employee_actions = list(employee_actions)
+        next_starts = self.get_next_starts(employee_actions)
+        action_ids = encrypt_ids([time_action.id for time_action in employee_actions])
+        for time_action, next_start, action_id in zip(employee_actions, next_starts, action_ids):
             type = time_action.type
             total_time = time_action.total_time
             comment = time_action.comment
 
             # convert the times to the employees timezone or the company timezone if selected.
-            start = start.astimezone(employee_timezone)
-            if end:
-                end = end.astimezone(employee_timezone)
+            start = time_action.start.astimezone(employee_timezone)
+            if time_action.end:
+                end = time_action.end.astimezone(employee_timezone)
+                predicted = False
+            elif next_start:
+                # handle if time action doesn't have an end date, the next action of the same type ends it.
+                end = next_start.astimezone(employee_timezone)
+                predicted = True
+            else:
+                end = None
+                predicted = True
 
-            if start and end:
+            if end:
                 if start.date() == end.date():
-                    action_objs.append(self.create_action_entry(action_id, type, start, end, comment, None, False, False, total_time))
+                    action_objs.append(
+                        self.create_action_entry(action_id, type, start, end, comment, None, False, predicted, total_time))
+                    if predicted:
+                        self.auto_inserted = True
                 else:
                     # the start and end dates are on two different days, we need to split at midnight
                     end2 = datetime.combine(start.date(), datetime.max.time()).replace(tzinfo=employee_timezone)
@@ -552,53 +724,26 @@ class Report:
                     action_objs.append(
                         self.create_action_entry(action_id, type, start, end2, comment, '(Midnight Split)', False, True))
                     action_objs.append(
-                        self.create_action_entry(action_id, type, start2, end, comment, '(Midnight Split)', True, False))
+                        self.create_action_entry(action_id, type, start2, end, comment, '(Midnight Split)', True, predicted))
                     self.auto_inserted = True
-            elif not end:
-                temp_pos = index + 1
-                while temp_pos < employee_action_length:
-                    if type == employee_actions[temp_pos].type:
-                        end = employee_actions[temp_pos].start.astimezone(employee_timezone)
-                        break
-                    temp_pos += 1
-                if end:
-                    if start.date() == end.date():
-                        action_objs.append(
-                            self.create_action_entry(action_id, type, start, end, comment, None, False, True, total_time))
-                        self.auto_inserted = True
-                    else:
-                        # the start and end dates are on two different days, we need to split at midnight
-                        end2 = datetime.combine(start.date(), datetime.max.time()).replace(tzinfo=employee_timezone)
-                        start2 = datetime.combine(end.date(), datetime.min.time()).replace(tzinfo=employee_timezone)
-                        action_objs.append(
-                            self.create_action_entry(action_id, type, start, end2, comment, '(Midnight Split)', False,
-                                                     True))
-                        action_objs.append(
-                            self.create_action_entry(action_id, type, start2, end, comment, '(Midnight Split)', True,
-                                                     True))
-                        self.auto_inserted = True
-                else:
-                    if start.date() == cur_time.date():
-                        # use the cur time as the temporary end
-                        end = cur_time
-                        action_objs.append(
-                            self.create_action_entry(action_id, type, start, end, comment, None, False, False))
-                    else:
-                        # the end date doesn't exist and the current date is not set. so lets generate two actions. one for the end of the day and one for the current day.
-                        end_time = datetime.max.time()
-                        end = datetime.combine(start.date(), end_time).replace(tzinfo=employee_timezone)
-                        end2 = datetime.combine(cur_time.date(), end_time).replace(tzinfo=employee_timezone)
-                        start2 = datetime.combine(cur_time.date(), datetime.min.time()).replace(
-                            tzinfo=employee_timezone)
-                        action_objs.append(
-                            self.create_action_entry(action_id, type, start, end, comment, '(Midnight Split With Predicted End Date)', False,
-                                                     True))
-                        action_objs.append(
-                            self.create_action_entry(action_id, type, start2, end2, comment, '(Midnight Split With Predicted End Date)', True,
-                                                     True))
-                        self.auto_inserted = True
+            elif start.date() == cur_time.date():
+                # use the cur time as the temporary end
+                action_objs.append(
+                    self.create_action_entry(action_id, type, start, cur_time, comment, None, False, False))
             else:
-                print("We shouldn't have gotten here")
+                # the end date doesn't exist and the current date is not set. so lets generate two actions. one for the end of the day and one for the current day.
+                end_time = datetime.max.time()
+                end = datetime.combine(start.date(), end_time).replace(tzinfo=employee_timezone)
+                end2 = datetime.combine(cur_time.date(), end_time).replace(tzinfo=employee_timezone)
+                start2 = datetime.combine(cur_time.date(), datetime.min.time()).replace(tzinfo=employee_timezone)
+                action_objs.append(
+                    self.create_action_entry(action_id, type, start, end, comment, '(Midnight Split With Predicted End Date)', False,
+                                             True))
+                action_objs.append(
+                    self.create_action_entry(action_id, type, start2, end2, comment, '(Midnight Split With Predicted End Date)', True,
+                                             True))
+                self.auto_inserted = True
+        # the actions are nearly in order already so the sort only has to move the split halves
         return sorted(action_objs, key=lambda x: x['start'])
 
     def create_action_entry(self, action_id, type, start, end, comment, additional_text, temp_start, temp_end, total_time=None):
@@ -0,0 +1,91 @@
+import hashlib
+import json
+import logging
+from datetime import date, timedelta
+
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+from middleware.timezone import get_timezone
+from .models import TTReportCache, TTReportDataVersion
+from .report import get_employee_list, get_report_timezone
+
+logger = logging.getLogger("django.request")
+
+# counted per process, reset when the process restarts
+report_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+
+def get_report_cache_key(user, form, override_timezone=None):
+    """Hashes everything the rendered report depends on: the company and its name, the report options, the employees
+        with their names, timezones and data versions, and today's date which is printed on the report.
+        Returns None when the report can't be cached, either the cache is off or the report reaches today where
+        open time actions still grow."""
+    if not settings.REPORT_CACHE_MAX_ENTRIES or form['end_date'] >= date.today() - timedelta(days=1):
+        return None
+    override_timezone = get_report_timezone(user, override_timezone)
+    employee_list, employee_id_list = get_employee_list(user.company, form['selected_employees_list'])
+    versions = dict(TTReportDataVersion.objects.filter(user_id__in=employee_id_list).values_list('user_id', 'version'))
+
+    key_data = {
+        'company': [user.company_id, user.company.name],
+        'form': normalize_report_form(form),
+        'employees': [[employee.user_id, employee.user.full_name, str(get_timezone(employee.user)),
+                       versions.get(employee.user_id, 0)] for employee in employee_list],
+        'timezone': str(override_timezone) if override_timezone else '',
+        'today': str(date.today()),
+    }
+    return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode()).hexdigest()
+
+
+def normalize_report_form(form):
+    """The cleaned ReportsForm data as strings, lists are sorted so the order of the checkboxes doesn't matter"""
+    normalized = {}
+    for key, value in form.items():
+        if isinstance(value, (list, tuple)):
+            normalized[key] = sorted(str(i) for i in value)
+        else:
+            normalized[key] = str(value)
+    return normalized
+
+
+def get_cached_report(cache_key):
+    """Returns the TTReportCache of the key and marks it as used, None on a miss"""
+    if cache_key is None:
+        return None
+    cached = TTReportCache.objects.select_related('report').filter(key=cache_key).first()
+    if cached is None:
+        report_cache_stats['misses'] += 1
+        return None
+    report_cache_stats['hits'] += 1
+    TTReportCache.objects.filter(id=cached.id).update(hits=F('hits') + 1, last_used=timezone.now())
+    return cached
+
+
+def store_cached_report(cache_key, company, report, report_path, size):
+    """Remembers a freshly uploaded report and evicts the least recently used ones that don't fit anymore"""
+    if cache_key is None:
+        return None
+    cached, created = TTReportCache.objects.update_or_create(
+        key=cache_key, defaults={'company': company, 'report': report, 'report_path': report_path, 'size': size,
+                                 'last_used': timezone.now()})
+    evict_report_cache()
+    return cached
+
+
+def evict_report_cache():
+    """Keeps the newest entries within REPORT_CACHE_MAX_ENTRIES and REPORT_CACHE_MAX_SIZE.
+        The TTReports and the pdf stay, only the cache entry is removed."""
+    entries = 0
+    total_size = 0
+    evict = []
+    for cache_id, size in TTReportCache.objects.order_by('-last_used', '-id').values_list('id', 'size'):
+        entries += 1
+        total_size += size
+        if entries > settings.REPORT_CACHE_MAX_ENTRIES or total_size > settings.REPORT_CACHE_MAX_SIZE:
+            evict.append(cache_id)
+    if evict:
+        TTReportCache.objects.filter(id__in=evict).delete()
+        report_cache_stats['evictions'] += len(evict)
+    return len(evict)
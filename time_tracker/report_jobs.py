@@ -0,0 +1,232 @@
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.datastructures import MultiValueDict
+
+from daxApp.encryption import encrypt_id
+from users.utils import send_user_message
+from .forms import ReportsForm
+from .models import TTReportJob
+from .report import create_report, render_report_pdf, upload_report, copy_report, get_report_link
+from .report_cache import get_report_cache_key, get_cached_report, store_cached_report
+from . import report_worker
+
+logger = logging.getLogger("django.request")
+
+REPORT_JOB_LINK_EXPIRATION = 60 * 60 * 24     # 1 day, the link is sent before the user is looking at it
+
+_executor = None
+_executor_lock = threading.Lock()
+_event_queue = None     # only set inside the worker processes
+
+
+def submit_report_job(user, data):
+    """Queues a report for the report workers and returns the TTReportJob immediately.
+        data is the submitted ReportsForm data, it should already be validated."""
+    form_data = {key: data.getlist(key) for key in data if key != 'csrfmiddlewaretoken'}
+    job = TTReportJob.objects.create(user=user, form_data=form_data)
+    transaction.on_commit(lambda: dispatch_report_job(job.id))
+    return job
+
+
+def dispatch_report_job(job_id):
+    """Hands the job to the worker pool, with no worker processes configured the job runs right away.
+        A broken pool (a worker was killed) is replaced once, the job fails if the new pool can't take it either."""
+    if not settings.REPORT_WORKER_PROCESSES:
+        run_report_job(job_id)
+        return
+    for attempt in range(2):
+        executor = get_report_executor()
+        try:
+            future = executor.submit(report_worker.run_report_job, job_id)
+        except (BrokenProcessPool, RuntimeError) as e:
+            logger.error('Failed to submit report job ' + str(job_id))
+            logger.error(e)
+            reset_report_executor(executor)
+            continue
+        future.add_done_callback(lambda done: check_report_future(job_id, done))
+        return
+    fail_lost_report_job(job_id, 'The report could not be started, please try again')
+
+
+def check_report_future(job_id, future):
+    """Fails the job when its worker died before it finished, a job that fails on its own is already marked failed"""
+    error = future.exception()
+    if error is None:
+        return
+    logger.error('Report job ' + str(job_id) + ' was lost')
+    logger.error(error)
+    if isinstance(error, BrokenProcessPool):
+        reset_report_executor()
+    fail_lost_report_job(job_id, 'Something went wrong while generating the report')
+
+
+def get_report_executor():
+    """Starts the worker pool the first time it is needed, the jobs the last pools lost are failed then.
+        The workers can't reach the channel layer of this process so their events are relayed by a thread."""
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            return _executor
+        context = multiprocessing.get_context('spawn')
+        event_queue = context.Queue()
+        _executor = executor = ProcessPoolExecutor(max_workers=settings.REPORT_WORKER_PROCESSES, mp_context=context,
+                                                   initializer=report_worker.init_report_worker,
+                                                   initargs=(event_queue,))
+        threading.Thread(target=relay_report_events, args=(event_queue,), daemon=True).start()
+    fail_stale_report_jobs()
+    return executor
+
+
+def reset_report_executor(executor=None):
+    """Drops the pool, or only that pool if it is still the current one, the next job starts a new one"""
+    global _executor
+    with _executor_lock:
+        if _executor is None or (executor is not None and _executor is not executor):
+            return
+        executor, _executor = _executor, None
+    executor.shutdown(wait=False, cancel_futures=True)
+
+
+def fail_lost_report_job(job_id, error):
+    job = TTReportJob.objects.filter(id=job_id, status__in=('q', 'r')).select_related('user').first()
+    if job is not None:
+        fail_report_job(job, error)
+
+
+def is_stale_report_job(job):
+    """A queued or running job that hasn't moved for REPORT_JOB_TIMEOUT seconds, the process that had it is gone"""
+    return job.status in ('q', 'r') and job.updated_date is not None and \
+        job.updated_date < timezone.now() - timedelta(seconds=settings.REPORT_JOB_TIMEOUT)
+
+
+def fail_stale_report_jobs():
+    """Fails the stale jobs of every process, they only ever lived in a worker pool. Returns how many were failed."""
+    stale = TTReportJob.objects.filter(
+        status__in=('q', 'r'), updated_date__lt=timezone.now() - timedelta(seconds=settings.REPORT_JOB_TIMEOUT))
+    failed = 0
+    for job in stale.select_related('user'):
+        fail_report_job(job, 'The report was interrupted, please try again')
+        failed += 1
+    return failed
+
+
+def set_event_queue(event_queue):
+    """Called in the worker processes, their events are put on the queue for the web process to send"""
+    global _event_queue
+    _event_queue = event_queue
+
+
+def relay_report_events(event_queue):
+    while True:
+        user_id, data = event_queue.get()
+        try:
+            send_user_message(user_id, data)
+        except Exception as e:
+            logger.error('Failed to send a report job event to user ' + str(user_id))
+            logger.error(e)
+
+
+def publish_report_event(job, data):
+    if _event_queue is not None:
+        _event_queue.put((job.user_id, data))
+    else:
+        send_user_message(job.user_id, data)
+
+
+def update_report_job(job, status, progress, **fields):
+    """Saves the job's state and lets the user know how far along it is"""
+    job.status = status
+    job.progress = progress
+    for key in fields:
+        setattr(job, key, fields[key])
+    job.save()
+    publish_report_event(job, {
+        'type': 'report_progress',
+        'job_id': encrypt_id(job.id),
+        'status': job.status,
+        'status_text': job.get_status_display(),
+        'progress': job.progress,
+    })
+
+
+def run_report_job(job_id):
+    """Builds, renders and uploads the report of a queued job. Runs inside the worker processes."""
+    job = TTReportJob.objects.select_related('user', 'user__company').get(id=job_id)
+    user = job.user
+    try:
+        update_report_job(job, 'r', 10)
+        original_form = ReportsForm(MultiValueDict(job.form_data), company=user.company, user=user)
+        if not original_form.is_valid():
+            fail_report_job(job, 'The report options were invalid')
+            return job
+        form = original_form.cleaned_data
+
+        cache_key = get_report_cache_key(user, form)
+        cached = get_cached_report(cache_key)
+        if cached is not None and cached.report.user_id == user.id:
+            report, report_path = cached.report, cached.report_path
+        elif cached is not None:
+            # the same report of someone else in the company, they keep theirs
+            report, report_path = copy_report(user, cached.report, cached.report_path)
+        else:
+            page, page_arguments = create_report(user, form)
+            if page is None:
+                fail_report_job(job, 'No employees selected')
+                return job
+            update_report_job(job, 'r', 50)
+
+            with render_report_pdf(page, page_arguments) as pdf_file:
+                update_report_job(job, 'r', 80)
+                size = pdf_file.seek(0, 2)
+                pdf_file.seek(0)
+                report, report_path = upload_report(user, form, page_arguments, pdf_file)
+            store_cached_report(cache_key, user.company, report, report_path, size)
+        link = get_report_link(report_path, REPORT_JOB_LINK_EXPIRATION)
+        update_report_job(job, 'c', 100, report=report, report_path=report_path)
+        publish_report_event(job, {
+            'type': 'notification',
+            'title': 'Report ready',
+            'message': report.report_name,
+            'link': link,
+            'actions': [{'text': 'Download', 'color': '', 'link': link}]
+        })
+    except Exception as e:
+        logger.error('Report job ' + str(job.id) + ' failed')
+        logger.error(e)
+        fail_report_job(job, 'Something went wrong while generating the report')
+    return job
+
+
+def fail_report_job(job, error):
+    update_report_job(job, 'f', 100, error=error)
+    publish_report_event(job, {
+        'type': 'notification',
+        'title': 'Report failed',
+        'message': error,
+        'actions': []
+    })
+
+
+def get_report_job_status(job):
+    """The current state of a job for clients that poll instead of listening on the websocket"""
+    if is_stale_report_job(job):
+        fail_report_job(job, 'The report was interrupted, please try again')
+    status = {
+        'job_id': encrypt_id(job.id),
+        'status': job.status,
+        'status_text': job.get_status_display(),
+        'progress': job.progress,
+        'error': job.error,
+        'link': '',
+    }
+    if job.status == 'c' and job.report_path:
+        status['link'] = get_report_link(job.report_path)
+    return status
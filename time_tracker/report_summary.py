@@ -0,0 +1,119 @@
+from datetime import datetime
+
+from django.db.models import Case, Count, F, FloatField, OuterRef, Q, Subquery, Sum, When
+from django.db.models.functions import Abs, Floor, Mod, Round, TruncDate
+from django.db.models.lookups import GreaterThan, LessThan
+
+from .report import Report, SECONDS_IN_HOUR, group_actions_by_user
+
+# python's round(hours, 2) rounds the exact binary value of the hours, the database can't tell which way a hundredth
+# that is this close to a half goes
+HALF_TOLERANCE = 1e-9
+
+
+class SummaryReport(Report):
+    """Builds the Summary Report from totals the database adds up per employee, local day and type.
+
+        Only actions that are still open, span midnight, have no total_time or would be rounded from near a half are
+        loaded and organized in python, the same way the detailed report does it. Every action is rounded before it is summed just like the detailed
+        report so both reports give the same totals."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._day_totals_by_user = None
+
+    def get_employee_chunks(self):
+        # the database already did the heavy lifting, there is nothing to gain from worker processes
+        return [list(self.employee_list)]
+
+    def create_employee_dict(self, employee, employee_timezone, weeks, tt_settings):
+        emp_dict = super().create_employee_dict(employee, employee_timezone, weeks, tt_settings)
+        self.convert_to_string(emp_dict, ['double_time'])
+        return emp_dict
+
+    def add_report_totals(self, return_dict):
+        super().add_report_totals(return_dict)
+        self.convert_to_string(return_dict, ['double_time'])
+
+    def get_employee_actions(self, employee):
+        """Returns the day totals and the actions that couldn't be totaled by the database for the employee"""
+        if self._day_totals_by_user is None:
+            self._day_totals_by_user = self.load_day_totals()
+        return self._day_totals_by_user.get(employee.user_id, ([], []))
+
+    def load_day_totals(self):
+        """Runs the aggregate queries, one for the day totals and one for the leftover actions per timezone"""
+        if not hasattr(self.time_actions_list, 'filter'):
+            # the range reaches into the archive and the actions are already loaded, they are all organized in python
+            return {user_id: ([], actions) for user_id, actions in group_actions_by_user(self.time_actions_list).items()}
+        employees_by_timezone = {}
+        for employee in self.employee_list:
+            employee_timezone = self.get_employee_timezone(employee)
+            employees_by_timezone.setdefault(str(employee_timezone), (employee_timezone, []))[1].append(employee.user_id)
+
+        day_totals_by_user = {}
+        for employee_timezone, user_ids in employees_by_timezone.values():
+            time_actions = self.time_actions_list.filter(user__in=user_ids).annotate(
+                local_start=TruncDate('start', tzinfo=employee_timezone),
+                local_end=TruncDate('end', tzinfo=employee_timezone))
+            same_day = Q(end__isnull=False, total_time__gt=0, local_start=F('local_end'))
+            if self.form['other_hours_format'] == 'decimal':
+                # the actions near a half are rounded by create_action_entry with the leftover actions
+                hundredths = F('total_time') * 100 / float(SECONDS_IN_HOUR)
+                time_actions = time_actions.annotate(half_distance=Abs(hundredths - Floor(hundredths) - 0.5))
+                same_day &= Q(half_distance__gt=HALF_TOLERANCE)
+
+            day_totals = time_actions.filter(same_day).order_by().values('user_id', 'local_start', 'type').annotate(
+                total=Sum(self.get_rounded_total()), action_count=Count('id'))
+            for row in day_totals:
+                day_totals_by_user.setdefault(row['user_id'], ([], []))[0].append(row)
+
+            next_start = self.time_actions_list.filter(
+                user=OuterRef('user'), type=OuterRef('type'),
+                action_lookup_datetime__gt=OuterRef('action_lookup_datetime')).order_by('action_lookup_datetime')
+            other_actions = time_actions.exclude(same_day).annotate(
+                next_start=Subquery(next_start.values('start')[:1])).order_by('user', 'action_lookup_datetime')
+            for time_action in other_actions:
+                day_totals_by_user.setdefault(time_action.user_id, ([], []))[1].append(time_action)
+        return day_totals_by_user
+
+    def get_rounded_total(self):
+        """The total of a single action rounded the way create_action_entry rounds it"""
+        if self.form['other_hours_format'] == 'decimal':
+            # not near a half, rounding up or to even gives the same hundredth
+            return Round(F('total_time') / float(SECONDS_IN_HOUR), 2, output_field=FloatField())
+        # the steps are worked out with the same float operations as create_action_entry
+        rounding = int(self.form['other_rounding'])
+        return self.round_half_even(F('total_time') / float(SECONDS_IN_HOUR) * 60 / rounding) * rounding
+
+    def round_half_even(self, steps):
+        """python rounds halves to the even number, the database would round them up"""
+        lower = Floor(steps)
+        return Case(
+            When(GreaterThan(steps - lower, 0.5), then=lower + 1),
+            When(LessThan(steps - lower, 0.5), then=lower),
+            default=lower + Mod(lower, 2),
+            output_field=FloatField())
+
+    def get_next_starts(self, employee_actions):
+        if not hasattr(self.time_actions_list, 'filter'):
+            return super().get_next_starts(employee_actions)
+        # the next start of the same type was looked up by the database
+        return [time_action.next_start for time_action in employee_actions]
+
+    def organize_employee_actions(self, cur_time, employee_actions, employee_timezone):
+        """Turns the day totals into one entry per day and type, the leftover actions are organized like the detailed
+            report does it. The entries only carry what calc_day_totals needs."""
+        day_totals, other_actions = employee_actions
+        action_objs = super().organize_employee_actions(cur_time, other_actions, employee_timezone)
+        for row in day_totals:
+            total = row['total']
+            if self.form['other_hours_format'] != 'decimal':
+                # whole minutes, the database hands them back as floats
+                total = int(round(total))
+            action_objs.append({
+                'type': row['type'],
+                'start': datetime.combine(row['local_start'], datetime.min.time()).replace(tzinfo=employee_timezone),
+                'total': total,
+            })
+        return sorted(action_objs, key=lambda x: x['start'])
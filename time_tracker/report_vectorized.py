@@ -0,0 +1,330 @@
+from datetime import datetime, timedelta
+from string import capwords
+
+import numpy as np
+
+from .report import Report
+
+CALIFORNIA_DOUBLE_TIME_HOURS = 8
+DAYS_IN_WEEK = 7
+
+
+def segment_sums(values, segment_ids, positions, segment_count):
+    """Sums values by segment, each segment is summed from left to right.
+
+        The values are laid out in a segment_count x longest segment matrix and reduced with cumsum, which adds in
+        order just like the python report does, so floating point results are identical to it."""
+    if not len(values):
+        return np.zeros(segment_count, dtype=values.dtype)
+    matrix = np.zeros((segment_count, positions.max() + 1), dtype=values.dtype)
+    matrix[segment_ids, positions] = values
+    return np.cumsum(matrix, axis=1)[:, -1]
+
+
+def total_sum(values):
+    """Sums all the values from left to right"""
+    if not len(values):
+        return values.dtype.type(0)
+    return np.cumsum(values)[-1]
+
+
+def split_segments(keys):
+    """Takes a sorted array of keys and returns the segment id of every entry, the position of every entry inside its
+    segment and the index where every segment starts."""
+    if not len(keys):
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+    starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+    segment_ids = np.cumsum(np.concatenate(([False], keys[1:] != keys[:-1])))
+    positions = np.arange(len(keys)) - starts[segment_ids]
+    return segment_ids, positions, starts
+
+
+class VectorizedReport(Report):
+    """Creates the same report as Report but calculates the day, week, employee and grand totals with numpy.
+
+    The actions of every employee are stored in flat arrays (employee, day, type and rounded total) and every total is
+    a segment reduction over those arrays, so the cost of the overtime rules no longer grows with python loops over
+    each day and week."""
+
+    def create_report_dict(self):
+        return_dict = self.create_report_header()
+        possible_weeks = self.get_possible_weeks()
+        if self.form['other_hours_format'] == 'decimal':
+            self.dtype = np.float64
+            self.hours_factor = 1
+        else:
+            self.dtype = np.int64
+            self.hours_factor = 60
+
+        employees = []
+        action_objs = []
+        action_employees = []
+        settings = []
+        for index, employee in enumerate(self.employee_list):
+            employee_timezone = self.get_employee_timezone(employee)
+            tt_settings = self.get_tt_settings(employee)
+            self.update_report_settings(return_dict, tt_settings)
+
+            cur_time = datetime.utcnow().astimezone(employee_timezone)
+            employee_action_objs = self.organize_employee_actions(cur_time, self.get_employee_actions(employee),
+                                                                  employee_timezone)
+            for time_action in employee_action_objs:
+                if self.full_beg_date <= time_action['start'].date() <= self.full_end_date:
+                    action_objs.append(time_action)
+                    action_employees.append(index)
+            employees.append((employee, employee_timezone))
+            settings.append(tt_settings)
+
+        self.load_settings(settings)
+        self.load_actions(action_objs, action_employees)
+        self.calc_day_totals_vectorized()
+        self.calc_week_totals_vectorized()
+        self.calc_employee_totals_vectorized(len(employees))
+
+        return_dict['employees'] = self.build_employee_dicts(employees, settings, action_objs, possible_weeks)
+        self.add_report_totals(return_dict)
+        self.add_report_dates(return_dict)
+        return return_dict
+
+    def load_settings(self, settings):
+        """Turns the employee settings into arrays indexed by the employee position in the report"""
+
+        def setting_array(name, dtype):
+            return np.array([tt_settings[name] or 0 for tt_settings in settings], dtype=dtype)
+
+        self.daily_overtime_s = setting_array('daily_overtime_s', bool)
+        self.double_time_s = setting_array('double_time_s', bool)
+        self.weekly_overtime_s = setting_array('weekly_overtime_s', bool)
+        self.california_overtime_s = setting_array('california_overtime_s', bool)
+        self.include_breaks = setting_array('include_breaks_in_overtime_calculation', bool)
+        self.daily_overtime_value = setting_array('daily_overtime_value', np.int64) * self.hours_factor
+        self.double_time_value = setting_array('double_time_value', np.int64) * self.hours_factor
+        self.weekly_overtime_value = setting_array('weekly_overtime_value', np.int64) * self.hours_factor
+
+    def load_actions(self, action_objs, action_employees):
+        """Stores the actions as arrays and works out which day and week every action belongs to.
+            Actions are already ordered by employee and start so days and weeks are contiguous segments."""
+        beg_ordinal = self.full_beg_date.toordinal()
+        self.action_employee = np.array(action_employees, dtype=np.int64)
+        self.action_start = np.array([a['start'].timestamp() for a in action_objs], dtype=np.float64)
+        self.action_end = np.array([a['end'].timestamp() for a in action_objs], dtype=np.float64)
+        self.action_is_time = np.array([a['type'] == 't' for a in action_objs], dtype=bool)
+        self.action_total = np.array([a['total'] for a in action_objs], dtype=self.dtype)
+        action_day = np.array([a['start'].date().toordinal() - beg_ordinal for a in action_objs], dtype=np.int64)
+
+        # segment the actions into days, an employee can't have more than 10^5 days in a single report
+        day_key = self.action_employee * 100000 + action_day
+        self.action_day_id, self.action_day_position, day_starts = split_segments(day_key)
+        self.day_count = len(day_starts)
+        self.day_employee = self.action_employee[day_starts]
+        self.day_ordinal = action_day[day_starts]
+        self.day_previous = (self.day_ordinal + beg_ordinal) < self.form['begin_date'].toordinal()
+
+        # segment the days into weeks
+        self.day_week_number = self.day_ordinal // DAYS_IN_WEEK
+        week_key = self.day_employee * 100000 + self.day_week_number
+        self.day_week_id, self.day_week_position, week_starts = split_segments(week_key)
+        self.week_count = len(week_starts)
+        self.week_employee = self.day_employee[week_starts]
+        self.week_number = self.day_week_number[week_starts]
+        self.week_position = np.zeros(self.week_count, dtype=np.int64)
+        if self.week_count:
+            self.week_position = np.arange(self.week_count) - np.searchsorted(self.week_employee, self.week_employee)
+
+    def calc_day_totals_vectorized(self):
+        """The vectorized version of calc_day_totals and the california 7th day check in add_day"""
+        zero = self.dtype(0)
+        days = (self.action_day_id, self.action_day_position, self.day_count)
+        self.day_total = segment_sums(np.where(self.action_is_time, self.action_total, -self.action_total), *days)
+        self.day_break = segment_sums(np.where(self.action_is_time, zero, self.action_total), *days)
+
+        # the 7th day of a week qualifies when the 6 days before it in the same week have at least 8 hours each
+        hours = CALIFORNIA_DOUBLE_TIME_HOURS * self.hours_factor
+        short_days = np.cumsum(np.concatenate(([0], self.day_total < hours)))
+        index = np.arange(self.day_count)
+        seventh_day = self.day_week_position == DAYS_IN_WEEK - 1
+        short_before = short_days[index] - short_days[np.maximum(index - (DAYS_IN_WEEK - 1), 0)]
+        cali_qualified = self.california_overtime_s[self.day_employee] & seventh_day & (short_before == 0)
+
+        daily_overtime_s = self.daily_overtime_s[self.day_employee]
+        actual_time = np.where(self.include_breaks[self.day_employee], self.day_total + self.day_break,
+                               self.day_total)
+
+        cal_overtime = self.dtype(CALIFORNIA_DOUBLE_TIME_HOURS * self.hours_factor)
+        cal_full = cali_qualified & (actual_time >= cal_overtime)
+        double_time = np.where(cal_full, cal_overtime, np.where(cali_qualified, actual_time, zero))
+        actual_time = np.where(cal_full, actual_time - cal_overtime, np.where(cali_qualified, zero, actual_time))
+
+        daily_overtime_value = self.daily_overtime_value[self.day_employee]
+        overtime = np.where(actual_time > daily_overtime_value, actual_time - daily_overtime_value, zero)
+        double_time_value = self.double_time_value[self.day_employee]
+        over_double = self.double_time_s[self.day_employee] & (actual_time > double_time_value)
+        double_time = np.where(over_double, actual_time - double_time_value, double_time)
+        overtime = np.where(over_double, overtime - double_time, overtime)
+
+        self.day_overtime = np.where(daily_overtime_s, overtime, zero)
+        self.day_double_time = np.where(daily_overtime_s, double_time, zero)
+        self.day_daily_overtime = self.day_overtime
+        # the python report keeps the california double time as a whole number of hours in the decimal format
+        self.day_double_time_is_int = daily_overtime_s & cal_full & ~over_double & (self.hours_factor == 1)
+        self.day_total_with_break = self.day_total + self.day_break
+
+    def calc_week_totals_vectorized(self):
+        """The vectorized version of add_week"""
+        zero = self.dtype(0)
+        weeks = (self.day_week_id, self.day_week_position, self.week_count)
+        previous = self.day_previous
+
+        def week_sum(values, use_previous):
+            return segment_sums(np.where(previous == use_previous, values, zero), *weeks)
+
+        daily_overtime_s = self.daily_overtime_s[self.week_employee]
+        double_time_s = self.double_time_s[self.week_employee] & daily_overtime_s
+
+        self.week_total = week_sum(self.day_total, False)
+        self.week_break = week_sum(self.day_break, False)
+        self.week_previous_total = week_sum(self.day_total, True)
+        self.week_previous_breaks = week_sum(self.day_break, True)
+        self.week_daily_overtime = np.where(daily_overtime_s, week_sum(self.day_overtime, False), zero)
+        self.week_previous_daily_overtime = np.where(daily_overtime_s, week_sum(self.day_overtime, True), zero)
+        self.week_double_time = np.where(double_time_s, week_sum(self.day_double_time, False), zero)
+        self.week_previous_double_time = np.where(double_time_s, week_sum(self.day_double_time, True), zero)
+
+        actual_time = self.week_total + self.week_previous_total
+        actual_time = np.where(self.include_breaks[self.week_employee],
+                               actual_time + self.week_break + self.week_previous_breaks, actual_time)
+        actual_time = np.where(
+            double_time_s,
+            actual_time - self.week_daily_overtime - self.week_double_time - self.week_previous_daily_overtime -
+            self.week_previous_double_time,
+            np.where(daily_overtime_s, actual_time - self.week_daily_overtime - self.week_previous_daily_overtime,
+                     actual_time))
+
+        weekly_overtime_value = self.weekly_overtime_value[self.week_employee]
+        over_weekly = self.weekly_overtime_s[self.week_employee] & (actual_time > weekly_overtime_value)
+        self.week_weekly_overtime = np.where(over_weekly, actual_time - weekly_overtime_value, zero)
+        self.week_overtime = np.where(over_weekly, self.week_daily_overtime + self.week_weekly_overtime,
+                                      self.week_daily_overtime)
+
+        self.week_regular = self.week_total - self.week_overtime
+        self.week_regular = np.where(self.double_time_s[self.week_employee],
+                                     self.week_regular - self.week_double_time, self.week_regular)
+        self.week_total_with_break = self.week_total + self.week_break
+
+    def calc_employee_totals_vectorized(self, employee_count):
+        """The vectorized version of the employee totals in create_employee_dict"""
+        zero = self.dtype(0)
+        employees = (self.week_employee, self.week_position, employee_count)
+        self.employee_total = segment_sums(self.week_total, *employees)
+        self.employee_break = segment_sums(self.week_break, *employees)
+        self.employee_previous_total = segment_sums(self.week_previous_total, *employees)
+        self.employee_previous_breaks = segment_sums(self.week_previous_breaks, *employees)
+        self.employee_overtime = segment_sums(self.week_overtime, *employees)
+        self.employee_weekly_overtime = np.where(self.weekly_overtime_s,
+                                                 segment_sums(self.week_weekly_overtime, *employees), zero)
+        self.employee_daily_overtime = np.where(self.daily_overtime_s,
+                                                segment_sums(self.week_daily_overtime, *employees), zero)
+        self.employee_double_time = np.where(self.double_time_s,
+                                             segment_sums(self.week_double_time, *employees), zero)
+        self.employee_regular = self.employee_total - self.employee_overtime
+        self.employee_regular = np.where(self.double_time_s, self.employee_regular - self.employee_double_time,
+                                         self.employee_regular)
+        self.employee_total_with_break = self.employee_total + self.employee_break
+
+    def build_employee_dicts(self, employees, settings, action_objs, possible_weeks):
+        """Turns the calculated arrays back into the dictionaries the report templates expect"""
+        day_fields = ['total', 'break', 'overtime', 'daily_overtime', 'double_time', 'total_with_break']
+        week_fields = ['total', 'regular', 'break', 'total_with_break', 'overtime', 'previous_total',
+                       'previous_breaks', 'weekly_overtime', 'double_time', 'daily_overtime',
+                       'previous_daily_overtime', 'previous_double_time']
+        employee_fields = ['total', 'break', 'overtime', 'previous_total', 'previous_breaks', 'weekly_overtime',
+                           'daily_overtime', 'double_time', 'regular', 'total_with_break']
+
+        day_values = {name: getattr(self, 'day_' + name).tolist() for name in day_fields}
+        day_double_time_is_int = self.day_double_time_is_int.tolist()
+        day_previous = self.day_previous.tolist()
+        day_ordinal = self.day_ordinal.tolist()
+        day_action_counts = np.bincount(self.action_day_id, minlength=self.day_count).tolist()
+        week_values = {name: getattr(self, 'week_' + name).tolist() for name in week_fields}
+        week_number = self.week_number.tolist()
+        week_day_counts = np.bincount(self.day_week_id, minlength=self.week_count).tolist()
+        week_employee = self.week_employee.tolist()
+        employee_values = {name: getattr(self, 'employee_' + name).tolist() for name in employee_fields}
+
+        days = []
+        action_index = 0
+        for day in range(self.day_count):
+            day_info = {
+                'date': self.full_beg_date + timedelta(days=day_ordinal[day]),
+                'actions': action_objs[action_index:action_index + day_action_counts[day]],
+                'previous': day_previous[day],
+            }
+            action_index += day_action_counts[day]
+            for name in day_fields:
+                day_info[name] = day_values[name][day]
+            if day_double_time_is_int[day]:
+                day_info['double_time'] = CALIFORNIA_DOUBLE_TIME_HOURS
+            day_info['date_str'] = day_info['date'].strftime('%a %m/%d/%y')
+            self.convert_to_string(day_info, day_fields)
+            days.append(day_info)
+
+        employee_weeks = [[] for _ in employees]
+        day_index = 0
+        for week in range(self.week_count):
+            week_info = {
+                'begin_date': possible_weeks[week_number[week]]['start'].strftime('%m/%d/%y'),
+                'end_date': possible_weeks[week_number[week]]['end'].strftime('%m/%d/%y'),
+                'days': days[day_index:day_index + week_day_counts[week]],
+            }
+            day_index += week_day_counts[week]
+            for name in week_fields:
+                week_info[name] = week_values[name][week]
+            self.convert_to_string(week_info, ['regular', 'total_with_break', 'total', 'previous_total',
+                                               'previous_breaks', 'previous_daily_overtime',
+                                               'previous_double_time', 'overtime', 'daily_overtime',
+                                               'weekly_overtime', 'break'])
+            week_info['number'] = week_number[week] + 1
+            employee_weeks[week_employee[week]].append(week_info)
+
+        employee_dicts = []
+        for index, (employee, employee_timezone) in enumerate(employees):
+            emp_dict = {
+                'name': capwords(employee.user.full_name),
+                'timezone': str(employee_timezone),
+                'weeks': employee_weeks[index],
+                'paid_breaks': settings[index]['paid_breaks']
+            }
+            for name in employee_fields:
+                emp_dict[name] = employee_values[name][index]
+            self.convert_to_string(
+                emp_dict, ['regular', 'total_with_break', 'total', 'previous_total',
+                           'previous_breaks', 'overtime', 'daily_overtime',
+                           'weekly_overtime', 'break'])
+            employee_dicts.append(emp_dict)
+        return employee_dicts
+
+    def add_report_totals(self, return_dict):
+        """The vectorized version of the grand totals in Report.add_report_totals"""
+        zero = self.dtype(0)
+        paid_breaks = np.array([employee['paid_breaks'] for employee in return_dict['employees']], dtype=bool)
+        totals = {
+            'total': total_sum(self.employee_total),
+            'break': total_sum(self.employee_break),
+            'previous_total': total_sum(self.employee_previous_total),
+            'previous_breaks': total_sum(self.employee_previous_breaks),
+            'overtime': total_sum(self.employee_overtime),
+            'total_with_break': total_sum(np.where(paid_breaks, self.employee_total_with_break, self.employee_total)),
+            'weekly_overtime': total_sum(self.employee_weekly_overtime) if return_dict['weekly_overtime_s'] else zero,
+            'daily_overtime': total_sum(self.employee_daily_overtime) if return_dict['daily_overtime_s'] else zero,
+            'double_time': total_sum(self.employee_double_time) if return_dict['double_time_s'] else zero,
+        }
+        totals = {key: value.item() for key, value in totals.items()}
+        totals['regular'] = totals['total'] - totals['overtime']
+        if return_dict['double_time_s']:
+            totals['regular'] = totals['regular'] - totals['double_time']
+        return_dict.update(totals)
+        self.convert_to_string(
+            return_dict, ['regular', 'total_with_break', 'total', 'previous_total',
+                          'previous_breaks', 'overtime', 'daily_overtime',
+                          'weekly_overtime', 'break'])
@@ -0,0 +1,25 @@
+"""Entry points of the report worker processes.
+
+The worker processes load this module before django is set up, so nothing that touches the models can be imported
+at the module level."""
+import django
+
+
+def init_report_worker(event_queue):
+    django.setup()
+    from . import report_jobs
+    report_jobs.set_event_queue(event_queue)
+
+
+def run_report_job(job_id):
+    from .report_jobs import run_report_job
+    return run_report_job(job_id).status
+
+
+def init_report_build_worker():
+    django.setup()
+
+
+def build_report_chunk(report, possible_weeks):
+    """Builds the employees of a chunk of a report, see Report.create_report_dict"""
+    return report.build_employees(possible_weeks)
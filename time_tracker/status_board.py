@@ -0,0 +1,98 @@
+import logging
+import threading
+import time
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from users.utils import group_send
+from .models import TTUserInfo
+from .status_cache import get_company_statuses
+
+logger = logging.getLogger("django.request")
+
+# Owners watching their company's status board are in the company's channels group. A status change only queues the
+# user once it is committed, a background thread reads the statuses of the queued users with one query every
+# STATUS_BOARD_TICK seconds and sends each company one message with them, so a burst of punches becomes one message per
+# company per tick. The in memory channel layer knows its groups, nothing is queued for a company nobody is watching.
+# The messages are handed to the loop serving the websockets, see users.utils.group_send.
+
+GROUP_PREFIX = 'company_status_'
+
+_pending = set()    # user ids
+_publisher = None
+_lock = threading.Lock()
+
+
+def get_group_name(company_id):
+    return GROUP_PREFIX + str(company_id)
+
+
+def has_viewers(company_id=None):
+    """If anyone might be watching the company's board, or any board without a company"""
+    groups = getattr(get_channel_layer(), 'groups', None)
+    if groups is None:
+        return True
+    if company_id is None:
+        return any(name.startswith(GROUP_PREFIX) and channels for name, channels in groups.items())
+    return bool(groups.get(get_group_name(company_id)))
+
+
+def status_changed(user_id, company_id=None):
+    """Queues the user's new status for the boards once the transaction commits"""
+    if settings.STATUS_BOARD_TICK:
+        transaction.on_commit(lambda: queue_status(user_id, company_id))
+
+
+def queue_status(user_id, company_id=None):
+    if not has_viewers(company_id):
+        return
+    with _lock:
+        _pending.add(user_id)
+    start_status_publisher()
+
+
+def publish_statuses():
+    """Sends the statuses of the queued users to their companies' boards, returns the number of messages sent"""
+    with _lock:
+        user_ids = list(_pending)
+        _pending.clear()
+    if not user_ids:
+        return 0
+    by_company = {}
+    for row in TTUserInfo.objects.filter(user_id__in=user_ids).values('user_id', 'user__company_id', 'status_text',
+                                                                        'status_time'):
+        if row['user__company_id'] is not None:
+            by_company.setdefault(row['user__company_id'], []).append(
+                [row['user_id'], row['status_text'], row['status_time'].isoformat() if row['status_time'] else None])
+    for company_id, statuses in by_company.items():
+        group_send(get_group_name(company_id), {'type': 'status_delta', 'statuses': statuses})
+    return len(by_company)
+
+
+def start_status_publisher():
+    global _publisher
+    with _lock:
+        if _publisher is None:
+            _publisher = threading.Thread(target=run_status_publisher, daemon=True)
+            _publisher.start()
+
+
+def run_status_publisher():
+    while True:
+        time.sleep(settings.STATUS_BOARD_TICK or 1)
+        try:
+            close_old_connections()
+            publish_statuses()
+        except Exception as e:
+            logger.error('Failed to publish the employee statuses')
+            logger.error(e)
+
+
+def get_status_snapshot(company_id):
+    """The statuses of every employee of the company as [user id, name, status text, status time] from the status
+        cache"""
+    return [[status['user_id'], status['name'], status['status_text'],
+             status['status_time'].isoformat() if status['status_time'] else None]
+            for status in sorted(get_company_statuses(company_id).values(), key=lambda x: x['name'] or '')]
@@ -0,0 +1,170 @@
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from itertools import count
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from .models import TTUserInfo
+
+# Keeps the status of every employee of recently used companies in memory.
+# A company is loaded with one query and kept for STATUS_CACHE_TTL seconds, at most STATUS_CACHE_MAX_COMPANIES are kept.
+# Status changes are written through once their transaction commits. Other processes hear about them through a stamp
+# file per company in STATUS_CACHE_BUS_DIR, a stand-in for a real pub/sub channel: a process that finds a stamp it
+# didn't write or see before drops the company. Nothing read inside a transaction is cached, it might be rolled back.
+# Every load and write through gives the company a new version, anything built from the statuses can be kept with it.
+
+STATUS_FIELDS = ['id', 'user_id', 'user__full_name', 'user__first_name', 'user__email', 'user__active', 'status_text',
+                 'status_time', 'enable_breaks', 'time_action_id', 'break_action_id']
+CLOCKED_IN_STATUSES = ('i', 'b', 'c')
+
+_companies = OrderedDict()  # company id: {'loaded': time, 'stamp': last stamp seen, 'version': n, 'users': {...}}
+_user_companies = {}
+_versions = count(1)
+_lock = threading.Lock()
+
+
+def load_company_statuses(company_id):
+    statuses = {}
+    for row in TTUserInfo.objects.filter(user__company_id=company_id).values(*STATUS_FIELDS):
+        row['name'] = row.pop('user__full_name')
+        row['first_name'] = row.pop('user__first_name')
+        row['email'] = row.pop('user__email')
+        row['active'] = row.pop('user__active')
+        row['company_id'] = company_id
+        statuses[row['user_id']] = row
+    return statuses
+
+
+def get_company_statuses(company_id):
+    """The status of every employee of the company as {user id: status}, the statuses must not be changed"""
+    return get_versioned_statuses(company_id)[1]
+
+
+def get_versioned_statuses(company_id):
+    """get_company_statuses with the version of the statuses, the version is None when they aren't cached"""
+    if not settings.STATUS_CACHE_MAX_COMPANIES or connection.in_atomic_block:
+        return None, load_company_statuses(company_id)
+    stamp = read_stamp(company_id)
+    with _lock:
+        entry = _companies.get(company_id)
+        if entry and entry['stamp'] == stamp and time.monotonic() - entry['loaded'] < settings.STATUS_CACHE_TTL:
+            _companies.move_to_end(company_id)
+            return entry['version'], entry['users']
+    statuses = load_company_statuses(company_id)
+    with _lock:
+        version = next(_versions)
+        _companies[company_id] = {'loaded': time.monotonic(), 'stamp': stamp, 'version': version, 'users': statuses}
+        _companies.move_to_end(company_id)
+        for user_id in statuses:
+            _user_companies[user_id] = company_id
+        while len(_companies) > settings.STATUS_CACHE_MAX_COMPANIES:
+            _, evicted = _companies.popitem(last=False)
+            for user_id in evicted['users']:
+                _user_companies.pop(user_id, None)
+    return version, statuses
+
+
+def get_user_status(user):
+    return get_company_statuses(user.company_id).get(user.id)
+
+
+def get_clocked_in(company_id):
+    """The statuses of the company's employees that are clocked in right now, including the ones on a break"""
+    return [status for status in get_company_statuses(company_id).values()
+            if status['status_text'] in CLOCKED_IN_STATUSES]
+
+
+def get_cached_user_info(user):
+    """A read only TTUserInfo for showing the user's status. Only the fields in STATUS_FIELDS are filled in, it must
+        never be saved."""
+    status = get_user_status(user)
+    if status is None:
+        return TTUserInfo.objects.filter(user=user).first()
+    return TTUserInfo(id=status['id'], user=user, status_text=status['status_text'],
+                      status_time=status['status_time'], enable_breaks=status['enable_breaks'],
+                      time_action_id=status['time_action_id'], break_action_id=status['break_action_id'])
+
+
+def status_changed(user_id, company_id=None, user_info=None):
+    """Called when a user's status changed. With the saved user_info the new status is written through, without it the
+        company is loaded again the next time it is needed. Happens after the transaction commits."""
+    if settings.STATUS_CACHE_MAX_COMPANIES:
+        transaction.on_commit(lambda: apply_status_change(user_id, company_id, user_info))
+
+
+def apply_status_change(user_id, company_id, user_info):
+    if company_id is None:
+        company_id = _user_companies.get(user_id)
+    if company_id is None:
+        from users.models import CustomUser
+        company_id = CustomUser.objects.filter(id=user_id).values_list('company_id', flat=True).first()
+    up_to_date, stamp = publish_stamp(company_id)
+    with _lock:
+        entry = _companies.get(company_id)
+        if entry is None:
+            return
+        status = entry['users'].get(user_id)
+        if user_info is None or status is None or not up_to_date:
+            # the new status is only known to the database, or another process changed the company too
+            del _companies[company_id]
+            return
+        entry['users'] = dict(entry['users'])
+        entry['users'][user_id] = dict(status, status_text=user_info.status_text, status_time=user_info.status_time,
+                                       enable_breaks=user_info.enable_breaks, time_action_id=user_info.time_action_id,
+                                       break_action_id=user_info.break_action_id)
+        entry['stamp'] = stamp
+        entry['version'] = next(_versions)
+
+
+def get_stamp_path(name):
+    return os.path.join(settings.STATUS_CACHE_BUS_DIR, name)
+
+
+def read_bus_stamp(name):
+    """The stamp last written to the bus under the name, None without a bus and '' when nothing was written yet"""
+    if not settings.STATUS_CACHE_BUS_DIR:
+        return None
+    try:
+        with open(get_stamp_path(name)) as stamp_file:
+            return stamp_file.read()
+    except OSError:
+        return ''
+
+
+def write_bus_stamp(name):
+    """Writes a new stamp to the bus under the name, the processes that saw the old one know it changed"""
+    if not settings.STATUS_CACHE_BUS_DIR:
+        return None
+    os.makedirs(settings.STATUS_CACHE_BUS_DIR, exist_ok=True)
+    stamp = uuid.uuid4().hex
+    temp_path = get_stamp_path(name) + '.' + stamp
+    with open(temp_path, 'w') as stamp_file:
+        stamp_file.write(stamp)
+    os.replace(temp_path, get_stamp_path(name))
+    return stamp
+
+
+def read_stamp(company_id):
+    return read_bus_stamp('company_' + str(company_id))
+
+
+def publish_stamp(company_id):
+    """Lets the other processes know the company changed. Returns the new stamp and if this process had seen every
+        change to the company before this one."""
+    if not settings.STATUS_CACHE_BUS_DIR or company_id is None:
+        return True, None
+    previous = read_stamp(company_id)
+    stamp = write_bus_stamp('company_' + str(company_id))
+    with _lock:
+        entry = _companies.get(company_id)
+        return entry is not None and entry['stamp'] == previous, stamp
+
+
+def clear_status_cache():
+    with _lock:
+        _companies.clear()
+        _user_companies.clear()
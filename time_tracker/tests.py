@@ -1,13 +1,59 @@
-from django.test import TestCase
+import json
+import os
+import random
+import shutil
+import tempfile
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+from io import StringIO
+from unittest import mock
+from urllib.parse import urlencode
+
+from django.core.management import call_command
+from pypdf import PdfReader
+from django.core.management.base import CommandError
+from django.test import AsyncClient, TestCase, TransactionTestCase, override_settings, tag
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
 from django.utils import timezone
 from datetime import date, timedelta, datetime
 
-from users.models import CustomUser, Company
+from users.models import CustomUser, Company, CompanyConnection
 from .forms import ReportsForm
-from .models import TTUserInfo, TTCompanyInfo, InOutAction
-from .report import Report, get_time_actions_list
+from .models import (TTUserInfo, TTCompanyInfo, InOutAction, TTReportJob, TTReportCache, TTDailyTotal,
+                     TTActionArchive, TTGeofence, TTReports, TTRejectedPunch)
+from .report import Report, get_time_actions_list, get_employee_list, render_report_pdf
+from .report_vectorized import VectorizedReport
+from .report_summary import SummaryReport
+from .report_jobs import run_report_job, dispatch_report_job, check_report_future, fail_stale_report_jobs
+from .report_cache import evict_report_cache
+from . import daily_totals
+from .daily_totals import get_daily_totals, update_daily_totals, verify_daily_totals
+from . import archive
+from .archive import (archive_actions, get_archive_model, get_archived_actions, get_archived_before,
+                      forget_archive_model)
+from .action_import import import_actions
+from .benchmark import (create_synthetic_company, get_benchmark_form, run_report_benchmark, create_load_test_clients,
+                        delete_load_test_clients, run_view_load_test, run_id_codec_benchmark, create_punch_burst_users,
+                        run_punch_burst_benchmark)
 from .helpers import get_pay_period_dates
+from .punch_buffer import get_buffered_user_info, flush_punch_log, buffer_punch, get_pending_punches
+from .status_board import publish_statuses
+from .consumers import StatusBoardConsumer
+from .status_cache import clear_status_cache, get_cached_user_info, get_clocked_in, get_company_statuses
+from .geofence import clear_geofence_index, get_fence_flags, is_outside_fences, load_geofences
+from .query_plans import get_hot_queries, assert_uses_indexes
+from .utils import aget_events_by_range, get_events_by_month
+from middleware.tenant import clear_tenant_cache, get_tenant
 from middleware.timezone import get_timezone
+from cryptography.fernet import InvalidToken
+from daxApp.central_data import clear_dashboard_cache, get_main_page_data
+from daxApp.encryption import (BlockIdCodec, FernetIdCodec, IdCodec, clear_id_decode_cache, decrypt_id, decrypt_ids,
+                               encrypt_id, encrypt_ids, get_id_decode_stats, get_master_key)
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
 
 
 class ModelsTest(TestCase):
@@ -82,6 +128,716 @@ class ModelsTest(TestCase):
         user_info = TTUserInfo.objects.filter(user=user)[0]
         self.assertEqual(user_info.break_action, break_in)
 
+    def test_clock_action_queries(self):
+        company = Company.objects.create(name='Test')
+        user = CustomUser.objects.create(first_name='temp', last_name='employee', email='temployee@test.com',
+                                         company=company)
+        InOutAction.objects.create(type='t', user=user, start=timezone.now() - timedelta(hours=2))
+
+        # savepoint, insert, report version, the user info UPDATE returning the new status and release
+        with self.assertNumQueries(5):
+            break_in = InOutAction.objects.create(type='b', user=user, start=timezone.now() - timedelta(hours=1))
+        user_info = TTUserInfo.objects.filter(user=user)[0]
+        self.assertEqual(user_info.break_action, break_in)
+        self.assertEqual(user_info.status_text, 'b')
+        self.assertEqual(user_info.status_time, break_in.start)
+
+        break_in.end = timezone.now()
+        break_in.save()
+        user_info = TTUserInfo.objects.filter(user=user)[0]
+        self.assertEqual(user_info.status_text, 'c')
+        self.assertEqual(user_info.status_time, break_in.end)
+
+        # an action entered after the fact doesn't replace the current one
+        earlier = InOutAction.objects.create(type='b', user=user, start=timezone.now() - timedelta(days=2),
+                                             end=timezone.now() - timedelta(days=2, hours=-1))
+        user_info = TTUserInfo.objects.filter(user=user)[0]
+        self.assertEqual(user_info.break_action, break_in)
+        self.assertEqual(earlier.action_lookup_datetime, earlier.end)
+
+        # without RETURNING the new status is read back
+        with mock.patch('time_tracker.models.can_update_returning', return_value=False):
+            break_in.end = timezone.now()
+            break_in.save()
+        user_info = TTUserInfo.objects.filter(user=user)[0]
+        self.assertEqual(user_info.status_text, 'c')
+        self.assertEqual(user_info.status_time, break_in.end)
+
+        # moving the current action back in time hands the status back to the latest action
+        break_in.start = timezone.now() - timedelta(days=3)
+        break_in.end = timezone.now() - timedelta(days=3, hours=-1)
+        break_in.save()
+        user_info = TTUserInfo.objects.filter(user=user)[0]
+        self.assertEqual(user_info.break_action, earlier)
+        self.assertEqual(user_info.status_text, 'i')
+
+
+class TestQueryPlans(TestCase):
+    """
+    Test that the hot time action queries are answered from an index
+    """
+
+    def test_hot_queries_use_indexes(self):
+        company = Company.objects.create(name='Test')
+        user = CustomUser.objects.create(first_name='temp', last_name='employee', email='temployee@test.com',
+                                         company=company)
+        for name, queryset in get_hot_queries(user).items():
+            with self.subTest(name):
+                assert_uses_indexes(queryset)
+
+        with self.assertRaises(AssertionError):
+            assert_uses_indexes(InOutAction.objects.filter(comment='forgot'))
+        with self.assertRaises(AssertionError):
+            assert_uses_indexes(InOutAction.objects.filter(user=user).order_by('-total_time'))
+        assert_uses_indexes(InOutAction.objects.filter(user=user).order_by('-total_time'), allow_sort=True)
+
+    def test_events_by_month(self):
+        company = Company.objects.create(name='Test')
+        user = CustomUser.objects.create(first_name='temp', last_name='employee', email='temployee@test.com',
+                                         company=company, timezone='America/Denver')
+        user.refresh_from_db()
+        # the evening of the last of February in Denver is March in UTC
+        InOutAction.objects.create(user=user, start=datetime(2023, 3, 1, 4, 0, tzinfo=timezone.utc))
+        InOutAction.objects.create(user=user, start=datetime(2023, 3, 1, 8, 0, tzinfo=timezone.utc))
+        self.assertEqual(len(json.loads(get_events_by_month(user, date(2023, 2, 1)))), 1)
+        self.assertEqual(len(json.loads(get_events_by_month(user, date(2023, 3, 15)))), 1)
+
+
+class TestPunchApi(TestCase):
+    """
+    Test the json punch api
+    """
+
+    def setUp(self):
+        company = Company.objects.create(name='Test')
+        self.user = CustomUser.objects.create(first_name='temp', last_name='employee', email='temployee@test.com',
+                                              company=company)
+        self.client.force_login(self.user)
+
+    def test_punches(self):
+        response = self.client.post(reverse('punch'), {'action': 'in'}, HTTP_IDEMPOTENCY_KEY='kiosk-1')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['status'], 'i')
+
+        # the retry of a punch that already went through gets the same answer
+        retry = self.client.post(reverse('punch'), {'action': 'in'}, HTTP_IDEMPOTENCY_KEY='kiosk-1')
+        self.assertEqual(retry.status_code, 201)
+        self.assertEqual(retry.json(), response.json())
+        self.assertEqual(InOutAction.objects.filter(user=self.user).count(), 1)
+
+        response = self.client.post(reverse('punch'), {'action': 'in'})
+        self.assertEqual(response.status_code, 409)
+
+        response = self.client.post(reverse('punch'), {'action': 'b_in', 'idempotency_key': 'kiosk-2'})
+        self.assertEqual(response.json()['status'], 'b')
+        response = self.client.post(reverse('punch'), {'action': 'b_out', 'comment': 'lunch'})
+        self.assertEqual(response.json()['status'], 'c')
+        response = self.client.post(reverse('punch'), {'action': 'out'})
+        self.assertEqual(response.json()['status'], 'o')
+
+        # the status in the response is the one that was saved
+        user_info = TTUserInfo.objects.get(user=self.user)
+        self.assertEqual(user_info.status_text, 'o')
+        self.assertEqual(response.json()['status_time'], user_info.status_time.isoformat())
+        self.assertEqual(InOutAction.objects.get(type='b').comment, 'lunch')
+
+        self.assertEqual(self.client.post(reverse('punch'), {'action': 'b_out'}).status_code, 409)
+        self.assertEqual(self.client.post(reverse('punch'), {'action': 'dance'}).status_code, 400)
+
+    def test_sync_punches(self):
+        day = timezone.now() - timedelta(days=1)
+        coworker = CustomUser.objects.create(first_name='co', last_name='worker', email='coworker@test.com',
+                                             company=self.user.company)
+        outsider = CustomUser.objects.create(first_name='out', last_name='sider', email='outsider@test.com',
+                                             company=Company.objects.create(name='Other'))
+        punches = [
+            {'id': 'e4', 'action': 'out', 'time': (day + timedelta(hours=8)).isoformat(), 'lat': '40.1', 'lon': -105.2},
+            {'id': 'e1', 'action': 'in', 'time': day.isoformat(), 'lat': 40.0, 'lon': '-105.0', 'comment': 'early'},
+            {'id': 'e2', 'action': 'b_in', 'time': (day + timedelta(hours=4)).isoformat()},
+            {'id': 'e3', 'action': 'b_out', 'time': (day + timedelta(hours=4, minutes=30)).isoformat()},
+            {'id': 'e2', 'action': 'b_in', 'time': (day + timedelta(hours=4)).isoformat()},
+            {'id': 'e5', 'action': 'b_out', 'time': (day + timedelta(hours=9)).isoformat()},
+            {'id': 'e6', 'action': 'in', 'time': day.isoformat(), 'employee_id': encrypt_id(coworker.id)},
+            {'id': 'e7', 'action': 'in', 'time': day.isoformat(), 'employee_id': encrypt_id(outsider.id)},
+            {'id': 'e8', 'action': 'in', 'time': 'noon'},
+        ]
+        response = self.client.post(reverse('punch_sync'), {'punches': punches}, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        results = response.json()['results']
+        self.assertEqual([result['status'] for result in results], ['created', 'created', 'created', 'created',
+                                                                    'duplicate', 'rejected', 'created', 'rejected',
+                                                                    'rejected'])
+        self.assertEqual(results[4]['action_id'], results[2]['action_id'])
+        self.assertEqual(response.json()['statuses'][0], {'employee_id': None, 'status': 'o',
+                                                           'status_time': (day + timedelta(hours=8)).isoformat()})
+
+        clock_in = InOutAction.objects.get(user=self.user, type='t')
+        self.assertEqual(clock_in.total_time, 8 * 3600)
+        self.assertEqual(clock_in.comment, 'early')
+        self.assertEqual(float(clock_in.end_lat), 40.1)
+        self.assertEqual(float(clock_in.start_lon), -105.0)
+        self.assertEqual(TTUserInfo.objects.get(user=coworker).status_text, 'i')
+        self.assertEqual(sum(row.total_time for row in TTDailyTotal.objects.filter(user=self.user, type='t')), 8 * 3600)
+
+        # a kiosk that didn't get the answer sends the same batch again
+        again = self.client.post(reverse('punch_sync'), {'punches': punches[:4]}, content_type='application/json')
+        self.assertEqual([result['status'] for result in again.json()['results']], ['duplicate'] * 4)
+        self.assertEqual(again.json()['results'][0]['action_id'], results[0]['action_id'])
+        self.assertEqual(InOutAction.objects.filter(user=self.user).count(), 2)
+
+    def test_punch_queries(self):
+        self.client.post(reverse('punch'), {'action': 'in'})
+        # the latest archive cutoff is read once per process
+        get_archived_before()
+        # session, user and company, the idempotency key lookup, user info, the clock out with its report version and
+        # status, storing the idempotency key. The daily totals are updated once it commits.
+        with self.assertNumQueries(14):
+            self.client.post(reverse('punch'), {'action': 'out'}, HTTP_IDEMPOTENCY_KEY='phone-1')
+
+
+class TestAsyncViews(TestCase):
+    """
+    Test the async clock and calendar views through the asgi handler
+    """
+
+    def setUp(self):
+        company = Company.objects.create(name='Test')
+        self.user = CustomUser.objects.create(first_name='temp', last_name='employee', email='temployee@test.com',
+                                              company=company)
+        self.async_client.force_login(self.user)
+
+    def post(self, name, data, client=None):
+        # the multipart bodies of the 4.1 async client can't be read, the forms are sent url encoded
+        return (client or self.async_client).post(reverse(name), urlencode(data),
+                                                  content_type='application/x-www-form-urlencoded')
+
+    async def test_clock_and_calendar(self):
+        response = await self.post('simple_clock', {'action': 'in', 'comment': 'early'})
+        self.assertContains(response, 'Clocked In')
+        response = await self.post('simple_clock', {'action': 'out'})
+        self.assertContains(response, 'Clocked Out')
+
+        calendar = {'start': (timezone.now() - timedelta(days=1)).isoformat(),
+                    'end': (timezone.now() + timedelta(days=1)).isoformat()}
+        events = (await self.post('get_time_actions', calendar)).json()
+        self.assertEqual([(event['title'], event['comment']) for event in events], [('Clocked In', 'early')])
+
+        # the user has no timezone, the calendar sends utc
+        for hours in [3, 2]:
+            start = (timezone.now() - timedelta(hours=hours)).replace(tzinfo=None)
+            response = await self.post('manage_time_event', {
+                'event': 'add_edit_time', 'title': 'Break', 'start': start.isoformat(),
+                'end': (start + timedelta(minutes=30)).isoformat()})
+            self.assertEqual(response.json()['errors'], [])
+        events = (await self.post('get_time_actions', calendar)).json()
+        self.assertEqual(sorted(event['title'] for event in events), ['Break', 'Break', 'Clocked In'])
+
+        response = await self.post('delete_action', {'action_id': response.json()['action_id']})
+        self.assertTrue(response.json()['Success'])
+        self.assertEqual(await InOutAction.objects.filter(user=self.user).acount(), 2)
+
+        response = await self.post('get_time_actions', calendar, AsyncClient())
+        self.assertEqual(response.status_code, 302)
+
+    async def test_middleware_on_event_loop(self):
+        # TenantMiddleware loaded the user and their company, the login check doesn't need a thread of its own
+        with mock.patch('daxApp.decorators.load_request_user') as load_request_user:
+            response = await self.post('simple_clock', {})
+        load_request_user.assert_not_called()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Frame-Options'], 'DENY')
+
+
+class TestGeofence(TestCase):
+    """
+    Test flagging punches made outside of the company's geofences
+    """
+
+    def setUp(self):
+        clear_geofence_index()
+        self.company = Company.objects.create(name='Test')
+        self.user = CustomUser.objects.create(first_name='temp', last_name='employee', email='temployee@test.com',
+                                              company=self.company)
+        self.client.force_login(self.user)
+        self.office = TTGeofence.objects.create(company=self.company, name='Office', shape='c', latitude='40.0',
+                                                longitude='-105.0', radius=200)
+        TTGeofence.objects.create(company=self.company, name='Yard', shape='p',
+                                  points=[[40.1, -105.1], [40.1, -105.09], [40.11, -105.09], [40.11, -105.1]])
+
+    def test_punch_flags(self):
+        response = self.client.post(reverse('punch'), {'action': 'in', 'lat': '40.0010', 'lon': '-105.0010'})
+        self.assertIs(response.json()['outside_fence'], False)
+        response = self.client.post(reverse('punch'), {'action': 'out', 'lat': '40.2', 'lon': '-105.0'})
+        self.assertIs(response.json()['outside_fence'], True)
+        action = InOutAction.objects.get(user=self.user)
+        self.assertEqual((action.start_outside_fence, action.end_outside_fence), (False, True))
+
+        response = self.client.post(reverse('punch'), {'action': 'in', 'lat': '40.105', 'lon': '-105.095'})
+        self.assertIs(response.json()['outside_fence'], False)
+        response = self.client.post(reverse('punch'), {'action': 'out'})
+        self.assertIsNone(response.json()['outside_fence'])
+        self.assertEqual(self.client.post(reverse('punch'), {'action': 'in', 'lat': 'north'}).status_code, 400)
+
+        # punches checked before the office closed are flagged again
+        self.office.active = False
+        self.office.save()
+        out = StringIO()
+        call_command('revalidate_geofences', '--company', str(self.company.id), stdout=out)
+        self.assertIn('Checked 2 actions, changed 1', out.getvalue())
+        self.assertTrue(InOutAction.objects.get(id=action.id).start_outside_fence)
+
+    def test_vectorized_flags(self):
+        # the grid and the vectorized check agree on every point, also with many sites
+        rng = random.Random(3)
+        for index in range(300):
+            TTGeofence.objects.create(company=self.company, shape='c', latitude=40 + rng.uniform(-1, 1),
+                                      longitude=-105 + rng.uniform(-1, 1), radius=rng.uniform(50, 5000))
+        fences = load_geofences(self.company.id)
+        points = [(40 + rng.uniform(-1, 1), -105 + rng.uniform(-1, 1)) for index in range(2000)]
+        points += [(40.105, -105.095), (40.0, -105.0), (None, None)]
+        flags = get_fence_flags(fences, [lat for lat, lon in points], [lon for lat, lon in points])
+        self.assertEqual(flags, [is_outside_fences(self.company.id, lat, lon) for lat, lon in points])
+        self.assertEqual(flags[-3:], [False, False, None])
+        self.assertIn(True, flags)
+
+    def test_fence_flags_company(self):
+        # only the company id of a user that isn't loaded is looked up, the grid is cached after the first punch
+        action = InOutAction(user_id=self.user.id, type='t', start=timezone.now(), start_lat='40.0', start_lon='-105.0')
+        with self.assertNumQueries(2):
+            action.set_fence_flags()
+        self.assertIs(action.start_outside_fence, False)
+        self.assertFalse(InOutAction.user.is_cached(action))
+        action.user = self.user
+        with self.assertNumQueries(0):
+            action.set_fence_flags()
+
+    def test_geofence_bus(self):
+        bus_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, bus_dir)
+        with override_settings(STATUS_CACHE_BUS_DIR=bus_dir):
+            self.assertIs(is_outside_fences(self.company.id, '40.0', '-105.0'), False)
+            # another process moved the office, this one drops its grid
+            TTGeofence.objects.filter(id=self.office.id).update(latitude='41.0')
+            self.assertIs(is_outside_fences(self.company.id, '40.0', '-105.0'), False)
+            stamp_path = os.path.join(bus_dir, 'geofence_company_' + str(self.company.id))
+            with open(stamp_path, 'w') as stamp_file:
+                stamp_file.write('other process')
+            self.assertIs(is_outside_fences(self.company.id, '40.0', '-105.0'), True)
+            with self.assertNumQueries(0):
+                is_outside_fences(self.company.id, '40.0', '-105.0')
+
+            # and this one tells the others once the change is committed
+            with self.captureOnCommitCallbacks(execute=True):
+                self.office.save()
+            with open(stamp_path) as stamp_file:
+                self.assertNotEqual(stamp_file.read(), 'other process')
+
+
+class TestPunchBuffer(TestCase):
+    """
+    Test the write-behind punch log
+    """
+
+    def setUp(self):
+        company = Company.objects.create(name='Test')
+        self.user = CustomUser.objects.create(first_name='temp', last_name='employee', email='temployee@test.com',
+                                              company=company)
+        self.client.force_login(self.user)
+        self.log_dir = tempfile.mkdtemp()
+        self.settings_override = override_settings(PUNCH_WRITE_BEHIND=True, PUNCH_LOG_DIR=self.log_dir,
+                                                   PUNCH_FLUSH_INTERVAL=0)
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.log_dir)
+
+    def test_write_behind_punches(self):
+        response = self.client.post(reverse('simple_clock'), {'action': 'in'})
+        self.assertContains(response, 'Clocked In')
+        self.client.post(reverse('simple_clock'), {'action': 'b_in', 'comment': 'coffee'})
+        # not allowed while on break, it isn't logged
+        self.client.post(reverse('simple_clock'), {'action': 'in'})
+        self.assertFalse(InOutAction.objects.filter(user=self.user).exists())
+
+        # the user sees their own punches before they are saved
+        self.assertEqual(get_buffered_user_info(self.user).status_text, 'b')
+        response = self.client.post(reverse('get_time_actions'), {
+            'start': (timezone.now() - timedelta(days=1)).isoformat(), 'end': (timezone.now() + timedelta(days=1)).isoformat()})
+        self.assertEqual([event['id'] for event in response.json()], ['', ''])
+
+        with open(os.path.join(self.log_dir, 'punches.log')) as log_file:
+            log = log_file.read()
+        out = StringIO()
+        call_command('flush_punches', stdout=out)
+        self.assertIn('Flushed 2 punches', out.getvalue())
+        self.assertEqual(InOutAction.objects.filter(user=self.user).count(), 2)
+        self.assertEqual(InOutAction.objects.get(type='b').comment, 'coffee')
+        self.assertEqual(TTUserInfo.objects.get(user=self.user).status_text, 'b')
+        self.assertEqual(os.path.getsize(os.path.join(self.log_dir, 'punches.log')), 0)
+
+        # a flusher that died before it moved the offset flushes the same punches again
+        with open(os.path.join(self.log_dir, 'punches.log'), 'w') as log_file:
+            log_file.write(log)
+        self.assertEqual(flush_punch_log(), 2)
+        self.assertEqual(InOutAction.objects.filter(user=self.user).count(), 2)
+
+        self.client.post(reverse('simple_clock'), {'action': 'b_out'})
+        self.assertEqual(get_buffered_user_info(self.user).status_text, 'c')
+        flush_punch_log()
+        self.assertTrue(InOutAction.objects.get(type='b').end)
+
+
+    def test_pending_punches(self):
+        other = CustomUser.objects.create(first_name='other', last_name='employee', email='oemployee@test.com',
+                                          company=self.user.company)
+        buffer_punch(self.user, 'in')
+        buffer_punch(other, 'in')
+        # a punch another process logged is read from the log
+        with open(os.path.join(self.log_dir, 'punches.log'), 'a') as log_file:
+            log_file.write(json.dumps({'id': 'logged', 'user_id': self.user.id, 'action': 'b_in',
+                                       'time': timezone.now().isoformat(), 'comment': ''}) + '\n')
+        self.assertEqual([event['action'] for event in get_pending_punches(self.user.id)], ['in', 'b_in'])
+        self.assertEqual([event['action'] for event in get_pending_punches(other.id)], ['in'])
+
+        # the flushed punches are dropped, the log starts over
+        flush_punch_log()
+        self.assertEqual(get_pending_punches(self.user.id), [])
+        buffer_punch(self.user, 'b_out')
+        self.assertEqual([event['action'] for event in get_pending_punches(self.user.id)], ['b_out'])
+        self.assertEqual(get_pending_punches(other.id), [])
+
+    def test_punch_burst_benchmark(self):
+        company, users = create_punch_burst_users(3)
+        results = run_punch_burst_benchmark(users, rounds=2)
+        self.assertEqual(results['punches'], 6)
+        self.assertEqual(results['flushed'], 6)
+        self.assertTrue(results['last_fifth']['p99'])
+        json.dumps(results)
+        self.assertEqual(InOutAction.objects.filter(user__company=company, end__isnull=False).count(), 3)
+
+    @mock.patch('time_tracker.punch_buffer.send_user_message')
+    def test_rejected_punches(self, send_user_message):
+        # clocking out without clocking in, and a line the log can't have come from
+        rejected = buffer_punch(self.user, 'out')
+        with open(os.path.join(self.log_dir, 'punches.log'), 'a') as log_file:
+            log_file.write(json.dumps({'id': 'junk', 'user_id': 0, 'action': 'in'}) + '\n')
+        with open(os.path.join(self.log_dir, 'punches.log')) as log_file:
+            log = log_file.read()
+        self.assertEqual(flush_punch_log(), 2)
+        self.assertFalse(InOutAction.objects.filter(user=self.user).exists())
+        self.assertEqual(sorted((punch.key, punch.user_id) for punch in TTRejectedPunch.objects.all()),
+                         sorted([(rejected['id'], self.user.id), ('junk', None)]))
+        self.assertTrue(TTRejectedPunch.objects.get(key=rejected['id']).errors)
+        self.assertEqual(send_user_message.call_count, 1)
+        self.assertEqual(send_user_message.call_args[0][0], self.user.id)
+
+        # flushed again after a crash they are only kept once
+        with open(os.path.join(self.log_dir, 'punches.log'), 'w') as log_file:
+            log_file.write(log)
+        flush_punch_log()
+        self.assertEqual(TTRejectedPunch.objects.count(), 2)
+
+
+class TestStatusCache(TransactionTestCase):
+    """
+    Test the in memory status cache, the cache is only used outside of transactions
+    """
+
+    def setUp(self):
+        self.bus_dir = tempfile.mkdtemp()
+        self.settings_override = override_settings(STATUS_CACHE_BUS_DIR=self.bus_dir)
+        self.settings_override.enable()
+        clear_status_cache()
+        self.company = Company.objects.create(name='Test')
+        self.user = CustomUser.objects.create(first_name='temp', last_name='employee', email='temployee@test.com',
+                                              company=self.company)
+        self.user.refresh_from_db()
+
+    def tearDown(self):
+        clear_status_cache()
+        self.settings_override.disable()
+        shutil.rmtree(self.bus_dir)
+
+    def test_status_cache(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(get_company_statuses(self.company.id)[self.user.id]['status_text'], 'n')
+        with self.assertNumQueries(0):
+            self.assertEqual(get_cached_user_info(self.user).status_text, 'n')
+
+        # the status the database worked out is read back and written through
+        clock_in = InOutAction.objects.create(user=self.user, type='t')
+        with self.assertNumQueries(0):
+            self.assertEqual([status['user_id'] for status in get_clocked_in(self.company.id)], [self.user.id])
+
+        clock_in.end = timezone.now()
+        clock_in.save()
+        with self.assertNumQueries(0):
+            self.assertEqual(get_clocked_in(self.company.id), [])
+
+        # a saved user info is written through
+        user_info = TTUserInfo.objects.get(user=self.user)
+        user_info.enable_breaks = False
+        user_info.save()
+        with self.assertNumQueries(0):
+            self.assertEqual(get_cached_user_info(self.user).status_text, 'o')
+            self.assertFalse(get_cached_user_info(self.user).enable_breaks)
+
+        # another process changed the company
+        TTUserInfo.objects.filter(user=self.user).update(status_text='i')
+        with open(os.path.join(self.bus_dir, 'company_' + str(self.company.id)), 'w') as stamp_file:
+            stamp_file.write('other process')
+        with self.assertNumQueries(1):
+            self.assertEqual(len(get_clocked_in(self.company.id)), 1)
+
+        with override_settings(STATUS_CACHE_TTL=0), self.assertNumQueries(1):
+            get_company_statuses(self.company.id)
+
+        other_company = Company.objects.create(name='Other')
+        with override_settings(STATUS_CACHE_MAX_COMPANIES=1):
+            get_company_statuses(other_company.id)
+            with self.assertNumQueries(1):
+                get_company_statuses(self.company.id)
+
+    def test_user_save(self):
+        with mock.patch('users.models.notify_status_changed') as notify:
+            # a login only saves last_login, a save that changes nothing the statuses show isn't sent either
+            self.user.last_login = timezone.now()
+            self.user.save(update_fields=['last_login'])
+            self.user.save()
+            notify.assert_not_called()
+
+            self.user.last_name = 'renamed'
+            self.user.save()
+            notify.assert_called_once_with(self.user.id, self.company.id)
+            notify.reset_mock()
+            self.user.save()
+            notify.assert_not_called()
+
+            # the old company lists the user too
+            other_company = Company.objects.create(name='Other')
+            self.user.company = other_company
+            self.user.save(update_fields=['company'])
+            self.assertEqual(notify.call_args_list, [mock.call(self.user.id, other_company.id),
+                                                     mock.call(self.user.id, self.company.id)])
+
+
+@override_settings(STATUS_CACHE_BUS_DIR=None)
+class TestTenantContext(TransactionTestCase):
+    """
+    The company, role and settings of a user are loaded once and kept until one of them is saved
+    """
+
+    def setUp(self):
+        clear_tenant_cache()
+        self.bus_dir = tempfile.mkdtemp()
+        self.settings_override = override_settings(STATUS_CACHE_BUS_DIR=self.bus_dir)
+        self.settings_override.enable()
+        self.company = Company.objects.create(name='Tenant', timezone='America/Denver', use_company_timezone=True)
+        self.user = CustomUser.objects.create(first_name='temp', last_name='employee', email='temployee@test.com',
+                                              company=self.company)
+        self.client.force_login(self.user)
+        # saving a user that has a connection fails, it is added after the login saved them
+        self.connection = CompanyConnection.objects.create(company=self.company, user=self.user, role='e')
+
+    def tearDown(self):
+        clear_tenant_cache()
+        self.settings_override.disable()
+        shutil.rmtree(self.bus_dir)
+
+    def get_tenant(self, queries):
+        user = CustomUser.objects.get(id=self.user.id)
+        with self.assertNumQueries(queries):
+            tenant = get_tenant(user)
+            self.assertIs(get_tenant(user), tenant)
+            get_timezone(user)
+        return tenant
+
+    def test_tenant_context(self):
+        response = self.client.get(reverse('manage_times'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.wsgi_request.tenant.company.id, self.company.id)
+        # the session and the user, then the employee picker of the page
+        with self.assertNumQueries(4):
+            self.client.get(reverse('manage_times'))
+
+        tenant = self.get_tenant(0)
+        self.assertEqual((tenant.role, tenant.tt_company_info.company_id), ('e', self.company.id))
+        self.assertEqual(str(tenant.timezone), 'America/Denver')
+        # the copies can be changed without changing the cache
+        tenant.company.use_company_timezone = False
+        self.assertTrue(self.get_tenant(0).company.use_company_timezone)
+
+        self.company.timezone = 'America/New_York'
+        self.company.save()
+        self.assertEqual(str(self.get_tenant(1).timezone), 'America/New_York')
+
+        self.connection.role = 'c'
+        self.connection.save()
+        self.assertEqual(self.get_tenant(1).role, 'c')
+
+        tt_company_info = TTCompanyInfo.objects.get(company=self.company)
+        tt_company_info.pay_period_type = 'm'
+        tt_company_info.save()
+        self.assertEqual(self.get_tenant(1).tt_company_info.pay_period_type, 'm')
+
+        with override_settings(TENANT_CACHE_TTL=0):
+            self.get_tenant(1)
+        with override_settings(TENANT_CACHE_MAX_USERS=0):
+            self.get_tenant(1)
+
+        # another process changed the company or the user
+        self.get_tenant(0)
+        for name in ['tenant_company_' + str(self.company.id), 'tenant_user_' + str(self.user.id)]:
+            with open(os.path.join(self.bus_dir, name), 'w') as stamp_file:
+                stamp_file.write('other process')
+            self.get_tenant(1)
+            self.get_tenant(0)
+
+        # and this one tells the others
+        self.connection.save()
+        with open(os.path.join(self.bus_dir, 'tenant_user_' + str(self.user.id))) as stamp_file:
+            self.assertNotEqual(stamp_file.read(), 'other process')
+
+
+@override_settings(STATUS_CACHE_BUS_DIR=None)
+class TestDashboardData(TransactionTestCase):
+    """
+    The home and employees pages of a company owner take the same queries however many employees there are
+    """
+
+    def setUp(self):
+        clear_tenant_cache()
+        clear_status_cache()
+        clear_dashboard_cache()
+        self.company = Company.objects.create(name='Dashboard')
+        self.owner = CustomUser.objects.create(first_name='Owner', last_name='Boss', email='owner@test.com',
+                                               company=self.company)
+        self.client.force_login(self.owner)
+        # saving a user that has a connection fails, it is added after the login saved them
+        CompanyConnection.objects.create(company=self.company, user=self.owner, role='c')
+
+    def tearDown(self):
+        clear_tenant_cache()
+        clear_status_cache()
+        clear_dashboard_cache()
+
+    def add_employees(self, count):
+        first = CustomUser.objects.count()
+        for i in range(first, first + count):
+            CustomUser.objects.create(first_name='first' + str(i), last_name='last',
+                                      email='employee' + str(i) + '@test.com', company=self.company)
+
+    def count_page_queries(self, name):
+        self.client.get(reverse(name))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse(name))
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response
+
+    def test_dashboard_data(self):
+        self.add_employees(5)
+        small = {name: self.count_page_queries(name)[0] for name in ['home', 'employees']}
+        self.add_employees(50)
+        large = {name: self.count_page_queries(name)[0] for name in ['home', 'employees']}
+        self.assertEqual(small, large)
+        # the session and the user
+        self.assertEqual(large['home'], 2)
+
+        data = get_main_page_data(self.owner, get_tt_employees=True, get_employee_list=True)
+        self.assertEqual(len(data['tt_employees']), 55)
+        self.assertEqual(len(data['employees']), 55)
+        self.assertNotIn(self.owner.id, [employee['user_id'] for employee in data['employees']])
+        self.assertEqual(data['employees'][0]['name'], 'LAST, FIRST1')
+        self.assertEqual(data['tt_employees'][0]['status'], 'Welcome to DaxApp')
+
+        # the lists are kept until the statuses change
+        with mock.patch('daxApp.central_data.encrypt_ids') as encrypt:
+            get_main_page_data(self.owner, get_employee_list=True)
+            encrypt.assert_not_called()
+        employee = CustomUser.objects.get(email='employee1@test.com')
+        employee.active = False
+        employee.save()
+        data = get_main_page_data(self.owner, get_employee_list=True)
+        self.assertFalse(data['employees'][0]['active'])
+
+        InOutAction.objects.create(user=employee, type='t')
+        data = get_main_page_data(self.owner, get_tt_employees=True)
+        self.assertEqual([i['status'] for i in data['tt_employees'] if i['user_id'] == employee.id], ['Clocked In'])
+
+
+@override_settings(STATUS_CACHE_BUS_DIR=None)
+class TestStatusBoard(TransactionTestCase):
+    """
+    The status board gets the statuses once and then one message per tick with the ones that changed
+    """
+
+    def setUp(self):
+        clear_tenant_cache()
+        clear_status_cache()
+        publish_statuses()
+        self.company = Company.objects.create(name='Board')
+        self.owner = CustomUser.objects.create(first_name='Owner', last_name='Boss', email='owner@test.com',
+                                               company=self.company)
+        CompanyConnection.objects.create(company=self.company, user=self.owner, role='c')
+        self.employees = [CustomUser.objects.create(first_name='first' + str(i), last_name='last',
+                                                    email='employee' + str(i) + '@test.com', company=self.company)
+                          for i in range(20)]
+
+    def tearDown(self):
+        clear_tenant_cache()
+        clear_status_cache()
+
+    @mock.patch('time_tracker.status_board.start_status_publisher')
+    def test_status_deltas(self, start_publisher):
+        channel_layer = get_channel_layer()
+        channel = async_to_sync(channel_layer.new_channel)()
+        async_to_sync(channel_layer.group_add)('company_status_' + str(self.company.id), channel)
+        try:
+            # a shift change is one message
+            for employee in self.employees:
+                InOutAction.objects.create(user=employee, type='t')
+            self.assertTrue(start_publisher.called)
+            with self.assertNumQueries(1):
+                self.assertEqual(publish_statuses(), 1)
+            message = async_to_sync(channel_layer.receive)(channel)
+            self.assertEqual(message['type'], 'status_delta')
+            self.assertEqual(sorted(status[0] for status in message['statuses']),
+                             sorted(employee.id for employee in self.employees))
+            self.assertEqual({status[1] for status in message['statuses']}, {'i'})
+            self.assertEqual(publish_statuses(), 0)
+        finally:
+            async_to_sync(channel_layer.group_discard)('company_status_' + str(self.company.id), channel)
+
+        # nobody is watching
+        InOutAction.objects.create(user=self.employees[0], type='b')
+        self.assertEqual(publish_statuses(), 0)
+
+    @override_settings(STATUS_BOARD_TICK=0.05)
+    async def test_status_board_consumer(self):
+        communicator = WebsocketCommunicator(StatusBoardConsumer.as_asgi(), '/ws/status_board/')
+        communicator.scope['user'] = self.employees[0]
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+        communicator = WebsocketCommunicator(StatusBoardConsumer.as_asgi(), '/ws/status_board/')
+        communicator.scope['user'] = self.owner
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        snapshot = await communicator.receive_json_from()
+        self.assertEqual(snapshot['type'], 'snapshot')
+        self.assertEqual(len(snapshot['employees']), 20)
+        self.assertEqual(snapshot['status_names']['i'], 'Clocked In')
+        employee_id = encrypt_id(self.employees[0].id)
+        self.assertIn([employee_id, 'LAST, FIRST0', 'n', None], snapshot['employees'])
+
+        # the publisher thread sends it, on the loop the consumer runs on
+        await InOutAction.objects.acreate(user=self.employees[0], type='t')
+        delta = await communicator.receive_json_from(timeout=5)
+        self.assertEqual(delta['type'], 'delta')
+        self.assertEqual([status[:2] for status in delta['employees']], [[employee_id, 'i']])
+        await communicator.disconnect()
+
 
 class TestForms(TestCase):
     """
@@ -109,7 +865,7 @@ class TestForms(TestCase):
                           'other_hours_format': ['This field is required.'],
                           'other_font_size': ['This field is required.']})
         form = ReportsForm(company=company, data={'begin_date': timezone.now(), 'end_date': timezone.now(),
-                                                  'report_type': 'reports/summary.html', 'other_rounding': 5,
+                                                  'report_type': 'time_tracker/reports/summary.html', 'other_rounding': 5,
                                                   'other_hours_format': 'hours_and_minutes',
                                                   'other_font_size': 'large'})
         self.assertTrue(form.is_valid())
@@ -130,12 +886,22 @@ class TestForms(TestCase):
         pass
 
 
+def remove_action_ids(report_dict):
+    """The encrypted action ids are different every time, remove them so reports can be compared"""
+    for employee in report_dict['employees']:
+        for week in employee['weeks']:
+            for day in week['days']:
+                for action in day['actions']:
+                    del action['action_id']
+    return report_dict
+
+
 class TestReport(TestCase):
     """
     Test the report generator
     """
 
-    def test_report_engine(self):
+    def setUp(self):
         # test data is a representation of the database, we will use it create a temp database and then run a report on
         # it and verify the results against test_answers
         test_data = [
@@ -972,7 +1738,7 @@ class TestReport(TestCase):
             }}
         ]
 
-        test_answers = [{'name': 'Caspy, Bill', 'timezone': 'UTC-07:00', 'paid_breaks': False, 'total': 114.23000000000002,
+        self.test_answers = [{'name': 'Caspy, Bill', 'timezone': 'UTC-07:00', 'paid_breaks': False, 'total': 114.23000000000002,
                          'break': 2.2, 'overtime': 22.360000000000014, 'previous_total': 17.26, 'previous_breaks': 0.0,
                          'weekly_overtime': 8.040000000000006, 'daily_overtime': 14.320000000000004, 'double_time': 0.0,
                          'regular': 91.87, 'total_with_break': 116.43000000000002, 'str_regular': '91.87',
@@ -1013,12 +1779,8 @@ class TestReport(TestCase):
             setattr(company_info, key, tt_data[key])
         company_info.save()
 
-        begin_date = date(year=2023, month=2, day=15)
-        end_date = date(year=2023, month=2, day=28)
-
-        real_emps = []
-        emp_id_list = []
         real_tt_emps = []
+        emp_id_list = []
         employees = test_data[0]['company']['employees']
         for employee in employees:
             temp_emp = CustomUser(**employee['data'])
@@ -1028,38 +1790,812 @@ class TestReport(TestCase):
                 setattr(tt_emp_info, key, employee['tt_data'][key])
             tt_emp_info.save()
             real_tt_emps.append(tt_emp_info)
-            real_emps.append(temp_emp)
             emp_id_list.append(temp_emp.id)
             actions = employee['actions']
             for action in actions:
                 new_action = InOutAction(**action, user=temp_emp)
                 new_action.save()
 
-        override_timezone = timezone.timezone(timedelta(hours=-7))
-
-        form_settings = {
-            'begin_date': begin_date,
-            'end_date': end_date,
+        self.company = company
+        self.company_info = company_info
+        self.real_tt_emps = real_tt_emps
+        self.emp_id_list = emp_id_list
+        self.override_timezone = timezone.timezone(timedelta(hours=-7))
+        self.form_settings = {
+            'begin_date': date(year=2023, month=2, day=15),
+            'end_date': date(year=2023, month=2, day=28),
             'other_hours_format': 'decimal',
             'other_rounding': '5',
         }
 
-        full_beg_date, full_end_date, time_actions_list = get_time_actions_list(form=form_settings,
-                                                                                employee_id_list=emp_id_list,
-                                                                                company_info=company_info,
-                                                                                override_timezone=override_timezone)
+    def test_report_engine(self):
+        full_beg_date, full_end_date, time_actions_list = get_time_actions_list(form=self.form_settings,
+                                                                                employee_id_list=self.emp_id_list,
+                                                                                company_info=self.company_info,
+                                                                                override_timezone=self.override_timezone)
 
-        report_engine = Report(employee_list=real_tt_emps, time_actions_list=time_actions_list,
-                               form=form_settings, full_beg_date=full_beg_date, full_end_date=full_end_date,
-                               company=company, company_info=company_info, override_timezone=override_timezone)
+        report_engine = Report(employee_list=self.real_tt_emps, time_actions_list=time_actions_list,
+                               form=self.form_settings, full_beg_date=full_beg_date, full_end_date=full_end_date,
+                               company=self.company, company_info=self.company_info,
+                               override_timezone=self.override_timezone)
 
         detailed_hours_report = report_engine.make_detailed_hours_report()
 
-        for index, answer_employee in enumerate(test_answers):
+        for index, answer_employee in enumerate(self.test_answers):
             result_employee = detailed_hours_report['employees'][index]
             del result_employee['weeks']
             self.assertEqual(answer_employee, result_employee)
 
+    def test_report_engine_query_count(self):
+        """The report should run the same number of queries no matter how many employees are selected"""
+        CustomUser.objects.filter(id__in=self.emp_id_list).update(company=self.company)
+        # the latest archive cutoff is read once per process
+        get_archived_before()
+        for selected, employees in [([str(self.emp_id_list[0])], 1), (['-1'], len(self.emp_id_list))]:
+            # the employees, the archived years of the range and the actions
+            with self.assertNumQueries(3):
+                employee_list, employee_id_list = get_employee_list(self.company, selected)
+                full_beg_date, full_end_date, time_actions_list = get_time_actions_list(
+                    form=self.form_settings, employee_id_list=employee_id_list, company_info=self.company_info,
+                    override_timezone=None)
+                report_engine = Report(employee_list=employee_list, time_actions_list=time_actions_list,
+                                       form=self.form_settings, full_beg_date=full_beg_date,
+                                       full_end_date=full_end_date, company=self.company,
+                                       company_info=self.company_info, override_timezone=None)
+                detailed_hours_report = report_engine.make_detailed_hours_report()
+            self.assertEqual(len(detailed_hours_report['employees']), employees)
+        self.assertGreater(len(self.emp_id_list), 1)
+
+    def test_next_starts(self):
+        """The one pass index has to find the same end as scanning forward for the next action of the same type"""
+        employee_list, employee_id_list = get_employee_list(self.company, ['-1'])
+        full_beg_date, full_end_date, time_actions_list = get_time_actions_list(
+            form=self.form_settings, employee_id_list=employee_id_list, company_info=self.company_info,
+            override_timezone=self.override_timezone)
+        report_engine = Report(employee_list=employee_list, time_actions_list=time_actions_list,
+                               form=self.form_settings, full_beg_date=full_beg_date, full_end_date=full_end_date,
+                               company=self.company, company_info=self.company_info,
+                               override_timezone=self.override_timezone)
+        for employee in employee_list:
+            employee_actions = report_engine.get_employee_actions(employee)
+            expected = []
+            for index, time_action in enumerate(employee_actions):
+                later = [action.start for action in employee_actions[index + 1:] if action.type == time_action.type]
+                expected.append(later[0] if later else None)
+            self.assertEqual(report_engine.get_next_starts(employee_actions), expected)
+
+    def test_unclosed_actions(self):
+        """Actions without an end are ended by the next action of the same type, or split at midnight"""
+        user = CustomUser.objects.create(first_name='han', last_name='solo', email='han@test.com', company=self.company)
+        for day in [16, 17, 19]:
+            InOutAction.objects.create(user=user, type='t', start=datetime(2023, 2, day, 15, 0, tzinfo=timezone.utc))
+            InOutAction.objects.create(user=user, type='b', start=datetime(2023, 2, day, 18, 0, tzinfo=timezone.utc),
+                                       end=datetime(2023, 2, day, 18, 30, tzinfo=timezone.utc))
+        employee_list, employee_id_list = get_employee_list(self.company, [str(user.id)])
+        full_beg_date, full_end_date, time_actions_list = get_time_actions_list(
+            form=self.form_settings, employee_id_list=employee_id_list, company_info=self.company_info,
+            override_timezone=self.override_timezone)
+        report_engine = Report(employee_list=employee_list, time_actions_list=time_actions_list,
+                               form=self.form_settings, full_beg_date=full_beg_date, full_end_date=full_end_date,
+                               company=self.company, company_info=self.company_info,
+                               override_timezone=self.override_timezone)
+        cur_time = datetime(2023, 2, 20, 12, 0, tzinfo=self.override_timezone)
+        action_objs = report_engine.organize_employee_actions(
+            cur_time, report_engine.get_employee_actions(employee_list[0]), self.override_timezone)
+
+        clock_actions = [(action['start'], action['end'], action['additional_text'])
+                         for action in action_objs if action['type'] == 't']
+        self.assertEqual([(start.strftime('%m/%d %H:%M'), end.strftime('%m/%d %H:%M'), text)
+                          for start, end, text in clock_actions], [
+            ('02/16 08:00', '02/16 23:59', '(Midnight Split)'),
+            ('02/17 00:00', '02/17 08:00', '(Midnight Split)'),
+            ('02/17 08:00', '02/17 23:59', '(Midnight Split)'),
+            ('02/19 00:00', '02/19 08:00', '(Midnight Split)'),
+            ('02/19 08:00', '02/19 23:59', '(Midnight Split With Predicted End Date)'),
+            ('02/20 00:00', '02/20 23:59', '(Midnight Split With Predicted End Date)'),
+        ])
+        self.assertTrue(report_engine.auto_inserted)
+
+    def test_render_report_pdf(self):
+        """The pdf is rendered in sections, the letter head and grand totals only show up once"""
+        CustomUser.objects.filter(id__in=self.emp_id_list).update(company=self.company)
+        form = dict(self.form_settings, display_clock_actions=True, display_employee_totals=True, display_grand_totals=True,
+                    report_type='time_tracker/reports/detailed_hours.html')
+        employee_list, employee_id_list = get_employee_list(self.company, ['-1'])
+        full_beg_date, full_end_date, time_actions_list = get_time_actions_list(
+            form=form, employee_id_list=employee_id_list, company_info=self.company_info,
+            override_timezone=self.override_timezone)
+        report_engine = Report(employee_list=employee_list, time_actions_list=time_actions_list,
+                               form=form, full_beg_date=full_beg_date, full_end_date=full_end_date,
+                               company=self.company, company_info=self.company_info,
+                               override_timezone=self.override_timezone)
+        page_arguments = report_engine.make_detailed_hours_report()
+
+        with override_settings(REPORT_PDF_CHUNK_SIZE=1):
+            with render_report_pdf(form['report_type'], page_arguments) as pdf_file:
+                reader = PdfReader(pdf_file)
+                pages = [page.extract_text() for page in reader.pages]
+        self.assertGreaterEqual(len(pages), len(page_arguments['employees']))
+        text = ''.join(pages)
+        self.assertEqual(text.count('Detailed Hours Report'), 1)
+        self.assertIn('Detailed Hours Report', pages[0])
+        self.assertEqual(text.count('Grand Totals'), 1)
+        self.assertIn('Grand Totals', pages[-1])
+        for employee in page_arguments['employees']:
+            self.assertIn(employee['name'], text)
+
+    def test_summary_report_engine(self):
+        """The summary totals added up by the database have to match the detailed report"""
+        CustomUser.objects.filter(id__in=self.emp_id_list).update(company=self.company)
+        # hundredths of an hour that are halves, python rounds 0.005 up and 0.125 to even by their binary values
+        tie_start = datetime(2023, 2, 21, 18, tzinfo=timezone.utc)
+        for seconds in [450, 162, 18]:
+            InOutAction.objects.create(user_id=self.emp_id_list[0], type='t', start=tie_start,
+                                       end=tie_start + timedelta(seconds=seconds))
+        total_keys = ['str_total', 'str_break', 'str_regular', 'str_overtime', 'str_daily_overtime',
+                      'str_weekly_overtime', 'str_total_with_break']
+        for hours_format in ['decimal', 'hours_and_minutes']:
+            for rounding in ['1', '10', '15']:
+                form = dict(self.form_settings, other_hours_format=hours_format, other_rounding=rounding)
+                reports = []
+                for report_class in [Report, SummaryReport]:
+                    employee_list, employee_id_list = get_employee_list(self.company, ['-1'])
+                    full_beg_date, full_end_date, time_actions_list = get_time_actions_list(
+                        form=form, employee_id_list=employee_id_list, company_info=self.company_info,
+                        override_timezone=self.override_timezone)
+                    report_engine = report_class(employee_list=employee_list, time_actions_list=time_actions_list,
+                                                 form=form, full_beg_date=full_beg_date, full_end_date=full_end_date,
+                                                 company=self.company, company_info=self.company_info,
+                                                 override_timezone=self.override_timezone)
+                    if report_class is SummaryReport:
+                        # the day totals and the actions that span midnight, are open or are rounded from a half
+                        with self.assertNumQueries(2):
+                            reports.append(report_engine.make_detailed_hours_report())
+                    else:
+                        reports.append(report_engine.make_detailed_hours_report())
+                detailed, summary = reports
+                self.assertEqual(len(detailed['employees']), len(summary['employees']))
+                for detailed_employee, summary_employee in zip(detailed['employees'], summary['employees']):
+                    self.assertEqual(detailed_employee['name'], summary_employee['name'])
+                    for key in total_keys:
+                        self.assertEqual(detailed_employee[key], summary_employee[key], (hours_format, rounding, key))
+                for key in total_keys + ['auto_inserted']:
+                    self.assertEqual(detailed[key], summary[key], (hours_format, rounding, key))
+
+    def test_parallel_report_engine(self):
+        """Building the employees in worker processes has to give the same report as building them one by one"""
+        CustomUser.objects.filter(id__in=self.emp_id_list).update(company=self.company)
+        results = []
+        for processes in [1, 2]:
+            employee_list, employee_id_list = get_employee_list(self.company, ['-1'])
+            full_beg_date, full_end_date, time_actions_list = get_time_actions_list(
+                form=self.form_settings, employee_id_list=employee_id_list, company_info=self.company_info,
+                override_timezone=self.override_timezone)
+            report_engine = Report(employee_list=employee_list, time_actions_list=time_actions_list,
+                                   form=self.form_settings, full_beg_date=full_beg_date, full_end_date=full_end_date,
+                                   company=self.company, company_info=self.company_info,
+                                   override_timezone=self.override_timezone, processes=processes, chunk_size=1)
+            results.append(remove_action_ids(report_engine.make_detailed_hours_report()))
+        self.assertEqual(len(results[1]['employees']), len(self.emp_id_list))
+        self.assertEqual(results[0], results[1])
+
+    def test_vectorized_report_engine(self):
+        """The numpy report has to match the python report exactly, including the rounding errors"""
+        CustomUser.objects.filter(id__in=self.emp_id_list).update(company=self.company)
+        # an employee working 7 long days in one week so the california 7th day rule kicks in
+        seven_day_employee = CustomUser.objects.create(first_name='seven', last_name='days', email='seven@test.com',
+                                                       company=self.company)
+        TTUserInfo.objects.filter(user=seven_day_employee).update(daily_overtime=True, daily_overtime_value=8,
+                                                                  double_time=False, weekly_overtime=True,
+                                                                  weekly_overtime_value=40)
+        for day in range(20, 27):
+            InOutAction.objects.create(user=seven_day_employee, type='t',
+                                       start=datetime(2023, 2, day, 6, 2, 11, tzinfo=self.override_timezone),
+                                       end=datetime(2023, 2, day, 16, 47, 3, tzinfo=self.override_timezone))
+        for hours_format in ['decimal', 'hours_and_minutes']:
+            for california_overtime in [False, True]:
+                for include_breaks in [False, True]:
+                    TTUserInfo.objects.filter(user__company=self.company).update(
+                        california_overtime=california_overtime, include_breaks_in_overtime_calculation=include_breaks)
+                    form_settings = dict(self.form_settings, other_hours_format=hours_format)
+                    results = []
+                    for report_class in [Report, VectorizedReport]:
+                        employee_list, employee_id_list = get_employee_list(self.company, ['-1'])
+                        full_beg_date, full_end_date, time_actions_list = get_time_actions_list(
+                            form=form_settings, employee_id_list=employee_id_list, company_info=self.company_info,
+                            override_timezone=self.override_timezone)
+                        report_engine = report_class(employee_list=employee_list, time_actions_list=time_actions_list,
+                                                     form=form_settings, full_beg_date=full_beg_date,
+                                                     full_end_date=full_end_date, company=self.company,
+                                                     company_info=self.company_info,
+                                                     override_timezone=self.override_timezone)
+                        results.append(remove_action_ids(report_engine.make_detailed_hours_report()))
+                    self.assertEqual(results[0], results[1])
+
+
+class TestReportJobs(TestCase):
+    """
+    Test generating reports in the background
+    """
+
+    def setUp(self):
+        company = Company.objects.create(name='Bounty Hunters')
+        self.user = CustomUser.objects.create(first_name='boba', last_name='fett', email='boba@test.com',
+                                              company=company)
+        InOutAction.objects.create(user=self.user, type='t',
+                                   start=datetime(2023, 2, 15, 14, 0, tzinfo=timezone.utc),
+                                   end=datetime(2023, 2, 15, 22, 30, tzinfo=timezone.utc))
+        self.form_data = {'begin_date': ['2023-02-15'], 'end_date': ['2023-02-28'],
+                          'report_type': ['time_tracker/reports/detailed_hours.html'],
+                          'selected_employees_list': [str(self.user.id)], 'other_rounding': ['5'],
+                          'other_hours_format': ['decimal'], 'other_font_size': ['medium']}
+
+    @mock.patch('time_tracker.report_jobs.send_user_message')
+    @mock.patch('time_tracker.report.S3_CLIENT')
+    def test_run_report_job(self, s3_client, send_user_message):
+        s3_client.generate_presigned_url.return_value = 'https://reports/link'
+        job = TTReportJob.objects.create(user=self.user, form_data=self.form_data)
+
+        run_report_job(job.id)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'c')
+        self.assertEqual(job.progress, 100)
+        self.assertTrue(job.report)
+        self.assertEqual(job.report_path, s3_client.upload_fileobj.call_args[0][2])
+
+        events = [call[0][1] for call in send_user_message.call_args_list]
+        for call in send_user_message.call_args_list:
+            self.assertEqual(call[0][0], self.user.id)
+        progress = [event['progress'] for event in events if event['type'] == 'report_progress']
+        self.assertEqual(progress, sorted(progress))
+        self.assertEqual(progress[-1], 100)
+        self.assertEqual(events[-1]['type'], 'notification')
+        self.assertEqual(events[-1]['link'], 'https://reports/link')
+
+    @mock.patch('time_tracker.report_jobs.send_user_message')
+    @mock.patch('time_tracker.report.S3_CLIENT')
+    def test_run_summary_report_job(self, s3_client, send_user_message):
+        job = TTReportJob.objects.create(user=self.user, form_data=dict(
+            self.form_data, report_type=['time_tracker/reports/summary.html']))
+
+        run_report_job(job.id)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'c')
+        self.assertEqual(job.report.folder, 'summary')
+        self.assertTrue(job.report.report_name.startswith('Summary Report'))
+
+    @mock.patch('time_tracker.report_jobs.send_user_message')
+    @mock.patch('time_tracker.report.S3_CLIENT')
+    def test_run_report_job_invalid_form(self, s3_client, send_user_message):
+        job = TTReportJob.objects.create(user=self.user, form_data=dict(self.form_data, report_type=['junk']))
+
+        run_report_job(job.id)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'f')
+        self.assertTrue(job.error)
+        self.assertFalse(s3_client.upload_fileobj.called)
+        self.assertEqual(send_user_message.call_args_list[-1][0][1]['title'], 'Report failed')
+
+
+    @mock.patch('time_tracker.report_jobs.send_user_message')
+    @mock.patch('time_tracker.report.S3_CLIENT')
+    def test_report_cache(self, s3_client, send_user_message):
+        first_job = TTReportJob.objects.create(user=self.user, form_data=self.form_data)
+        run_report_job(first_job.id)
+        first_job.refresh_from_db()
+
+        # the same report again is handed out without uploading another pdf
+        second_job = TTReportJob.objects.create(user=self.user, form_data=self.form_data)
+        with self.assertNumQueries(8):
+            run_report_job(second_job.id)
+        second_job.refresh_from_db()
+        self.assertEqual(s3_client.upload_fileobj.call_count, 1)
+        self.assertEqual(second_job.status, 'c')
+        self.assertEqual(second_job.report, first_job.report)
+        self.assertEqual(second_job.report_path, first_job.report_path)
+        self.assertEqual(TTReportCache.objects.get().hits, 1)
+
+        # a new time action changes the report
+        InOutAction.objects.create(user=self.user, type='t',
+                                   start=datetime(2023, 2, 16, 14, 0, tzinfo=timezone.utc),
+                                   end=datetime(2023, 2, 16, 22, 30, tzinfo=timezone.utc))
+        third_job = TTReportJob.objects.create(user=self.user, form_data=self.form_data)
+        run_report_job(third_job.id)
+        third_job.refresh_from_db()
+        self.assertEqual(s3_client.upload_fileobj.call_count, 2)
+        self.assertNotEqual(third_job.report, first_job.report)
+
+        # so does changing the employee's overtime settings
+        user_info = TTUserInfo.objects.get(user=self.user)
+        user_info.daily_overtime = True
+        user_info.save()
+        run_report_job(TTReportJob.objects.create(user=self.user, form_data=self.form_data).id)
+        self.assertEqual(s3_client.upload_fileobj.call_count, 3)
+
+        # and the names printed on it
+        self.user.first_name = 'din'
+        self.user.save()
+        run_report_job(TTReportJob.objects.create(user=self.user, form_data=self.form_data).id)
+        self.assertEqual(s3_client.upload_fileobj.call_count, 4)
+        company = self.user.company
+        company.name = 'Mandalorians'
+        company.save()
+        job = run_report_job(TTReportJob.objects.create(user=self.user, form_data=self.form_data).id)
+        self.assertEqual(s3_client.upload_fileobj.call_count, 5)
+
+        # a report someone else requested is copied, they keep theirs
+        other = CustomUser.objects.create(first_name='bo', last_name='katan', email='bo@test.com', company=company)
+        TTReports.objects.filter(id=job.report_id).update(user=other)
+        copy_job = run_report_job(TTReportJob.objects.create(user=self.user, form_data=self.form_data).id)
+        self.assertEqual(s3_client.upload_fileobj.call_count, 5)
+        self.assertEqual(copy_job.status, 'c')
+        self.assertEqual(copy_job.report.user, self.user)
+        self.assertNotEqual(copy_job.report_id, job.report_id)
+        self.assertEqual(s3_client.copy.call_args[0][0]['Key'], job.report_path)
+        self.assertEqual(s3_client.copy.call_args[0][2], copy_job.report_path)
+
+    @mock.patch('time_tracker.report_jobs.send_user_message')
+    @mock.patch('time_tracker.report.S3_CLIENT')
+    def test_report_cache_eviction(self, s3_client, send_user_message):
+        report_ids = []
+        for rounding in ['1', '5', '15']:
+            job = run_report_job(TTReportJob.objects.create(user=self.user,
+                                                            form_data=dict(self.form_data, other_rounding=[rounding])).id)
+            report_ids.append(job.report_id)
+        self.assertEqual(TTReportCache.objects.count(), 3)
+
+        # the least recently used report is dropped first
+        with override_settings(REPORT_CACHE_MAX_ENTRIES=2):
+            self.assertEqual(evict_report_cache(), 1)
+        self.assertEqual(sorted(TTReportCache.objects.values_list('report_id', flat=True)), report_ids[1:])
+
+
+    def test_report_job_status(self):
+        job = TTReportJob.objects.create(user=self.user, form_data=self.form_data)
+        self.client.force_login(self.user)
+        response = self.client.post(reverse('report_job_status'), {'job_id': encrypt_id(job.id)})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['status'], 'q')
+        for job_id in ['', 'not a token', encrypt_id(job.id + 1)]:
+            response = self.client.post(reverse('report_job_status'), {'job_id': job_id})
+            self.assertEqual(response.status_code, 404)
+            self.assertEqual(response.json(), {'errors': ['The report does not exist']})
+        self.assertEqual(self.client.get(reverse('report_job_status')).status_code, 405)
+
+    @mock.patch('time_tracker.report_jobs.send_user_message')
+    def test_lost_report_jobs(self, send_user_message):
+        stale = TTReportJob.objects.create(user=self.user, form_data=self.form_data, status='r')
+        TTReportJob.objects.filter(id=stale.id).update(updated_date=timezone.now() - timedelta(hours=1))
+        fresh = TTReportJob.objects.create(user=self.user, form_data=self.form_data)
+        self.assertEqual(fail_stale_report_jobs(), 1)
+        self.assertEqual(TTReportJob.objects.get(id=stale.id).status, 'f')
+        self.assertEqual(TTReportJob.objects.get(id=fresh.id).status, 'q')
+
+        # a broken pool is replaced once, then the job fails
+        executor = mock.Mock()
+        executor.submit.side_effect = BrokenProcessPool
+        with override_settings(REPORT_WORKER_PROCESSES=1), \
+                mock.patch('time_tracker.report_jobs.get_report_executor', return_value=executor), \
+                mock.patch('time_tracker.report_jobs.reset_report_executor') as reset_executor:
+            dispatch_report_job(fresh.id)
+        self.assertEqual(executor.submit.call_count, 2)
+        self.assertEqual(reset_executor.call_count, 2)
+        fresh.refresh_from_db()
+        self.assertEqual(fresh.status, 'f')
+        self.assertEqual(send_user_message.call_args[0][1]['title'], 'Report failed')
+
+        # a worker that dies takes its job with it
+        lost = TTReportJob.objects.create(user=self.user, form_data=self.form_data, status='r')
+        future = Future()
+        future.set_exception(BrokenProcessPool())
+        with mock.patch('time_tracker.report_jobs.reset_report_executor'):
+            check_report_future(lost.id, future)
+        self.assertEqual(TTReportJob.objects.get(id=lost.id).status, 'f')
+
+
+@override_settings(STATUS_CACHE_BUS_DIR=None)
+class TestDailyTotals(TransactionTestCase):
+    """
+    Test keeping the daily totals rollup up to date, the totals of a punch are updated once it commits
+    """
+
+    def setUp(self):
+        company = Company.objects.create(name='Rebels')
+        self.user = CustomUser.objects.create(first_name='luke', last_name='skywalker', email='luke@test.com',
+                                              company=company, timezone='America/Denver')
+        self.user.refresh_from_db()
+
+    def get_totals(self):
+        return {(row.date, row.type): row.total_time for row in TTDailyTotal.objects.filter(user=self.user)}
+
+    def test_daily_totals(self):
+        # 8am to 4pm in Denver
+        action = InOutAction.objects.create(user=self.user, type='t',
+                                            start=datetime(2023, 3, 1, 15, 0, tzinfo=timezone.utc),
+                                            end=datetime(2023, 3, 1, 23, 0, tzinfo=timezone.utc))
+        InOutAction.objects.create(user=self.user, type='b',
+                                   start=datetime(2023, 3, 1, 19, 0, tzinfo=timezone.utc),
+                                   end=datetime(2023, 3, 1, 19, 30, tzinfo=timezone.utc))
+        self.assertEqual(self.get_totals(), {(date(2023, 3, 1), 't'): 8 * 3600, (date(2023, 3, 1), 'b'): 1800})
+
+        # open actions aren't counted until they are finished
+        night = InOutAction.objects.create(user=self.user, type='t', start=datetime(2023, 3, 3, 3, 0, tzinfo=timezone.utc))
+        self.assertEqual(len(self.get_totals()), 2)
+
+        # 8pm to 2am in Denver is split at midnight
+        night.end = datetime(2023, 3, 3, 9, 0, tzinfo=timezone.utc)
+        night.save()
+        totals = self.get_totals()
+        self.assertEqual(totals[(date(2023, 3, 2), 't')], 4 * 3600)
+        self.assertEqual(totals[(date(2023, 3, 3), 't')], 2 * 3600)
+
+        # moving an action clears the day it was on
+        action = InOutAction.objects.get(id=action.id)
+        action.start = datetime(2023, 3, 6, 15, 0, tzinfo=timezone.utc)
+        action.end = datetime(2023, 3, 6, 16, 0, tzinfo=timezone.utc)
+        action.save()
+        totals = self.get_totals()
+        self.assertNotIn((date(2023, 3, 1), 't'), totals)
+        self.assertEqual(totals[(date(2023, 3, 6), 't')], 3600)
+
+        InOutAction.objects.get(id=night.id).delete()
+        self.assertEqual(get_daily_totals(self.user, date(2023, 3, 1), date(2023, 3, 31)),
+                         {date(2023, 3, 1): {'b': 1800}, date(2023, 3, 6): {'t': 3600}})
+
+    def test_daily_totals_upkeep_queries(self):
+        # the rollup only feeds the manage_times calendar, ending an action keeps the upkeep to a few small queries
+        action = InOutAction.objects.create(user=self.user, type='t',
+                                            start=datetime(2023, 3, 1, 15, 0, tzinfo=timezone.utc),
+                                            end=datetime(2023, 3, 1, 23, 0, tzinfo=timezone.utc))
+        with self.assertNumQueries(0):
+            action.update_daily_totals((action.start, None))
+        with self.assertNumQueries(5):
+            action.update_daily_totals((action.start, None), (action.start, action.end))
+
+    def test_concurrent_daily_totals(self):
+        InOutAction.objects.create(user=self.user, type='t', start=datetime(2023, 3, 1, 15, 0, tzinfo=timezone.utc),
+                                   end=datetime(2023, 3, 1, 23, 0, tzinfo=timezone.utc))
+        calc_daily_totals = daily_totals.calc_daily_totals
+
+        def calc_with_other_punch(*args, **kwargs):
+            totals = calc_daily_totals(*args, **kwargs)
+            # another punch of the user writes the day's row in the meantime
+            TTDailyTotal.objects.update_or_create(user=self.user, date=date(2023, 3, 1), type='t',
+                                                  defaults={'total_time': 1, 'timezone': 'America/Denver'})
+            return totals
+        with mock.patch('time_tracker.daily_totals.calc_daily_totals', side_effect=calc_with_other_punch):
+            update_daily_totals(self.user.id, {date(2023, 3, 1)}, get_timezone(self.user))
+        self.assertEqual(self.get_totals(), {(date(2023, 3, 1), 't'): 8 * 3600})
+
+    def test_timezone_change(self):
+        # 8pm to 10pm in Denver is the next day in utc
+        InOutAction.objects.create(user=self.user, type='t', start=datetime(2023, 3, 2, 3, 0, tzinfo=timezone.utc),
+                                   end=datetime(2023, 3, 2, 5, 0, tzinfo=timezone.utc))
+        self.assertEqual(self.get_totals(), {(date(2023, 3, 1), 't'): 2 * 3600})
+        self.user.timezone = 'UTC'
+        self.user.save()
+        self.assertEqual(self.get_totals(), {(date(2023, 3, 2), 't'): 2 * 3600})
+
+        # the company's timezone the user goes by now
+        company = self.user.company
+        company.timezone = 'America/Denver'
+        company.use_company_timezone = True
+        company.save()
+        self.assertEqual(self.get_totals(), {(date(2023, 3, 1), 't'): 2 * 3600})
+
+        # rows left in the old timezone are summed from the actions when they are read, without writing any rows
+        TTDailyTotal.objects.filter(user=self.user).update(timezone='UTC', date=date(2023, 3, 2))
+        self.user.refresh_from_db()
+        with self.assertNumQueries(4):
+            self.assertEqual(get_daily_totals(self.user, date(2023, 3, 1), date(2023, 3, 2)),
+                             {date(2023, 3, 1): {'t': 7200}})
+        self.assertEqual(self.get_totals(), {(date(2023, 3, 2), 't'): 2 * 3600})
+
+    def test_fetch_daily_totals(self):
+        other = CustomUser.objects.create(first_name='han', last_name='solo', email='han@test.com',
+                                          company=Company.objects.create(name='Smugglers'))
+        coworker = CustomUser.objects.create(first_name='leia', last_name='organa', email='leia@test.com',
+                                             company=self.user.company)
+        self.client.force_login(self.user)
+        data = {'start': '2023-03-01', 'end': '2023-03-31'}
+        response = self.client.post(reverse('get_daily_totals'), dict(data, employee_id=encrypt_id(coworker.id)))
+        self.assertEqual(response.status_code, 201)
+        for employee_id in [encrypt_id(other.id), 'junk']:
+            response = self.client.post(reverse('get_daily_totals'), dict(data, employee_id=employee_id))
+            self.assertEqual(response.status_code, 404)
+
+    def test_rebuild_daily_totals(self):
+        InOutAction.objects.create(user=self.user, type='t',
+                                   start=datetime(2023, 3, 1, 15, 0, tzinfo=timezone.utc),
+                                   end=datetime(2023, 3, 1, 23, 0, tzinfo=timezone.utc))
+        call_command('rebuild_daily_totals', '--verify', stdout=StringIO())
+
+        TTDailyTotal.objects.filter(user=self.user).update(total_time=0)
+        with self.assertRaises(CommandError):
+            call_command('rebuild_daily_totals', '--verify', stdout=StringIO())
+
+        call_command('rebuild_daily_totals', '--user', str(self.user.id), stdout=StringIO())
+        self.assertEqual(self.get_totals(), {(date(2023, 3, 1), 't'): 8 * 3600})
+        call_command('rebuild_daily_totals', '--verify', stdout=StringIO())
+
+
+class TestActionImport(TestCase):
+    """
+    Test importing time actions in bulk
+    """
+
+    def setUp(self):
+        company = Company.objects.create(name='Rebels')
+        self.user = CustomUser.objects.create(first_name='leia', last_name='organa', email='leia@test.com',
+                                              company=company, timezone='America/Denver')
+
+    def test_import_actions(self):
+        rows = [
+            {'email': 'Leia@test.com', 'type': 't', 'start': '2023-03-01 08:00', 'end': '2023-03-01 16:00'},
+            {'user_id': str(self.user.id), 'type': 'b', 'start': '2023-03-01T19:00:00+00:00',
+             'end': '2023-03-01T19:30:00+00:00'},
+            {'email': 'leia@test.com', 'type': 't', 'start': '2023-03-02 08:00', 'comment': 'forgot to clock out'},
+            {'email': 'vader@test.com', 'type': 't', 'start': '2023-03-01 08:00'},
+            {'email': 'leia@test.com', 'type': 'x', 'start': '2023-03-01 08:00'},
+            {'email': 'leia@test.com', 'type': 't', 'start': '2023-03-01 08:00', 'end': '2023-03-01 07:00'},
+            {'email': 'leia@test.com', 'type': 't', 'start': 'yesterday'},
+        ]
+        result = import_actions(rows, dry_run=True)
+        self.assertEqual(result['created'], 3)
+        self.assertFalse(InOutAction.objects.filter(user=self.user).exists())
+
+        result = import_actions(rows, batch_size=2)
+        self.assertEqual(result['created'], 3)
+        self.assertEqual(result['users'], 1)
+        self.assertEqual([row_number for row_number, error in result['errors']], [4, 5, 6, 7])
+
+        clock_in = InOutAction.objects.get(user=self.user, type='t', end__isnull=False)
+        self.assertEqual(clock_in.start, datetime(2023, 3, 1, 15, 0, tzinfo=timezone.utc))
+        self.assertEqual(clock_in.total_time, 8 * 3600)
+        self.assertEqual(clock_in.action_lookup_datetime, clock_in.end)
+
+        user_info = TTUserInfo.objects.get(user=self.user)
+        self.assertEqual(user_info.time_action.comment, 'forgot to clock out')
+        self.assertEqual(user_info.status_text, 'i')
+        self.assertEqual(get_daily_totals(self.user, date(2023, 3, 1), date(2023, 3, 31)),
+                         {date(2023, 3, 1): {'t': 8 * 3600, 'b': 1800}})
+
+    def test_import_actions_command(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as csv_file:
+            csv_file.write('email,type,start,end,comment\n')
+            for day in range(1, 21):
+                csv_file.write('leia@test.com,t,2023-03-%02d 08:00,2023-03-%02d 16:00,\n' % (day, day))
+        out = StringIO()
+        # the number of queries doesn't grow with the rows, only with the batches and users. 2023 is older than the
+        # archive horizon, the daily totals look for archived actions too. The latest archive cutoff is read once per
+        # process, before the queries are counted.
+        get_archived_before()
+        with self.assertNumQueries(19):
+            call_command('import_actions', csv_file.name, '--batch-size', '10', stdout=out)
+        os.remove(csv_file.name)
+        self.assertIn('Imported 20 actions for 1 users', out.getvalue())
+        self.assertEqual(TTUserInfo.objects.get(user=self.user).status_text, 'o')
+
+
+@override_settings(STATUS_CACHE_BUS_DIR=None)
+class TestActionArchive(TransactionTestCase):
+    """
+    Test moving old actions into the archive tables, the sqlite schema editor can't run inside a transaction
+    """
+
+    def setUp(self):
+        company = Company.objects.create(name='Test')
+        self.user = CustomUser.objects.create(first_name='Leia', last_name='Organa', email='leia@test.com',
+                                              company=company)
+        yesterday = timezone.now() - timedelta(days=1)
+        import_actions([
+            {'user_id': self.user.id, 'start': '2020-03-02 08:00', 'end': '2020-03-02 16:00', 'comment': 'old'},
+            {'user_id': self.user.id, 'type': 'b', 'start': '2020-03-02 12:00', 'end': '2020-03-02 12:30'},
+            {'user_id': self.user.id, 'start': '2021-06-01 22:00', 'end': '2021-06-02 06:00'},
+            {'user_id': self.user.id, 'start': (yesterday - timedelta(hours=8)).isoformat(),
+             'end': yesterday.isoformat()},
+        ])
+
+    def tearDown(self):
+        for year in TTActionArchive.objects.values_list('year', flat=True):
+            get_archive_model(year).objects.all().delete()
+
+    def test_archive_actions(self):
+        totals = get_daily_totals(self.user, date(2020, 1, 1), date(2021, 12, 31))
+        old_id = InOutAction.objects.get(comment='old').id
+        out = StringIO()
+        call_command('archive_actions', stdout=out)
+        self.assertIn('Archived 2 actions', out.getvalue())
+        # the break is the user's current break action, it stays
+        self.assertEqual(InOutAction.objects.filter(user=self.user).count(), 2)
+        self.assertEqual(dict(TTActionArchive.objects.values_list('year', 'actions')), {2020: 1, 2021: 1})
+        self.assertEqual(archive_actions(), {})
+
+        # the rollup is kept and can still be rebuilt from the archive
+        self.assertEqual(get_daily_totals(self.user, date(2020, 1, 1), date(2021, 12, 31)), totals)
+        self.assertEqual(verify_daily_totals(self.user, get_timezone(self.user)), [])
+
+        company_info = TTCompanyInfo.objects.get(company=self.user.company)
+        form = {'begin_date': date(2020, 3, 2), 'end_date': date(2021, 6, 2)}
+        time_actions = get_time_actions_list(form, [self.user.id], company_info, None)[2]
+        self.assertEqual([(time_action.type, time_action.comment) for time_action in time_actions],
+                         [('b', ''), ('t', 'old'), ('t', '')])
+        # the archived actions keep their ids
+        self.assertEqual(time_actions[1].id, old_id)
+        form = get_benchmark_form(date(2020, 3, 2), 3)
+        full_beg_date, full_end_date, time_actions = get_time_actions_list(form, [self.user.id], company_info, None)
+        employee_list = get_employee_list(self.user.company, ['-1'])[0]
+        reports = [report_class(employee_list, time_actions, form, full_beg_date, full_end_date, self.user.company,
+                                company_info, None).make_detailed_hours_report()
+                   for report_class in [Report, SummaryReport]]
+        self.assertEqual(reports[0]['str_total'], reports[1]['str_total'])
+        self.assertEqual(reports[0]['str_break'], '0.5')
+
+        events = async_to_sync(aget_events_by_range)(self.user, '2020-03-01T00:00:00+00:00', '2020-03-03T00:00:00+00:00')
+        self.assertEqual(sorted((event['title'], event.get('editable', True)) for event in events),
+                         [('Break', True), ('Clocked In', False)])
+
+        # a range newer than the horizon doesn't look for archives
+        with self.assertNumQueries(0):
+            self.assertEqual(get_archived_actions(timezone.now() - timedelta(days=7), timezone.now()), [])
+
+        self.user.delete()
+        archive_actions()
+        self.assertFalse(get_archive_model(2020).objects.exists())
+        self.assertEqual(TTActionArchive.objects.get(year=2020).actions, 0)
+
+
+    def test_archive_columns(self):
+        # a table made before the geofence flags were archived
+        import_actions([{'user_id': self.user.id, 'start': '2019-05-01 08:00', 'end': '2019-05-01 16:00',
+                         'comment': 'older'}])
+        old_fields = [name for name in archive.ARCHIVE_FIELDS if not name.endswith('_outside_fence')]
+        with mock.patch.object(archive, 'ARCHIVE_FIELDS', old_fields):
+            forget_archive_model(2019)
+            archive_actions()
+        # read by a process that knows the flags
+        forget_archive_model(2019)
+        older = get_archived_actions(datetime(2019, 1, 1, tzinfo=timezone.utc), datetime(2019, 12, 31, tzinfo=timezone.utc))
+        self.assertEqual([(action.comment, action.start_outside_fence) for action in older], [('older', None)])
+
+        # the next run adds the columns
+        import_actions([{'user_id': self.user.id, 'start': '2019-05-02 08:00', 'end': '2019-05-02 16:00'}])
+        InOutAction.objects.filter(user=self.user, start__year=2019).update(start_outside_fence=True)
+        archive_actions()
+        older = get_archived_actions(datetime(2019, 1, 1, tzinfo=timezone.utc), datetime(2019, 12, 31, tzinfo=timezone.utc))
+        self.assertEqual(sorted((action.comment, action.start_outside_fence) for action in older),
+                         [('', True), ('older', None)])
+
+        # the archive is found by where the runs stopped, not by the current setting
+        with override_settings(ACTION_ARCHIVE_DAYS=365 * 10):
+            self.assertEqual(len(get_archived_actions(datetime(2021, 6, 1, tzinfo=timezone.utc))), 1)
+
+
+@tag('benchmark')
+class TestReportBenchmark(TestCase):
+    """
+    Small runs of the report benchmark, the query counts of the hot path must not grow with the employees
+    """
+
+    def run_benchmark(self, employees, seed):
+        company, begin_date = create_synthetic_company(employees=employees, days=14, overnight_ratio=0.2,
+                                                       open_ratio=0.1, timezones=['America/Denver', 'UTC'], seed=seed)
+        form = get_benchmark_form(begin_date, 14)
+        return run_report_benchmark(company, form, stages=['query', 'organize', 'totals', 'render'],
+                                    trace_memory=False)
+
+    def test_report_benchmark(self):
+        # the latest archive cutoff is read once per process, not by the first run
+        get_archived_before()
+        small = self.run_benchmark(2, seed=1)
+        large = self.run_benchmark(6, seed=2)
+
+        self.assertEqual(list(large['stages']), ['query', 'organize', 'totals', 'render'])
+        self.assertEqual(large['employees'], 6)
+        self.assertTrue(large['actions'])
+        json.dumps(large)
+        for stage in small['stages']:
+            self.assertEqual(small['stages'][stage]['queries'], large['stages'][stage]['queries'], stage)
+        self.assertEqual(large['stages']['organize']['queries'], 0)
+        self.assertEqual(large['stages']['totals']['queries'], 0)
+
+
+class TestIdCodec(TestCase):
+    """
+    The short tokens are the same every time, can't be forged and the Fernet tokens handed out before still work
+    """
+
+    def setUp(self):
+        clear_id_decode_cache()
+
+    def test_block_tokens(self):
+        fernet = FernetIdCodec(get_master_key())
+        token = encrypt_id(42)
+        self.assertEqual(len(token), 22)
+        self.assertEqual(token, encrypt_id('42'))
+        self.assertNotEqual(token, encrypt_id(43))
+        self.assertEqual(decrypt_id(token), 42)
+        self.assertEqual(BlockIdCodec(get_master_key()).encode(42), token)
+        self.assertEqual(decrypt_id(fernet.encode(42)), 42)
+
+        ids = [1, 2, 2 ** 40, 7]
+        tokens = encrypt_ids(ids)
+        self.assertEqual(tokens, [encrypt_id(in_id) for in_id in ids])
+        self.assertEqual(decrypt_ids(tokens + [fernet.encode(9)]), ids + [9])
+        self.assertEqual(encrypt_ids([]), [])
+
+        changed = token[:5] + ('A' if token[5] != 'A' else 'B') + token[6:]
+        for bad_token in [changed, '', 'not a token', '!' * 22]:
+            with self.assertRaises(InvalidToken):
+                decrypt_id(bad_token)
+        with self.assertRaises(InvalidToken):
+            decrypt_ids([token, changed])
+        with self.assertRaises(ValueError):
+            encrypt_id(-1)
+
+    @override_settings(ID_CODEC='daxApp.encryption.FernetIdCodec')
+    def test_fernet_codec(self):
+        token = encrypt_id(42)
+        self.assertNotEqual(token, encrypt_id(42))
+        self.assertEqual(decrypt_ids([token, encrypt_id(42)]), [42, 42])
+
+        # a codec has to encode and decode
+        with self.assertRaises(TypeError):
+            IdCodec(get_master_key())
+
+    @override_settings(ID_DECODE_CACHE_SIZE=3)
+    def test_decode_cache(self):
+        tokens = encrypt_ids([1, 2, 3, 4])
+        self.assertEqual(decrypt_id(tokens[0]), 1)
+        self.assertEqual(decrypt_id(tokens[0]), 1)
+        self.assertEqual(decrypt_ids([tokens[0], tokens[1], tokens[1], 'bad', None], skip_invalid=True),
+                         [1, 2, 2, None, None])
+        self.assertEqual(get_id_decode_stats(), {'hits': 2, 'misses': 4, 'size': 2, 'hit_rate': 0.3333})
+        with self.assertRaises(InvalidToken):
+            decrypt_ids([tokens[2], 'bad'])
+
+        # the least recently used token is dropped
+        decrypt_ids(tokens[2:])
+        decrypt_id(tokens[0])
+        self.assertEqual(get_id_decode_stats()['size'], 3)
+        with mock.patch.object(BlockIdCodec, 'decode', side_effect=AssertionError):
+            self.assertEqual(decrypt_id(tokens[0]), 1)
+            self.assertEqual(decrypt_id(tokens[3]), 4)
+            with self.assertRaises(AssertionError):
+                decrypt_id(tokens[1])
+
+    def test_id_codec_benchmark(self):
+        results = run_id_codec_benchmark(count=50)
+        self.assertEqual(results['BlockIdCodec']['token_length'], 22)
+        self.assertTrue(results['BlockIdCodec']['deterministic'])
+        self.assertFalse(results['FernetIdCodec']['deterministic'])
+        for timings in results.values():
+            self.assertTrue(timings['correct'])
+
+
+@override_settings(STATUS_CACHE_BUS_DIR=None)
+class TestViewLoadTest(TransactionTestCase):
+    """
+    A small run of the view load test, the handlers use their own connections so nothing can be rolled back. The in
+    memory test database locks whole tables, only one client is run.
+    """
+
+    def test_view_load_test(self):
+        company, sessions = create_load_test_clients(1)
+        try:
+            for server in ['asgi', 'wsgi']:
+                results = run_view_load_test(sessions, rounds=2, server=server)
+                self.assertEqual(results['requests'], 6)
+                self.assertEqual(results['statuses'], {200: 4, 201: 2})
+                self.assertTrue(results['requests_per_second'])
+        finally:
+            delete_load_test_clients(company, sessions)
+        self.assertFalse(CustomUser.objects.filter(company=company).exists())
+        self.assertFalse(InOutAction.objects.exists())
+
 
 class TestPayPeriod(TestCase):
     def test_weekly(self):
@@ -4,9 +4,13 @@ from . import views
 
 urlpatterns = [
     path('simple_clock/', views.simple_clock, name='simple_clock'),
+    path('punch/', views.punch_clock, name='punch'),
+    path('punch/sync/', views.punch_sync, name='punch_sync'),
     path('manage_times/', views.manage_times, name='manage_times'),
     path('manage_times/event/', views.event_handler, name='manage_time_event'),
     path('get_time_actions', views.fetch_actions, name='get_time_actions'),
+    path('get_daily_totals', views.fetch_daily_totals, name='get_daily_totals'),
     path('delete_action', views.delete_action, name='delete_action'),
-    path('report_center/', views.report_center, name='report_center')
+    path('report_center/', views.report_center, name='report_center'),
+    path('report_center/job_status', views.report_job_status, name='report_job_status'),
 ]
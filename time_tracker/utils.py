@@ -1,9 +1,13 @@
 import logging
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from datetime import date, datetime, timezone, timedelta
 from .models import InOutAction
+from .archive import get_archived_actions, areaches_archive
+from .daily_totals import get_local_midnight
 from middleware.timezone import get_timezone
 from json import dumps
-from daxApp.encryption import encrypt_id, decrypt_id
+from daxApp.encryption import encrypt_id, encrypt_ids, decrypt_id
 from .forms import SimpleClockForm
 
 logger = logging.getLogger("django.request")
@@ -18,58 +22,71 @@ def combine_comments(first, second):
     return final_comment
 
 
+def get_month_range(in_date, user_timezone):
+    """Midnight at the start of the month and of the next month, a range can use the indexes where __year and
+        __month can't"""
+    month_start = in_date.replace(day=1)
+    next_month_start = (month_start + timedelta(days=32)).replace(day=1)
+    return get_local_midnight(month_start, user_timezone), get_local_midnight(next_month_start, user_timezone)
+
+
 def get_events_by_month(user, in_date=date.today()):
-    actions = InOutAction.objects.filter(user=user, action_lookup_datetime__year=in_date.year, action_lookup_datetime__month=in_date.month)
     user_timezone = get_timezone(user)
-    action_list = []
-    for action in actions:
-        action_dict = {'id': encrypt_id(action.id)}
-        start = action.start
-        if start:
-            action_dict['start'] = start.astimezone(user_timezone).strftime("%Y-%m-%d %H:%M:%S")
-        end = action.end
-        if end:
-            action_dict['end'] = end.astimezone(user_timezone).strftime("%Y-%m-%d %H:%M:%S")
-        comment = action.comment
-        if comment:
-            action_dict['comment'] = comment
-        type = action.type
-        if type == 't':
-            action_dict['title'] = 'Clocked In'
-            action_dict['className'] = 'bg-soft-success'
-        elif type == 'b':
-            action_dict['title'] = 'Break'
-            action_dict['className'] = 'bg-soft-primary'
-        action_list.append(action_dict)
-    return dumps(action_list)
-
-
-def get_events_by_range(user, in_start, in_end):
+    month_start, next_month_start = get_month_range(in_date, user_timezone)
+    actions = InOutAction.objects.filter(user=user, action_lookup_datetime__gte=month_start,
+                                         action_lookup_datetime__lt=next_month_start)
+    return dumps(get_action_events(actions, user_timezone))
+
+
+async def aget_events_by_range(user, in_start, in_end):
+    """The calendar events of the user between in_start and in_end, the user's company has to be loaded already"""
     in_start = datetime.fromisoformat(in_start)
     in_end = datetime.fromisoformat(in_end)
-    actions = InOutAction.objects.filter(user=user, action_lookup_datetime__gte=in_start, action_lookup_datetime__lte=in_end)
-    user_timezone = get_timezone(user)
-    action_list = []
-    for action in actions:
-        action_dict = {'id': encrypt_id(action.id)}
-        start = action.start
-        if start:
-            action_dict['start'] = start.astimezone(user_timezone).strftime("%Y-%m-%d %H:%M:%S")
-        end = action.end
-        if end:
-            action_dict['end'] = end.astimezone(user_timezone).strftime("%Y-%m-%d %H:%M:%S")
-        comment = action.comment
-        if comment:
-            action_dict['comment'] = comment
-        type = action.type
-        if type == 't':
-            action_dict['title'] = 'Clocked In'
-            action_dict['className'] = 'bg-soft-success'
-        elif type == 'b':
-            action_dict['title'] = 'Break'
-            action_dict['className'] = 'bg-soft-primary'
-        action_list.append(action_dict)
-    return action_list
+    actions = [action async for action in InOutAction.objects.filter(user=user, action_lookup_datetime__gte=in_start,
+                                                                     action_lookup_datetime__lte=in_end)]
+    if await areaches_archive(in_start):
+        actions = await sync_to_async(get_archived_actions)(in_start, in_end, user=user) + actions
+    if settings.PUNCH_WRITE_BEHIND:
+        from .punch_buffer import get_buffered_actions
+        actions = await sync_to_async(get_buffered_actions)(user, actions, in_start, in_end)
+    return get_action_events(actions, get_timezone(user))
+
+
+def get_action_events(actions, user_timezone):
+    """The calendar events of the actions, their ids are encrypted together"""
+    actions = list(actions)
+    action_ids = iter(encrypt_ids([action.id for action in actions if action.id]))
+    return [get_action_event(action, user_timezone, next(action_ids) if action.id else '') for action in actions]
+
+
+def get_action_event(action, user_timezone, action_id=None):
+    """The calendar event of an action, action_id is its encrypted id if it has been encrypted already"""
+    if action.id and action_id is None:
+        action_id = encrypt_id(action.id)
+    if getattr(action, 'archived', False):
+        action_dict = {'id': action_id, 'editable': False}
+    elif action.id:
+        action_dict = {'id': action_id}
+    else:
+        # a punch that is still in the punch log, it can be edited once it is saved
+        action_dict = {'id': '', 'editable': False}
+    start = action.start
+    if start:
+        action_dict['start'] = start.astimezone(user_timezone).strftime("%Y-%m-%d %H:%M:%S")
+    end = action.end
+    if end:
+        action_dict['end'] = end.astimezone(user_timezone).strftime("%Y-%m-%d %H:%M:%S")
+    comment = action.comment
+    if comment:
+        action_dict['comment'] = comment
+    type = action.type
+    if type == 't':
+        action_dict['title'] = 'Clocked In'
+        action_dict['className'] = 'bg-soft-success'
+    elif type == 'b':
+        action_dict['title'] = 'Break'
+        action_dict['className'] = 'bg-soft-primary'
+    return action_dict
 
 
 def add_edit_time(user, post):
@@ -141,17 +158,15 @@ def add_edit_time(user, post):
     return errors, action_id
 
 
-def delete_event(user, action_id):
+async def adelete_event(user, action_id):
     """
     Handles deleting an existing action.
     """
     # TODO this should be updated to double check that the user has permissions to delete the other users action id. For now I will just assert that the users belong to the same company.
     try:
-        event = InOutAction.objects.get(id=decrypt_id(action_id))
+        event = await InOutAction.objects.select_related('user').aget(id=decrypt_id(action_id))
     except InOutAction.DoesNotExist:
         return {'errors': ['The action submitted does not exist'], 'Success': False}
-    if event.user.company == user.company:
-        event.delete()
+    if event.user.company_id == user.company_id:
+        await sync_to_async(event.delete)()
     return {'errors': [], 'Success': True}
-
-
@@ -1,25 +1,35 @@
+import json
 import logging
+from django.conf import settings
 from django.shortcuts import render
 from django.http import JsonResponse
 from django.contrib.auth.decorators import login_required
 from django.utils import timezone
 
-from .models import InOutAction, TTUserInfo
-from .utils import combine_comments, get_events_by_range, add_edit_time, delete_event
+from .models import InOutAction, TTUserInfo, TTReportJob
+from .utils import combine_comments, aget_events_by_range, add_edit_time, adelete_event
+from .daily_totals import get_daily_total_events
+from .punch import punch, sync_punches
+from .status_cache import get_cached_user_info
 from users.models import CustomUser
-from daxApp.encryption import decrypt_id
+from cryptography.fernet import InvalidToken
+from daxApp.encryption import encrypt_id, decrypt_id
+from django.contrib import messages
 from daxApp.central_data import get_main_page_data
+from daxApp.decorators import async_login_required
 from users.utils import get_selectable_employees
 from .forms import ReportsForm
-from .report import generate_report
+from .report_jobs import submit_report_job, get_report_job_status
 from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
+from asgiref.sync import async_to_sync, sync_to_async
 
 logger = logging.getLogger("django.request")
 
 
-@login_required
-def simple_clock(request):
+@async_login_required
+async def simple_clock(request):
+    if settings.PUNCH_WRITE_BEHIND:
+        return await sync_to_async(simple_clock_write_behind)(request)
     if request.method == 'POST':
         # and example of how to send a message to a user.
         # channel_layer = get_channel_layer()
@@ -37,34 +47,51 @@ def simple_clock(request):
         action = request.POST.get('action', None)
         comment = request.POST.get('comment', '')
         if action:
-            user_info = TTUserInfo.objects.filter(user=request.user)[0]
+            user_info = await TTUserInfo.objects.select_related('time_action', 'break_action').filter(
+                user=request.user).afirst()
             if action == 'in':
                 # add a clock action
-                InOutAction.objects.create(user=request.user, type='t', comment=comment)
+                await InOutAction.objects.acreate(user=request.user, type='t', comment=comment)
             elif action == 'out':
                 # update the existing user clock action
                 time_action = user_info.time_action
                 if not time_action.end:
                     time_action.comment = combine_comments(time_action.comment, comment)
                     time_action.end = timezone.now()
-                    time_action.save()
+                    await sync_to_async(time_action.save)()
                 else:
                     logger.error('Tried to set clock out but time action already has an end date. TimeAction:' + str(
                                     time_action.id))
             elif action == 'b_in':
                 # create a break action
-                InOutAction.objects.create(user=request.user, type='b', comment=comment)
+                await InOutAction.objects.acreate(user=request.user, type='b', comment=comment)
             elif action == 'b_out':
                 # Update the existing user break action
                 break_action = user_info.break_action
                 if not break_action.end:
                     break_action.comment = combine_comments(break_action.comment, comment)
                     break_action.end = timezone.now()
-                    break_action.save()
+                    await sync_to_async(break_action.save)()
                 else:
                     logger.error('Tried to set break out but break action already has an end date. BreakAction:' + str(
                                     break_action.id))
-    user_info = TTUserInfo.objects.filter(user=request.user)[0]
+    user_info = await sync_to_async(get_cached_user_info)(request.user)
+    page = 'time_tracker/widgets/simple_clock_in.html'
+    page_arguments = {
+        'tt_user_info': user_info
+    }
+
+    return render(request, page, page_arguments)
+
+
+def simple_clock_write_behind(request):
+    """simple_clock with the punch logged for the punch flusher to save, the status includes the logged punches"""
+    from .punch_buffer import buffer_clock_action, get_buffered_user_info
+    action = request.POST.get('action', None) if request.method == 'POST' else None
+    if action:
+        user_info = buffer_clock_action(request.user, action, request.POST.get('comment', ''))
+    else:
+        user_info = get_buffered_user_info(request.user)
     page = 'time_tracker/widgets/simple_clock_in.html'
     page_arguments = {
         'tt_user_info': user_info
@@ -73,6 +100,33 @@ def simple_clock(request):
     return render(request, page, page_arguments)
 
 
+@login_required
+def punch_clock(request):
+    """The json version of simple_clock for the kiosks and the mobile app, responds with the new status"""
+    if request.POST:
+        idempotency_key = request.headers.get('Idempotency-Key') or request.POST.get('idempotency_key', '')
+        data, status = punch(request.user, request.POST.get('action', ''), request.POST.get('comment', ''),
+                             idempotency_key, request.POST.get('lat'), request.POST.get('lon'))
+        return JsonResponse(data=data, status=status, safe=False)
+    return JsonResponse(data={'errors': ['Punches have to be posted']}, status=405, safe=False)
+
+
+@login_required
+def punch_sync(request):
+    """Takes the punches a kiosk or phone queued while it was offline, as a json body or a posted punches field"""
+    if request.method == 'POST':
+        try:
+            if request.content_type == 'application/json':
+                events = json.loads(request.body).get('punches')
+            else:
+                events = json.loads(request.POST.get('punches', ''))
+        except (ValueError, AttributeError):
+            return JsonResponse(data={'errors': ['The punches could not be read']}, status=400, safe=False)
+        data, status = sync_punches(request.user, events)
+        return JsonResponse(data=data, status=status, safe=False)
+    return JsonResponse(data={'errors': ['Punches have to be posted']}, status=405, safe=False)
+
+
 @login_required
 def manage_times(request):
     page = 'time_tracker/manage_times.html'
@@ -83,36 +137,51 @@ def manage_times(request):
     return render(request, page, page_arguments)
 
 
-@login_required
-def event_handler(request):
+@async_login_required
+async def event_handler(request):
     if request.POST:
         event = request.POST.get('event', '')
         if event:
             if event == 'add_edit_time':
                 # TODO possibly include some sort of check to make sure the user can access the other users information
                 if request.POST.get('employee_id', ''):
-                    user = CustomUser.objects.get(id=decrypt_id(request.POST['employee_id']))
+                    user = await CustomUser.objects.select_related('company').aget(
+                        id=decrypt_id(request.POST['employee_id']))
                 else:
                     user = request.user
-                errors, action_id = add_edit_time(user, request.POST)
+                errors, action_id = await sync_to_async(add_edit_time)(user, request.POST)
                 return JsonResponse(data={'errors': errors, 'action_id': action_id}, status=201, safe=False)
 
 
-@login_required
-def fetch_actions(request):
+@async_login_required
+async def fetch_actions(request):
     if request.POST:
         # TODO possibly include some sort of check to make sure the user can access the other users information
         if request.POST.get('employee_id', ''):
-            user = CustomUser.objects.get(id=decrypt_id(request.POST['employee_id']))
+            user = await CustomUser.objects.select_related('company').aget(id=decrypt_id(request.POST['employee_id']))
         else:
             user = request.user
-        return JsonResponse(data=get_events_by_range(user, in_start=request.POST.get('start'), in_end=request.POST.get('end')), status=201, safe=False)
+        return JsonResponse(data=await aget_events_by_range(user, in_start=request.POST.get('start'), in_end=request.POST.get('end')), status=201, safe=False)
 
 
 @login_required
-def delete_action(request):
+def fetch_daily_totals(request):
     if request.POST:
-        return JsonResponse(data=delete_event(request.user, request.POST.get('action_id', '')), status=201, safe=False)
+        if request.POST.get('employee_id', ''):
+            try:
+                user = CustomUser.objects.select_related('company').get(id=decrypt_id(request.POST['employee_id']),
+                                                                        company=request.user.company)
+            except (CustomUser.DoesNotExist, InvalidToken, TypeError, ValueError):
+                return JsonResponse(data={'errors': ['The employee does not exist']}, status=404, safe=False)
+        else:
+            user = request.user
+        return JsonResponse(data=get_daily_total_events(user, in_start=request.POST.get('start'), in_end=request.POST.get('end')), status=201, safe=False)
+
+
+@async_login_required
+async def delete_action(request):
+    if request.POST:
+        return JsonResponse(data=await adelete_event(request.user, request.POST.get('action_id', '')), status=201, safe=False)
 
 
 @login_required
@@ -122,8 +191,27 @@ def report_center(request):
     page_arguments = get_main_page_data(request.user)
 
     if request.POST:
-        return generate_report(request, page, page_arguments)
+        form = ReportsForm(request.POST, company=request.user.company, user=request.user)
+        if form.is_valid():
+            job = submit_report_job(request.user, request.POST)
+            messages.info(request, 'Your report is being generated, we will send you a link when it is ready.')
+            page_arguments['report_job_id'] = encrypt_id(job.id)
+        else:
+            logger.error("An invalid request to generate a report was received")
+            messages.warning(request, 'Please fix the error below')
     else:
         form = ReportsForm(company=request.user.company)
-        page_arguments['form'] = form
-    return render(request, page, page_arguments)
\ No newline at end of file
+    page_arguments['form'] = form
+    return render(request, page, page_arguments)
+
+
+@login_required
+def report_job_status(request):
+    """Returns the state of a background report, used when the websocket is not available"""
+    if request.method != 'POST':
+        return JsonResponse(data={'errors': ['Only POST requests are allowed']}, status=405, safe=False)
+    try:
+        job = TTReportJob.objects.get(id=decrypt_id(request.POST.get('job_id', '')), user=request.user)
+    except (TTReportJob.DoesNotExist, InvalidToken, TypeError, ValueError):
+        return JsonResponse(data={'errors': ['The report does not exist']}, status=404, safe=False)
+    return JsonResponse(data=get_report_job_status(job), status=200, safe=False)
\ No newline at end of file
@@ -1,12 +1,15 @@
 import json
 from channels.generic.websocket import AsyncWebsocketConsumer
 
+from .utils import remember_server_loop
+
 
 class NotificationConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         # Get the user ID from the session
         user_id = self.scope['user'].id
         print("Connected")
+        remember_server_loop()
 
         # Set the channel name to "user_{user_id}"
         self.group_name = 'user_' + str(user_id)
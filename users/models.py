@@ -4,7 +4,7 @@ from django.contrib.auth.models import AbstractUser
 from django.db import models
 from django.utils.translation import gettext_lazy as _
 from timezone_field import TimeZoneField
-from time_tracker.models import TTUserInfo, TTCompanyInfo
+from time_tracker.models import TTUserInfo, TTCompanyInfo, notify_status_changed
 
 from .managers import CustomUserManager
 
@@ -27,6 +27,11 @@ class Company(models.Model):
         if created:
             # this is created for the first time, so we need to initialize other modals
             TTCompanyInfo.objects.create(company=self)
+        else:
+            from middleware.tenant import tenant_changed
+            from time_tracker.daily_totals import timezone_changed
+            tenant_changed(company_id=self.pk)
+            timezone_changed(company_id=self.pk)
 
 
 class CustomUser(AbstractUser):
@@ -50,11 +55,27 @@ class CustomUser(AbstractUser):
 
     objects = CustomUserManager()
 
+    # what the cached statuses of the company's employees carry about the user
+    STATUS_FIELDS = ('full_name', 'first_name', 'email', 'active', 'company_id')
+    STATUS_UPDATE_FIELDS = {'first_name', 'middle_name', 'last_name', 'full_name', 'email', 'active', 'company',
+                            'company_id'}
+
     def __str__(self):
         return self.email
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """Remembers what the cached statuses show of the user, saving the user only notifies when that changed"""
+        instance = super().from_db(db, field_names, values)
+        instance._original_status = instance.get_status_values()
+        return instance
+
+    def get_status_values(self):
+        return tuple(self.__dict__.get(name) for name in self.STATUS_FIELDS)
+
     def save(self, *args, **kwargs):
         created = not self.pk
+        update_fields = kwargs.get('update_fields')
         self.update_full_name()
         super().save(*args, **kwargs)
         if not self.company:
@@ -70,6 +91,22 @@ class CustomUser(AbstractUser):
             CompanyConnection.objects.create(company=company, user=self, role='e')
         if created:
             TTUserInfo.objects.create(user=self)
+        elif kwargs.get('update_fields') is None or 'timezone' in kwargs['update_fields']:
+            from time_tracker.daily_totals import timezone_changed
+            timezone_changed(user_id=self.id)
+        # the cached statuses carry the name, email and active flag of the employees, a login only saves last_login
+        original_status = getattr(self, '_original_status', None)
+        status = self.get_status_values()
+        if (update_fields is None or self.STATUS_UPDATE_FIELDS & set(update_fields)) and status != original_status:
+            notify_status_changed(self.id, self.company_id)
+            if original_status is not None and original_status[-1] not in (None, self.company_id):
+                # the user moved, their old company lists them too
+                notify_status_changed(self.id, original_status[-1])
+        self._original_status = status
+
+    def delete(self, *args, **kwargs):
+        notify_status_changed(self.id, self.company_id)
+        return super().delete(*args, **kwargs)
 
     def update_full_name(self):
         """
@@ -90,6 +127,12 @@ class CompanyConnection(models.Model):
     role = models.CharField(_('Role'), max_length=2, help_text="The role of the user within the company", default='e', choices=(('e', 'Employee'), ('c', 'Company Admin'), ('r', 'Restricted Admin')))
     updated_date = models.DateField(_("Updated Date"), auto_now=True, blank=True, null=True)
 
+    def save(self, *args, **kwargs):
+        """Overridden so the user's cached tenant picks up the new role"""
+        super().save(*args, **kwargs)
+        from middleware.tenant import tenant_changed
+        tenant_changed(user_id=self.user_id)
+
 
 class Notification(models.Model):
     user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, null=False)
@@ -4,13 +4,23 @@ from django.utils.encoding import force_bytes
 from django.core.mail import send_mail
 from django.conf import settings
 from .tokens import account_activation_token
-from daxApp.encryption import encrypt_id, decrypt_id
+from daxApp.encryption import encrypt_ids, decrypt_id
 from django.core.paginator import Paginator
 from .models import CustomUser
 from django.contrib.sites.shortcuts import get_current_site
 from daxApp.settings import DOMAIN
+from channels.layers import get_channel_layer
+from asgiref.sync import async_to_sync
+import asyncio
 import logging
 
+GROUP_SEND_TIMEOUT = 5     # seconds
+
+# The in memory channel layer's queues belong to the event loop serving the websockets, a message sent from a loop of
+# its own (async_to_sync in a thread) is put on them from the wrong loop and the consumer waiting on them isn't woken.
+# The consumers remember the loop they run on and the sync code hands its messages to it.
+_server_loop = None
+
 
 def check_employee_form(current_site, form, initial_email, send=True):
     return_dict = {'change_email': False, 'success': True, 'form': form}
@@ -54,12 +64,13 @@ def get_selectable_employees(user, page=1, query=''):
     employees = CustomUser.objects.filter(company=user.company, full_name__contains=query).order_by('last_name',
                                                                                                     'first_name')
     p = Paginator(employees, 30)
-    for employee in p.page(page).object_list:
+    employees = list(p.page(page).object_list)
+    for employee, employee_id in zip(employees, encrypt_ids([employee.id for employee in employees])):
         text = employee.last_name + ', ' + employee.first_name
         if employee.middle_name:
             text += ' ' + employee.middle_name
         return_list.append({
-            'id': encrypt_id(employee.id),
+            'id': employee_id,
             'text': text
         })
     more = page * 30 < p.count
@@ -101,4 +112,34 @@ def send_email_with_link(user, request=None, type='activation'):
     #     settings.DEFAULT_FROM_EMAIL,
     #     [to_email],
     #     fail_silently=False,
-    # )
\ No newline at end of file
+    # )
+
+
+def send_user_message(user_id, data):
+    """Sends data to every websocket the user has open through the NotificationConsumer user group."""
+    group_send('user_' + str(user_id), {'type': 'send_message', 'data': data})
+
+
+def remember_server_loop():
+    """Called by the consumers from the loop the websockets are served on"""
+    global _server_loop
+    _server_loop = asyncio.get_running_loop()
+
+
+def group_send(group_name, message):
+    """Sends a message to a channels group from sync code, on the loop the websockets are served on when this process
+        serves any. Without one (a wsgi process, a worker) the layer is reached from a loop of our own."""
+    channel_layer = get_channel_layer()
+    loop = _server_loop
+    if loop is None or loop.is_closed() or not loop.is_running():
+        async_to_sync(channel_layer.group_send)(group_name, message)
+        return
+    try:
+        running_loop = asyncio.get_running_loop()
+    except RuntimeError:
+        running_loop = None
+    if running_loop is loop:
+        # called from sync code on the loop itself, it can't wait for the loop
+        loop.create_task(channel_layer.group_send(group_name, message))
+        return
+    asyncio.run_coroutine_threadsafe(channel_layer.group_send(group_name, message), loop).result(GROUP_SEND_TIMEOUT)